@@ -0,0 +1,374 @@
+# Arquivo: api.py
+"""
+Serviço assíncrono do motor de perguntas (POST /api/v1/query).
+
+Recebe um schema.QueryRequest, monta o SQL com o query_builder e executa
+num pool de conexões assíncrono (SQLAlchemy + asyncpg). Enquanto uma query
+espera o Postgres, o mesmo processo continua atendendo outras requisições,
+então poucos workers aguentam centenas de usuários de painel ao mesmo tempo
+(o servidor de desenvolvimento do Flask atende uma requisição por vez).
+
+* cada requisição tem um tempo limite (`timeout_ms`, com teto) aplicado no
+  Python e também como statement_timeout no Postgres;
+* se o cliente desconecta antes da resposta, a query é cancelada no banco;
+* as respostas (o JSON pronto) ficam num cache como o do main.py
+  (cache_respostas.py), com o cabeçalho X-Cache: HIT/MISS;
+* resultados grandes saem por POST /api/v1/query/stream (NDJSON ou CSV),
+  lidos de um cursor no servidor em blocos de `itersize` linhas, sem
+  montar o resultado inteiro na memória;
+* com MOTOR_COLUNAR_ATIVO, as perguntas no grão da venda são respondidas
+  da memória pelo motor_colunar.py (NumPy), sem ir ao Postgres;
+* tempos por forma de pergunta em GET /metrics (Prometheus) e planos das
+  queries lentas em GET /api/v1/queries-lentas (instrumentacao.py).
+
+Rodar: uvicorn app.api:app --workers 4
+"""
+import asyncio
+import csv
+import io
+import json
+import math
+import sys
+import time
+from contextlib import asynccontextmanager
+
+from datetime import date, datetime
+
+import anyio
+from fastapi import FastAPI, HTTPException, Query, Request, Response
+from fastapi.responses import StreamingResponse
+from sqlalchemy import exc as sa_exc, text
+from sqlalchemy.engine import URL
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from . import cache_respostas, instrumentacao, motor_colunar, query_builder, rollup
+from .conexao_db import db_config
+from .schema import QueryRequest, QueryResponse
+
+# --- CONFIGURAÇÕES ---
+POOL_TAMANHO = 20          # conexões abertas por processo
+POOL_EXTRA = 10            # conexões extras em pico (fechadas depois)
+POOL_ESPERA_SEGUNDOS = 30  # espera máxima por uma conexão livre -> 503 (o timeout da requisição vale antes)
+TIMEOUT_PADRAO_MS = 15000
+TIMEOUT_MAXIMO_MS = 60000
+DESCONEXAO_INTERVALO_SEGUNDOS = 0.1  # frequência da checagem de cliente desconectado
+ROLLUP_VERIFICACAO_SEGUNDOS = 30
+ITERSIZE_PADRAO = 2000     # linhas buscadas do cursor por vez no modo streaming
+ITERSIZE_MAXIMO = 50000
+MOTOR_COLUNAR_ATIVO = False  # responde da memória (motor_colunar.py) as perguntas que ele cobre
+# Prepared statements guardados por conexão (asyncpg). Com o cache de planos
+# do query_builder, cada forma de pergunta gera sempre o mesmo SQL e é
+# preparada uma vez por conexão.
+PREPARED_POR_CONEXAO = query_builder.PLANOS_MAX_ITENS
+
+# Status usado (como no nginx) quando o cliente desistiu antes da resposta
+STATUS_CLIENTE_DESCONECTADO = 499
+
+
+def url_async(config):
+    """Converte o db_config do conexao_db numa URL postgresql+asyncpg."""
+    return URL.create(
+        'postgresql+asyncpg',
+        username=config.get('user'),
+        password=config.get('password'),
+        host=config.get('host'),
+        port=config.get('port'),
+        database=config.get('database'),
+        query={'prepared_statement_cache_size': str(PREPARED_POR_CONEXAO)},
+    )
+
+
+# --- 1. Ciclo de vida: pool assíncrono e cache ---
+engine = None
+cache = cache_respostas.CacheRespostas()
+motor = motor_colunar.MotorColunar()
+_rollup = {'valor': False, 'verificado_em': -math.inf}
+
+
+@asynccontextmanager
+async def lifespan(app):
+    global engine
+    engine = create_async_engine(
+        url_async(db_config),
+        pool_size=POOL_TAMANHO,
+        max_overflow=POOL_EXTRA,
+        pool_timeout=POOL_ESPERA_SEGUNDOS,
+        pool_pre_ping=True,
+    )
+    cache_respostas.iniciar_escuta_invalidacao(
+        db_config, cache, canais=(cache_respostas.CANAL_VENDAS, rollup.CANAL_ROLLUP)
+    )
+    instrumentacao.iniciar_captura_planos(db_config)
+    if MOTOR_COLUNAR_ATIVO:
+        motor_colunar.iniciar_atualizacao_em_segundo_plano(motor, db_config)
+    try:
+        yield
+    finally:
+        await engine.dispose()
+
+
+app = FastAPI(title="Maria BI - Motor de Perguntas", lifespan=lifespan)
+
+
+# --- 2. Execução da pergunta ---
+async def rollup_pronto(conn):
+    """Versão assíncrona de rollup.rollup_pronto (resultado em cache por alguns segundos)."""
+    agora = time.monotonic()
+    if agora - _rollup['verificado_em'] < ROLLUP_VERIFICACAO_SEGUNDOS:
+        return _rollup['valor']
+
+    pronto = False
+    existe = await conn.scalar(text("SELECT to_regclass(:tabela) IS NOT NULL"), {'tabela': rollup.ROLLUP_ESTADO})
+    if existe:
+        construidos = await conn.scalar(
+            text(f"SELECT COUNT(*) FROM {rollup.ROLLUP_ESTADO} "
+                 "WHERE built_at IS NOT NULL AND rollup_name = ANY(:tabelas)"),
+            {'tabelas': list(rollup.TABELAS_ROLLUP)},
+        )
+        pronto = construidos == len(rollup.TABELAS_ROLLUP)
+
+    _rollup['valor'] = pronto
+    _rollup['verificado_em'] = agora
+    return pronto
+
+
+async def executar_pergunta(query_request: QueryRequest, timeout_ms: int, medicao=None):
+    """
+    Monta e executa a query; devolve (linhas como dicts, erro relativo ou None se exata).
+    Os tempos vão para `medicao` (instrumentacao.Medicao), que quem chama finaliza.
+    """
+    medicao = medicao if medicao is not None else instrumentacao.Medicao('v1/query')
+    if MOTOR_COLUNAR_ATIVO and motor.pode_responder(query_request):
+        forma = query_builder.forma_da_requisicao(query_request, usar_rollup=False)
+        medicao.forma = instrumentacao.rotulo_forma(forma[:-1] + ('motor_colunar',))
+        inicio = time.perf_counter()
+        # Em outra thread: o cálculo em NumPy não segura o event loop
+        linhas = await asyncio.to_thread(motor.responder, query_request)
+        medicao.execucao += time.perf_counter() - inicio
+        medicao.linhas += len(linhas)
+        return linhas, None
+    inicio = time.perf_counter()
+    async with engine.connect() as conn:
+        medicao.espera_pool += time.perf_counter() - inicio
+        # SET LOCAL vale só para esta transação: a conexão volta limpa ao pool
+        await conn.execute(text(f"SET LOCAL statement_timeout = {int(timeout_ms)}"))
+        usar_rollup = await rollup_pronto(conn)
+        medicao.forma = instrumentacao.rotulo_forma(query_builder.forma_da_requisicao(query_request, usar_rollup))
+        query, parametros = query_builder.plano_da_requisicao(query_request, usar_rollup=usar_rollup)
+        inicio = time.perf_counter()
+        # Com o asyncpg o execute já traz todas as linhas: não há fetch separado
+        resultado = await conn.execute(query, parametros)
+        duracao = time.perf_counter() - inicio
+        medicao.execucao += duracao
+        if instrumentacao.lenta(duracao):
+            instrumentacao.capturar_plano(query, parametros, duracao, medicao)
+        linhas = [dict(linha._mapping) for linha in resultado]
+        medicao.linhas += len(linhas)
+        erro = query_builder.erro_padrao_relativo(query_request, usar_rollup=usar_rollup)
+        return linhas, erro
+
+
+async def _esperar_desconexao(request: Request):
+    while not await request.is_disconnected():
+        await asyncio.sleep(DESCONEXAO_INTERVALO_SEGUNDOS)
+
+
+async def executar_ou_cancelar(request: Request, corrotina, timeout_segundos):
+    """
+    Roda `corrotina` até terminar, estourar o tempo ou o cliente desconectar.
+    Nos dois últimos casos a tarefa é cancelada, o que cancela a query no
+    Postgres e devolve (ou descarta) a conexão do pool.
+    """
+    tarefa = asyncio.ensure_future(corrotina)
+    vigia = asyncio.ensure_future(_esperar_desconexao(request))
+    try:
+        feitas, _ = await asyncio.wait({tarefa, vigia}, timeout=timeout_segundos,
+                                       return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        vigia.cancel()
+        if not tarefa.done():
+            tarefa.cancel()
+            await asyncio.gather(tarefa, return_exceptions=True)
+
+    if tarefa in feitas:
+        return tarefa.result()
+    if vigia in feitas:
+        raise HTTPException(STATUS_CLIENTE_DESCONECTADO, "Cliente desconectou; query cancelada.")
+    raise HTTPException(504, f"A consulta passou do tempo limite ({timeout_segundos:g}s) e foi cancelada.")
+
+
+def erro_http(e, timeout_ms, endpoint):
+    """Traduz uma exceção da consulta no HTTPException correspondente."""
+    if isinstance(e, HTTPException):
+        return e
+    if isinstance(e, ValueError):  # pergunta que o query_builder não sabe montar
+        return HTTPException(400, str(e))
+    if isinstance(e, sa_exc.TimeoutError):
+        return HTTPException(503, "Todas as conexões com o banco estão ocupadas; tente novamente.")
+    # statement_timeout do Postgres (SQLSTATE 57014): mesmo tratamento do tempo limite
+    if isinstance(e, sa_exc.DBAPIError) and getattr(e.orig, 'sqlstate', None) == '57014':
+        return HTTPException(504, f"A consulta passou do tempo limite ({timeout_ms} ms) e foi cancelada.")
+    print(f"ERRO [{endpoint}]: {e}", file=sys.stderr)
+    return HTTPException(500, "Erro ao executar a consulta.")
+
+
+# --- 3. Endpoints ---
+@app.post('/api/v1/query', response_model=QueryResponse)
+async def query(
+    query_request: QueryRequest,
+    request: Request,
+    timeout_ms: int = Query(TIMEOUT_PADRAO_MS, gt=0, le=TIMEOUT_MAXIMO_MS,
+                            description="Tempo limite da consulta, em milissegundos."),
+):
+    """Responde a uma pergunta (métrica + dimensões + filtros) do painel."""
+    medicao = instrumentacao.Medicao('v1/query')
+    chave = cache_respostas.chave_query_request(query_request)
+    achou, corpo = cache.obter(chave)
+    if achou:
+        medicao.finalizar(cache='HIT')
+        return Response(corpo, media_type='application/json', headers={'X-Cache': 'HIT'})
+
+    geracao = cache.geracao
+    try:
+        dados, erro = await executar_ou_cancelar(
+            request, executar_pergunta(query_request, timeout_ms, medicao), timeout_ms / 1000
+        )
+    except Exception as e:
+        medicao.finalizar(cache='MISS')
+        raise erro_http(e, timeout_ms, 'v1/query')
+
+    corpo = QueryResponse(dados=dados, erro_padrao_relativo=erro, query_request=query_request).model_dump_json()
+    cache.guardar(chave, corpo, geracao)
+    medicao.finalizar(cache='MISS')
+    return Response(corpo, media_type='application/json', headers={'X-Cache': 'MISS'})
+
+
+# --- 4. Modo streaming (resultados grandes) ---
+FORMATOS_STREAM = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv; charset=utf-8',
+}
+
+
+def _valor_json(valor):
+    # Mesmo formato da resposta JSON: datas em ISO, Decimal como texto
+    if isinstance(valor, (date, datetime)):
+        return valor.isoformat()
+    return str(valor)
+
+
+def formatar_bloco(colunas, linhas, formato):
+    """Converte um bloco de linhas em texto NDJSON (um objeto por linha) ou CSV."""
+    if formato == 'ndjson':
+        return ''.join(json.dumps(dict(zip(colunas, linha)), default=_valor_json, ensure_ascii=False) + '\n'
+                       for linha in linhas)
+    saida = io.StringIO()
+    csv.writer(saida, lineterminator='\n').writerows(linhas)
+    return saida.getvalue()
+
+
+async def _enviar_blocos(conn, resultado, formato, medicao):
+    """Lê o cursor bloco a bloco e entrega cada bloco já formatado; fecha tudo no fim."""
+    try:
+        colunas = list(resultado.keys())
+        if formato == 'csv':
+            yield formatar_bloco(colunas, [colunas], 'csv')
+        inicio = time.perf_counter()
+        async for linhas in resultado.partitions():
+            # Fetch: da volta do yield (cliente leu o bloco anterior) até o próximo bloco chegar
+            medicao.fetch += time.perf_counter() - inicio
+            medicao.linhas += len(linhas)
+            yield formatar_bloco(colunas, linhas, formato)
+            inicio = time.perf_counter()
+    finally:
+        # Cliente desconectado cancela o gerador; a limpeza roda protegida do
+        # cancelamento para fechar o cursor e devolver a conexão ao pool
+        with anyio.CancelScope(shield=True):
+            await resultado.close()
+            await conn.close()
+        medicao.finalizar()
+
+
+async def abrir_cursor(query_request: QueryRequest, timeout_ms: int, itersize: int, medicao):
+    """
+    Abre conexão e cursor no servidor para a pergunta; quem chama fecha a conexão.
+    Devolve (conn, resultado, erro relativo ou None se a resposta é exata).
+    """
+    inicio = time.perf_counter()
+    conn = await engine.connect()
+    medicao.espera_pool += time.perf_counter() - inicio
+    try:
+        await conn.execute(text(f"SET LOCAL statement_timeout = {int(timeout_ms)}"))
+        usar_rollup = await rollup_pronto(conn)
+        medicao.forma = instrumentacao.rotulo_forma(query_builder.forma_da_requisicao(query_request, usar_rollup))
+        query, parametros = query_builder.plano_da_requisicao(query_request, usar_rollup=usar_rollup)
+        inicio = time.perf_counter()
+        resultado = await conn.stream(query, parametros, execution_options={'yield_per': itersize})
+        duracao = time.perf_counter() - inicio
+        medicao.execucao += duracao
+        if instrumentacao.lenta(duracao):
+            instrumentacao.capturar_plano(query, parametros, duracao, medicao)
+        return conn, resultado, query_builder.erro_padrao_relativo(query_request, usar_rollup=usar_rollup)
+    except BaseException:
+        await conn.close()
+        raise
+
+
+@app.post('/api/v1/query/stream')
+async def query_stream(
+    query_request: QueryRequest,
+    request: Request,
+    formato: str = Query('ndjson', pattern='^(ndjson|csv)$', description="ndjson ou csv"),
+    itersize: int = Query(ITERSIZE_PADRAO, gt=0, le=ITERSIZE_MAXIMO,
+                          description="Linhas buscadas do banco por vez."),
+    timeout_ms: int = Query(TIMEOUT_PADRAO_MS, gt=0, le=TIMEOUT_MAXIMO_MS,
+                            description="Tempo limite até a consulta começar a devolver linhas."),
+):
+    """
+    Mesma pergunta do /api/v1/query, mas as linhas saem conforme chegam do
+    banco (resposta em chunks). A memória usada não depende do tamanho do
+    resultado. Não passa pelo cache.
+    """
+    medicao = instrumentacao.Medicao('v1/query/stream')
+    try:
+        conn, resultado, erro = await executar_ou_cancelar(
+            request, abrir_cursor(query_request, timeout_ms, itersize, medicao), timeout_ms / 1000
+        )
+    except Exception as e:
+        medicao.finalizar()
+        raise erro_http(e, timeout_ms, 'v1/query/stream')
+
+    cabecalhos = {'Content-Disposition': 'attachment; filename="consulta.csv"'} if formato == 'csv' else {}
+    if erro is not None:
+        cabecalhos['X-Erro-Padrao-Relativo'] = f"{erro:.4f}"
+    return StreamingResponse(_enviar_blocos(conn, resultado, formato, medicao),
+                             media_type=FORMATOS_STREAM[formato], headers=cabecalhos)
+
+
+@app.get('/api/v1/status')
+async def status():
+    """Uso do pool de conexões e contadores dos caches (respostas e planos)."""
+    pool = engine.pool
+    return {
+        'pool': {
+            'tamanho': pool.size(),
+            'em_uso': pool.checkedout(),
+            'livres': pool.checkedin(),
+            'extras': max(pool.overflow(), 0),
+        },
+        'cache': cache.estatisticas(),
+        'planos': query_builder.planos.estatisticas(),
+        'motor_colunar': motor.estatisticas() if MOTOR_COLUNAR_ATIVO else None,
+    }
+
+
+@app.get('/metrics')
+async def metrics():
+    """Histogramas de tempo e linhas por endpoint e forma de pergunta, no formato de texto do Prometheus."""
+    return Response(instrumentacao.metricas.texto(), media_type=instrumentacao.TIPO_CONTEUDO_METRICAS)
+
+
+@app.get('/api/v1/queries-lentas')
+async def queries_lentas():
+    """EXPLAIN (ANALYZE, BUFFERS) das últimas queries acima de instrumentacao.LIMIAR_QUERY_LENTA_MS."""
+    return instrumentacao.planos_lentos.listar()
@@ -0,0 +1,226 @@
+# Arquivo: cache_respostas.py
+"""
+Cache das respostas dos painéis (LRU com TTL por endpoint).
+
+As páginas de painel disparam sempre os mesmos poucos endpoints com as
+mesmas query strings. Guardamos a resposta pronta (JSON) por chave
+normalizada, para que a mesma pergunta não vá ao Postgres de novo:
+
+* a chave ignora a ordem de `loja`/`canal`, preenche os valores padrão
+  (hora_inicio=0, hora_fim=23, ...) e descarta parâmetros desconhecidos;
+* cada entrada expira pelo TTL do seu endpoint, e o cache tem tamanho
+  máximo (sai a entrada usada há mais tempo);
+* quando chegam vendas novas (gerador, carga, API) ou o rollup é
+  atualizado, o Postgres avisa por LISTEN/NOTIFY e o cache é esvaziado.
+"""
+import json
+import select
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+import psycopg2
+
+# Canal de NOTIFY disparado por qualquer comando que altere `sales`
+CANAL_VENDAS = 'vendas_alteradas'
+TRIGGER_AVISO_VENDAS = f'trg_{CANAL_VENDAS}'
+
+# Criado na preparação do banco (rollup.criar_estrutura_rollup), não na API:
+# DROP/CREATE TRIGGER trava `sales` (ACCESS EXCLUSIVE)
+DDL_AVISO_VENDAS = f"""
+CREATE OR REPLACE FUNCTION {CANAL_VENDAS}_avisar() RETURNS trigger AS $$
+BEGIN
+    -- Um aviso por comando; o Postgres junta avisos iguais da mesma transação
+    -- e só entrega no COMMIT
+    PERFORM pg_notify('{CANAL_VENDAS}', TG_TABLE_NAME);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS {TRIGGER_AVISO_VENDAS} ON sales;
+CREATE TRIGGER {TRIGGER_AVISO_VENDAS}
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON sales
+    FOR EACH STATEMENT EXECUTE FUNCTION {CANAL_VENDAS}_avisar();
+"""
+
+# Tamanho máximo e TTLs (segundos). O prefixo do endpoint escolhe o TTL.
+CACHE_MAX_ITENS = 1024
+TTL_PADRAO_SEGUNDOS = 60
+TTL_POR_ENDPOINT = {
+    'analise/resumo-kpis': 30,
+    'analise/top-produtos': 60,
+    'graficos/': 60,
+    'query': 60,
+}
+
+
+class CacheRespostas:
+    """LRU limitado por quantidade de itens, com expiração por entrada. Thread-safe."""
+
+    def __init__(self, max_itens=CACHE_MAX_ITENS, ttl_por_endpoint=None, ttl_padrao=TTL_PADRAO_SEGUNDOS):
+        self.max_itens = max_itens
+        self.ttl_por_endpoint = TTL_POR_ENDPOINT if ttl_por_endpoint is None else ttl_por_endpoint
+        self.ttl_padrao = ttl_padrao
+        self._itens = OrderedDict()  # chave -> (expira_em, valor)
+        self._lock = threading.Lock()
+        self._contadores = {'hits': 0, 'misses': 0, 'expirados': 0, 'despejados': 0, 'invalidacoes': 0}
+        self._por_endpoint = {}
+        self._ultima_invalidacao = None
+        self._geracao = 0  # muda a cada invalidação
+
+    @property
+    def geracao(self):
+        return self._geracao
+
+    def ttl(self, endpoint):
+        for prefixo, segundos in self.ttl_por_endpoint.items():
+            if endpoint.startswith(prefixo):
+                return segundos
+        return self.ttl_padrao
+
+    def obter(self, chave):
+        """Retorna (achou, valor). A chave é a tupla (endpoint, filtros normalizados)."""
+        endpoint = chave[0]
+        agora = time.monotonic()
+        with self._lock:
+            item = self._itens.get(chave)
+            if item is not None and item[0] <= agora:
+                del self._itens[chave]
+                self._contadores['expirados'] += 1
+                item = None
+            contador = self._por_endpoint.setdefault(endpoint, {'hits': 0, 'misses': 0})
+            if item is None:
+                self._contadores['misses'] += 1
+                contador['misses'] += 1
+                return False, None
+            self._itens.move_to_end(chave)
+            self._contadores['hits'] += 1
+            contador['hits'] += 1
+            return True, item[1]
+
+    def guardar(self, chave, valor, geracao=None):
+        """
+        Guarda `valor`. Passe a `geracao` lida antes de calcular o valor: se o
+        cache foi invalidado no meio do cálculo, o valor (possivelmente velho)
+        é descartado.
+        """
+        expira_em = time.monotonic() + self.ttl(chave[0])
+        with self._lock:
+            if geracao is not None and geracao != self._geracao:
+                return
+            self._itens[chave] = (expira_em, valor)
+            self._itens.move_to_end(chave)
+            while len(self._itens) > self.max_itens:
+                self._itens.popitem(last=False)
+                self._contadores['despejados'] += 1
+
+    def invalidar(self, motivo=''):
+        """Esvazia o cache (dados novos no banco)."""
+        with self._lock:
+            self._itens.clear()
+            self._geracao += 1
+            self._contadores['invalidacoes'] += 1
+            self._ultima_invalidacao = {'motivo': motivo, 'em': time.time()}
+
+    def estatisticas(self):
+        with self._lock:
+            consultas = self._contadores['hits'] + self._contadores['misses']
+            return {
+                **self._contadores,
+                'taxa_acerto': (self._contadores['hits'] / consultas) if consultas else 0,
+                'itens': len(self._itens),
+                'max_itens': self.max_itens,
+                'ultima_invalidacao': self._ultima_invalidacao,
+                'por_endpoint': {e: dict(c) for e, c in self._por_endpoint.items()},
+            }
+
+
+# --- CHAVES NORMALIZADAS ---
+
+def normalizar_args(args, campos):
+    """
+    Lê da query string só os `campos` conhecidos, na forma canônica.
+
+    campos: {nome: (tipo, padrão)}. Com tipo `list` o valor vira uma tupla
+    ordenada e sem repetição (ex.: várias `loja`); com `tuple`, uma tupla na
+    ordem recebida (quando a ordem muda a resposta); os demais são convertidos
+    como nos handlers (valor inválido -> padrão).
+    """
+    filtros = {}
+    for nome, (tipo, padrao) in campos.items():
+        if tipo is list:
+            filtros[nome] = tuple(sorted(set(args.getlist(nome))))
+        elif tipo is tuple:
+            filtros[nome] = tuple(args.getlist(nome))
+        else:
+            filtros[nome] = args.get(nome, default=padrao, type=tipo)
+    return filtros
+
+
+def chave_requisicao(endpoint, filtros):
+    """Chave de cache: endpoint + filtros normalizados (ordem dos campos fixa)."""
+    return (endpoint, tuple(sorted(filtros.items())))
+
+
+def chave_query_request(query_request):
+    """
+    Chave de cache de um schema.QueryRequest. A ordem dos filtros (e dos
+    valores de um filtro `in`) não muda o resultado, então é normalizada;
+    a ordem das dimensões muda as colunas da resposta e é mantida.
+    """
+    pergunta = query_request.model_dump(mode='json')
+    filtros = []
+    for f in pergunta.get('filtros') or []:
+        valor = f.get('valor')
+        if isinstance(valor, list):
+            valor = sorted(valor, key=json.dumps)
+        filtros.append(json.dumps({**f, 'valor': valor}, sort_keys=True))
+    pergunta['filtros'] = sorted(filtros)
+    return ('query', json.dumps(pergunta, sort_keys=True))
+
+
+# --- INVALIDAÇÃO (LISTEN/NOTIFY) ---
+
+def iniciar_escuta_invalidacao(db_config, cache, canais=(CANAL_VENDAS,), espera_segundos=5):
+    """
+    Sobe uma thread daemon que escuta os `canais` e esvazia o `cache` a cada aviso.
+    Usa uma conexão própria e só faz LISTEN. Se a conexão cair, esvazia o
+    cache (avisos podem ter se perdido) e reconecta. Sem o trigger de
+    DDL_AVISO_VENDAS no banco, vendas novas só saem do cache pelo TTL.
+    """
+    def _loop():
+        conn = None
+        while True:
+            try:
+                if conn is None or conn.closed:
+                    conn = psycopg2.connect(**db_config)
+                    conn.autocommit = True
+                    with conn.cursor() as cursor:
+                        for canal in canais:
+                            cursor.execute(f"LISTEN {canal}")
+                        if CANAL_VENDAS in canais:
+                            cursor.execute("SELECT 1 FROM pg_trigger WHERE tgname = %s AND tgrelid = 'sales'::regclass",
+                                           (TRIGGER_AVISO_VENDAS,))
+                            if cursor.fetchone() is None:
+                                print(f"AVISO [cache-invalidacao]: trigger {TRIGGER_AVISO_VENDAS} não existe; "
+                                      f"rode rollup.py para criá-lo", file=sys.stderr)
+                    cache.invalidar('reconexão')
+
+                if select.select([conn], [], [], espera_segundos)[0]:
+                    conn.poll()
+                    if conn.notifies:
+                        motivos = sorted({f"{n.channel}:{n.payload}" for n in conn.notifies})
+                        conn.notifies.clear()
+                        cache.invalidar(", ".join(motivos))
+            except Exception as e:
+                print(f"ERRO [cache-invalidacao]: {e}", file=sys.stderr)
+                cache.invalidar('erro na escuta')
+                if conn is not None and not conn.closed:
+                    conn.close()
+                conn = None
+                time.sleep(espera_segundos)
+
+    thread = threading.Thread(target=_loop, name='cache-invalidacao', daemon=True)
+    thread.start()
+    return thread
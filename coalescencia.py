@@ -0,0 +1,160 @@
+# Arquivo: coalescencia.py
+"""
+Coalescência de requisições iguais e simultâneas ("single-flight").
+
+Quando um painel abre (ou vários usuários abrem a mesma visão padrão na
+virada da hora), chegam juntas várias requisições com a mesma pergunta.
+O cache de respostas (cache_respostas.py) só ajuda depois que a primeira
+termina; até lá cada uma roda o mesmo SQL pesado numa conexão do pool.
+
+Com a Coalescencia, a primeira requisição de uma chave (a mesma chave
+normalizada do cache) calcula o valor e as outras esperam por ele:
+
+* entre threads do mesmo processo: as seguidoras esperam num Event e
+  recebem o mesmo valor (ou a mesma exceção) da líder;
+* entre processos (opcional, `pasta_travas`): cada chave tem um arquivo
+  de trava na máquina (flock). A líder de cada processo disputa a trava;
+  quem ganha calcula e grava o resultado num arquivo ao lado, e quem
+  esperou lê o resultado em vez de calcular. Só resultados gravados
+  depois que a espera começou são aceitos, então nada mais velho que uma
+  requisição concorrente é servido. No modo entre processos o valor tem
+  que ser serializável em JSON.
+
+Quem espera mais que `espera_maxima_segundos` desiste e calcula sozinho.
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # Windows: só a coalescência entre threads
+    fcntl = None
+
+ESPERA_MAXIMA_SEGUNDOS = 30
+INTERVALO_TRAVA_SEGUNDOS = 0.01  # intervalo entre tentativas de pegar a trava de arquivo
+
+
+class _Voo:
+    """Um cálculo em andamento: as seguidoras esperam `pronto`."""
+
+    def __init__(self):
+        self.pronto = threading.Event()
+        self.valor = None
+        self.erro = None
+        self.seguidoras = 0
+
+
+class Coalescencia:
+    """Executa no máximo um cálculo por chave de cada vez. Thread-safe."""
+
+    def __init__(self, pasta_travas=None, espera_maxima_segundos=ESPERA_MAXIMA_SEGUNDOS):
+        self.pasta_travas = pasta_travas
+        self.espera_maxima_segundos = espera_maxima_segundos
+        self._voos = {}  # chave -> _Voo
+        self._lock = threading.Lock()
+        self._contadores = {'lideres': 0, 'coalescidas': 0, 'entre_processos': 0, 'desistencias': 0}
+        if pasta_travas is not None:
+            if fcntl is None:
+                raise RuntimeError("A coalescência entre processos precisa de fcntl (Linux/macOS).")
+            os.makedirs(pasta_travas, mode=0o700, exist_ok=True)
+
+    def executar(self, chave, calcular):
+        """
+        Retorna (valor, coalescida). `calcular()` roda só na líder; com
+        coalescida=True o valor veio do cálculo de outra requisição.
+        """
+        with self._lock:
+            voo = self._voos.get(chave)
+            lider = voo is None
+            if lider:
+                voo = self._voos[chave] = _Voo()
+                self._contadores['lideres'] += 1
+            else:
+                voo.seguidoras += 1
+
+        if not lider:
+            if not voo.pronto.wait(self.espera_maxima_segundos):
+                self._contar('desistencias')
+                return calcular(), False
+            self._contar('coalescidas')
+            if voo.erro is not None:
+                raise voo.erro
+            return voo.valor, True
+
+        try:
+            if self.pasta_travas is None:
+                voo.valor, coalescida = calcular(), False
+            else:
+                voo.valor, coalescida = self._executar_entre_processos(chave, calcular)
+            return voo.valor, coalescida
+        except BaseException as e:
+            voo.erro = e
+            raise
+        finally:
+            with self._lock:
+                del self._voos[chave]
+            voo.pronto.set()
+
+    def _executar_entre_processos(self, chave, calcular):
+        """Disputa a trava de arquivo da chave com as líderes dos outros processos."""
+        nome = hashlib.sha1(repr(chave).encode('utf-8')).hexdigest()
+        caminho_trava = os.path.join(self.pasta_travas, nome + '.lock')
+        caminho_resultado = os.path.join(self.pasta_travas, nome + '.json')
+        inicio = time.time()
+        limite = time.monotonic() + self.espera_maxima_segundos
+
+        with open(caminho_trava, 'a') as trava:
+            esperou = False
+            while True:
+                try:
+                    fcntl.flock(trava, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    if time.monotonic() >= limite:
+                        self._contar('desistencias')
+                        return calcular(), False
+                    esperou = True
+                    time.sleep(INTERVALO_TRAVA_SEGUNDOS)
+            try:
+                if esperou:
+                    resultado = _ler_resultado(caminho_resultado)
+                    if resultado is not None and resultado['gravado_em'] >= inicio:
+                        self._contar('entre_processos')
+                        return resultado['valor'], True
+                valor = calcular()
+                _gravar_resultado(caminho_resultado, valor)
+                return valor, False
+            finally:
+                fcntl.flock(trava, fcntl.LOCK_UN)
+
+    def _contar(self, nome):
+        with self._lock:
+            self._contadores[nome] += 1
+
+    def estatisticas(self):
+        with self._lock:
+            return {
+                **self._contadores,
+                'em_andamento': len(self._voos),
+                'esperando': sum(voo.seguidoras for voo in self._voos.values()),
+                'entre_processos_ativo': self.pasta_travas is not None,
+            }
+
+
+def _ler_resultado(caminho):
+    try:
+        with open(caminho, encoding='utf-8') as arquivo:
+            return json.load(arquivo)
+    except (OSError, ValueError):
+        return None
+
+
+def _gravar_resultado(caminho, valor):
+    """Grava num temporário e renomeia: quem lê nunca vê o arquivo pela metade."""
+    temporario = f"{caminho}.{os.getpid()}.tmp"
+    with open(temporario, 'w', encoding='utf-8') as arquivo:
+        json.dump({'gravado_em': time.time(), 'valor': valor}, arquivo)
+    os.replace(temporario, caminho)
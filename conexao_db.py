@@ -1,6 +1,16 @@
 # Arquivo: conexao_db.py
-import psycopg2.pool
+import collections
 import sys
+import threading
+import time
+
+import psycopg2
+import psycopg2.extensions
+
+try:
+    from . import instrumentacao
+except ImportError:  # o main.py importa os módulos pelo nome, de dentro da pasta
+    import instrumentacao
 
 # O pool agora começa como None
 connection_pool = None
@@ -13,17 +23,232 @@ db_config = {
     'password': '1234',
     'port': 5432
 }
+
+POOL_MINIMO = 1
+POOL_MAXIMO = 20
+ESPERA_MAXIMA_SEGUNDOS = 10     # quanto uma requisição espera por uma conexão antes do 503
+STATEMENT_TIMEOUT_MS = 30000    # aplicado em toda conexão do pool
+OCIOSA_MAXIMA_SEGUNDOS = 300    # conexões livres há mais tempo são fechadas (acima do mínimo)
+VIDA_MAXIMA_SEGUNDOS = 1800     # conexões mais velhas são recicladas na retirada
+TESTAR_APOS_SEGUNDOS = 30       # conexão parada há mais tempo passa por um SELECT 1 antes de ser entregue
 # ---------------------------
 
+
+class PoolEsgotado(Exception):
+    """Nenhuma conexão ficou livre dentro do tempo de espera."""
+
+
+class PoolConexoes:
+    """
+    Pool de conexões psycopg2 seguro para várias threads.
+
+    Quem pede uma conexão com o pool cheio espera na fila (por ordem de
+    chegada) até `espera_segundos`; depois disso recebe PoolEsgotado.
+    Conexões quebradas, velhas demais ou paradas há muito tempo são
+    descartadas e reabertas. Toda conexão nasce com statement_timeout.
+    """
+
+    def __init__(self, minimo, maximo, espera_segundos=ESPERA_MAXIMA_SEGUNDOS,
+                 statement_timeout_ms=STATEMENT_TIMEOUT_MS, ociosa_maxima_segundos=OCIOSA_MAXIMA_SEGUNDOS,
+                 vida_maxima_segundos=VIDA_MAXIMA_SEGUNDOS, testar_apos_segundos=TESTAR_APOS_SEGUNDOS, **config):
+        self.minimo = minimo
+        self.maximo = maximo
+        self.espera_segundos = espera_segundos
+        self.statement_timeout_ms = statement_timeout_ms
+        self.ociosa_maxima_segundos = ociosa_maxima_segundos
+        self.vida_maxima_segundos = vida_maxima_segundos
+        self.testar_apos_segundos = testar_apos_segundos
+        self.config = config
+
+        self._cond = threading.Condition()
+        self._fila = collections.deque()  # uma ficha por thread esperando, em ordem de chegada
+        self._livres = []                 # pilha: a conexão devolvida por último sai primeiro
+        self._abertas = 0                 # livres + em uso + sendo abertas
+        self._info = {}                   # id(conn) -> {'criada_em', 'devolvida_em', 'retirada_em'}
+        self._contadores = {
+            'retiradas': 0, 'esperaram': 0, 'esgotado': 0, 'abertas_total': 0,
+            'recicladas': 0, 'falhas_teste': 0, 'descartadas': 0,
+        }
+        self._espera = {'total': 0.0, 'maximo': 0.0}
+        self._uso = {'total': 0.0, 'maximo': 0.0, 'devolvidas': 0}
+
+        with self._cond:
+            for _ in range(minimo):
+                self._abertas += 1
+                self._livres.append(self._abrir())
+
+    # --- abertura, teste e fechamento ---
+
+    def _abrir(self):
+        try:
+            # O cursor instrumentado mede execução, fetch e linhas de cada query (instrumentacao.py)
+            conn = psycopg2.connect(**{'cursor_factory': instrumentacao.CursorInstrumentado, **self.config},
+                                    options=f"-c statement_timeout={int(self.statement_timeout_ms)}")
+        except Exception:
+            with self._cond:
+                self._abertas -= 1
+                self._cond.notify_all()
+            raise
+        agora = time.monotonic()
+        with self._cond:
+            self._info[id(conn)] = {'criada_em': agora, 'devolvida_em': agora, 'retirada_em': None}
+            self._contadores['abertas_total'] += 1
+        return conn
+
+    def _fechar(self, conn):
+        """Fecha a conexão e libera a vaga (chamar com o lock)."""
+        self._info.pop(id(conn), None)
+        self._abertas -= 1
+        try:
+            conn.close()
+        except Exception:
+            pass
+        self._cond.notify_all()
+
+    def _problema(self, conn, info, agora):
+        """Motivo para não entregar a conexão ('recicladas', 'falhas_teste'), ou None se ela serve."""
+        if conn.closed:
+            return 'falhas_teste'
+        if agora - info['criada_em'] > self.vida_maxima_segundos:
+            return 'recicladas'
+        if agora - info['devolvida_em'] > self.testar_apos_segundos:
+            try:
+                with conn.cursor() as cursor:
+                    cursor.execute("SELECT 1")
+                conn.rollback()
+            except psycopg2.Error:
+                return 'falhas_teste'
+        return None
+
+    def _recolher_ociosas(self, agora):
+        """Fecha as conexões livres paradas há muito tempo, mantendo o mínimo (chamar com o lock)."""
+        while (self._livres and self._abertas > self.minimo
+               and agora - self._info[id(self._livres[0])]['devolvida_em'] > self.ociosa_maxima_segundos):
+            self._fechar(self._livres.pop(0))
+
+    # --- API ---
+
+    def getconn(self, timeout=None):
+        """Retira uma conexão, esperando na fila até `timeout` segundos (padrão: espera_segundos)."""
+        timeout = self.espera_segundos if timeout is None else timeout
+        inicio = time.monotonic()
+        prazo = inicio + timeout
+        ficha = object()
+
+        with self._cond:
+            self._fila.append(ficha)
+            try:
+                while not (self._fila[0] is ficha and (self._livres or self._abertas < self.maximo)):
+                    restante = prazo - time.monotonic()
+                    if restante <= 0:
+                        self._contadores['esgotado'] += 1
+                        raise PoolEsgotado(
+                            f"Nenhuma conexão livre em {timeout:g}s ({self._abertas} abertas, "
+                            f"{len(self._fila)} na fila)"
+                        )
+                    self._cond.wait(restante)
+            finally:
+                self._fila.remove(ficha)
+                # O próximo da fila pode ter ficado apto (ou esta ficha desistiu)
+                self._cond.notify_all()
+
+            agora = time.monotonic()
+            self._recolher_ociosas(agora)
+            conn = self._livres.pop() if self._livres else None
+            if conn is None:
+                self._abertas += 1  # reserva a vaga; a conexão é aberta fora do lock
+            else:
+                info = dict(self._info[id(conn)])
+
+            esperou = agora - inicio
+            self._contadores['retiradas'] += 1
+            if esperou > 0.001:
+                self._contadores['esperaram'] += 1
+            self._espera['total'] += esperou
+            self._espera['maximo'] = max(self._espera['maximo'], esperou)
+
+        # Teste/abertura fora do lock: não trava as outras threads
+        if conn is not None:
+            problema = self._problema(conn, info, agora)
+            if problema:
+                with self._cond:
+                    self._contadores[problema] += 1
+                    self._fechar(conn)
+                    self._abertas += 1  # a vaga continua reservada para a conexão nova
+                conn = None
+        if conn is None:
+            conn = self._abrir()
+
+        with self._cond:
+            self._info[id(conn)]['retirada_em'] = time.monotonic()
+        return conn
+
+    def putconn(self, conn, descartar=False):
+        """Devolve a conexão. Transação aberta é desfeita; conexão quebrada é fechada."""
+        if not descartar and not conn.closed:
+            try:
+                status = conn.info.transaction_status
+                if status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+                    descartar = True
+                elif status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except psycopg2.Error:
+                descartar = True
+
+        agora = time.monotonic()
+        with self._cond:
+            info = self._info.get(id(conn))
+            if info is None:
+                return  # conexão que não é deste pool (ou já fechada)
+            if info['retirada_em'] is not None:
+                usou = agora - info['retirada_em']
+                self._uso['total'] += usou
+                self._uso['maximo'] = max(self._uso['maximo'], usou)
+                self._uso['devolvidas'] += 1
+                info['retirada_em'] = None
+            if descartar or conn.closed:
+                self._contadores['descartadas'] += 1
+                self._fechar(conn)
+            else:
+                info['devolvida_em'] = agora
+                self._livres.append(conn)
+                self._cond.notify_all()
+
+    def closeall(self):
+        with self._cond:
+            for conn in self._livres:
+                self._fechar(conn)
+            self._livres = []
+
+    def estatisticas(self):
+        with self._cond:
+            em_uso = self._abertas - len(self._livres)
+            retiradas = self._contadores['retiradas']
+            devolvidas = self._uso['devolvidas']
+            return {
+                **self._contadores,
+                'abertas': self._abertas,
+                'livres': len(self._livres),
+                'em_uso': em_uso,
+                'na_fila': len(self._fila),
+                'maximo': self.maximo,
+                'utilizacao': em_uso / self.maximo,
+                'espera_media_ms': 1000 * self._espera['total'] / retiradas if retiradas else 0,
+                'espera_maxima_ms': 1000 * self._espera['maximo'],
+                'uso_medio_ms': 1000 * self._uso['total'] / devolvidas if devolvidas else 0,
+                'uso_maximo_ms': 1000 * self._uso['maximo'],
+            }
+
+
 def init_pool():
     """Cria o pool de conexões. Deve ser chamada na inicialização da API."""
     global connection_pool
     if connection_pool is None:
         try:
             print("Tentando criar pool de conexões...")
-            connection_pool = psycopg2.pool.SimpleConnectionPool(
-                1,
-                20,
+            connection_pool = PoolConexoes(
+                POOL_MINIMO,
+                POOL_MAXIMO,
                 **db_config
             )
             print("Pool de conexões criado com sucesso.")
@@ -31,21 +256,24 @@ def init_pool():
             print(f"--- ERRO FATAL AO CRIAR POOL: {e}", file=sys.stderr)
             sys.exit(1) # Sai da aplicação se o banco falhar
 
-def get_connection():
-    """Pega uma conexão do pool."""
-    global connection_pool
+def get_connection(timeout=None):
+    """
+    Pega uma conexão do pool. Com o pool cheio, espera na fila até `timeout`
+    segundos (padrão: ESPERA_MAXIMA_SEGUNDOS) e então levanta PoolEsgotado.
+    """
     if connection_pool is None:
-        print("ERRO: Pool não foi inicializado. Chame init_pool() primeiro.", file=sys.stderr)
-        return None
-        
+        raise RuntimeError("Pool não foi inicializado. Chame init_pool() primeiro.")
+    inicio = time.perf_counter()
     try:
-        conn = connection_pool.getconn()
-        return conn
-    except Exception as e:
-        print(f"Erro ao pegar conexão do pool: {e}", file=sys.stderr)
-        return None
+        return connection_pool.getconn(timeout)
+    finally:
+        instrumentacao.registrar_espera_pool(time.perf_counter() - inicio)
 
 def release_connection(conn):
     """Devolve uma conexão ao pool."""
     if connection_pool:
-        connection_pool.putconn(conn)
\ No newline at end of file
+        connection_pool.putconn(conn)
+
+def estatisticas_pool():
+    """Uso do pool, tempo de espera e tempo de uso das conexões."""
+    return connection_pool.estatisticas() if connection_pool else {}
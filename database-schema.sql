@@ -97,8 +97,12 @@ CREATE TABLE customers (
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
 
+-- Sales and every table hanging from a sale are range-partitioned by the month
+-- of the sale's created_at (one partition per month, see create_sales_partitions
+-- at the end). Child tables carry the sale's created_at as sale_created_at, so a
+-- month of sales and all its details live in partitions of the same month.
 CREATE TABLE sales (
-    id SERIAL PRIMARY KEY,
+    id SERIAL,
     store_id INTEGER NOT NULL REFERENCES stores(id),
     sub_brand_id INTEGER REFERENCES sub_brands(id),
     customer_id INTEGER REFERENCES customers(id),
@@ -110,6 +114,11 @@ CREATE TABLE sales (
     customer_name VARCHAR(100),
     sale_status_desc VARCHAR(100) NOT NULL,
     
+    -- Derived from created_at (stored, so date/hour/weekday filters can use indexes)
+    sale_date DATE GENERATED ALWAYS AS (created_at::date) STORED,
+    sale_hour SMALLINT GENERATED ALWAYS AS (EXTRACT(HOUR FROM created_at)::smallint) STORED,
+    sale_isodow SMALLINT GENERATED ALWAYS AS (EXTRACT(ISODOW FROM created_at)::smallint) STORED,
+    
     -- Financial values
     total_amount_items DECIMAL(10,2) NOT NULL,
     total_discount DECIMAL(10,2) DEFAULT 0,
@@ -127,47 +136,62 @@ CREATE TABLE sales (
     -- Metadata
     discount_reason VARCHAR(300),
     increase_reason VARCHAR(300),
-    origin VARCHAR(100) DEFAULT 'POS'
-);
+    origin VARCHAR(100) DEFAULT 'POS',
+
+    -- The partition key must be part of the primary key
+    PRIMARY KEY (id, created_at)
+) PARTITION BY RANGE (created_at);
 
 CREATE TABLE product_sales (
-    id SERIAL PRIMARY KEY,
-    sale_id INTEGER NOT NULL REFERENCES sales(id) ON DELETE CASCADE,
+    id SERIAL,
+    sale_id INTEGER NOT NULL,
+    sale_created_at TIMESTAMP NOT NULL,
     product_id INTEGER NOT NULL REFERENCES products(id),
     quantity FLOAT NOT NULL,
     base_price FLOAT NOT NULL,
     total_price FLOAT NOT NULL,
-    observations VARCHAR(300)
-);
+    observations VARCHAR(300),
+    PRIMARY KEY (id, sale_created_at),
+    FOREIGN KEY (sale_id, sale_created_at) REFERENCES sales(id, created_at) ON DELETE CASCADE
+) PARTITION BY RANGE (sale_created_at);
 
 -- Items added to products (e.g., "Hamburguer + Bacon + Queijo extra")
 CREATE TABLE item_product_sales (
-    id SERIAL PRIMARY KEY,
-    product_sale_id INTEGER NOT NULL REFERENCES product_sales(id) ON DELETE CASCADE,
+    id SERIAL,
+    product_sale_id INTEGER NOT NULL,
+    sale_created_at TIMESTAMP NOT NULL,
     item_id INTEGER NOT NULL REFERENCES items(id),
     option_group_id INTEGER REFERENCES option_groups(id),
     quantity FLOAT NOT NULL,
     additional_price FLOAT NOT NULL,
     price FLOAT NOT NULL,
     amount FLOAT DEFAULT 1,
-    observations VARCHAR(300)
-);
+    observations VARCHAR(300),
+    PRIMARY KEY (id, sale_created_at),
+    FOREIGN KEY (product_sale_id, sale_created_at)
+        REFERENCES product_sales(id, sale_created_at) ON DELETE CASCADE
+) PARTITION BY RANGE (sale_created_at);
 
 -- Items added to items (nested customization)
 CREATE TABLE item_item_product_sales (
-    id SERIAL PRIMARY KEY,
-    item_product_sale_id INTEGER NOT NULL REFERENCES item_product_sales(id) ON DELETE CASCADE,
+    id SERIAL,
+    item_product_sale_id INTEGER NOT NULL,
+    sale_created_at TIMESTAMP NOT NULL,
     item_id INTEGER NOT NULL REFERENCES items(id),
     option_group_id INTEGER REFERENCES option_groups(id),
     quantity FLOAT NOT NULL,
     additional_price FLOAT NOT NULL,
     price FLOAT NOT NULL,
-    amount FLOAT DEFAULT 1
-);
+    amount FLOAT DEFAULT 1,
+    PRIMARY KEY (id, sale_created_at),
+    FOREIGN KEY (item_product_sale_id, sale_created_at)
+        REFERENCES item_product_sales(id, sale_created_at) ON DELETE CASCADE
+) PARTITION BY RANGE (sale_created_at);
 
 CREATE TABLE delivery_sales (
-    id SERIAL PRIMARY KEY,
-    sale_id INTEGER NOT NULL REFERENCES sales(id) ON DELETE CASCADE,
+    id SERIAL,
+    sale_id INTEGER NOT NULL,
+    sale_created_at TIMESTAMP NOT NULL,
     courier_id VARCHAR(100),
     courier_name VARCHAR(100),
     courier_phone VARCHAR(100),
@@ -178,13 +202,16 @@ CREATE TABLE delivery_sales (
     delivery_fee FLOAT,
     courier_fee FLOAT,
     timing VARCHAR(100),
-    mode VARCHAR(100)
-);
+    mode VARCHAR(100),
+    PRIMARY KEY (id, sale_created_at),
+    FOREIGN KEY (sale_id, sale_created_at) REFERENCES sales(id, created_at) ON DELETE CASCADE
+) PARTITION BY RANGE (sale_created_at);
 
 CREATE TABLE delivery_addresses (
-    id SERIAL PRIMARY KEY,
-    sale_id INTEGER NOT NULL REFERENCES sales(id) ON DELETE CASCADE,
-    delivery_sale_id INTEGER REFERENCES delivery_sales(id) ON DELETE CASCADE,
+    id SERIAL,
+    sale_id INTEGER NOT NULL,
+    sale_created_at TIMESTAMP NOT NULL,
+    delivery_sale_id INTEGER,
     street VARCHAR(200),
     number VARCHAR(20),
     complement VARCHAR(200),
@@ -196,8 +223,12 @@ CREATE TABLE delivery_addresses (
     postal_code VARCHAR(20),
     reference VARCHAR(300),
     latitude FLOAT,
-    longitude FLOAT
-);
+    longitude FLOAT,
+    PRIMARY KEY (id, sale_created_at),
+    FOREIGN KEY (sale_id, sale_created_at) REFERENCES sales(id, created_at) ON DELETE CASCADE,
+    FOREIGN KEY (delivery_sale_id, sale_created_at)
+        REFERENCES delivery_sales(id, sale_created_at) ON DELETE CASCADE
+) PARTITION BY RANGE (sale_created_at);
 
 CREATE TABLE payment_types (
     id SERIAL PRIMARY KEY,
@@ -206,14 +237,17 @@ CREATE TABLE payment_types (
 );
 
 CREATE TABLE payments (
-    id SERIAL PRIMARY KEY,
-    sale_id INTEGER NOT NULL REFERENCES sales(id) ON DELETE CASCADE,
+    id SERIAL,
+    sale_id INTEGER NOT NULL,
+    sale_created_at TIMESTAMP NOT NULL,
     payment_type_id INTEGER REFERENCES payment_types(id),
     value DECIMAL(10,2) NOT NULL,
     is_online BOOLEAN DEFAULT false,
     description VARCHAR(100),
-    currency VARCHAR(10) DEFAULT 'BRL'
-);
+    currency VARCHAR(10) DEFAULT 'BRL',
+    PRIMARY KEY (id, sale_created_at),
+    FOREIGN KEY (sale_id, sale_created_at) REFERENCES sales(id, created_at) ON DELETE CASCADE
+) PARTITION BY RANGE (sale_created_at);
 
 CREATE TABLE coupons (
     id SERIAL PRIMARY KEY,
@@ -226,11 +260,90 @@ CREATE TABLE coupons (
     valid_until TIMESTAMP
 );
 
+-- sale_id is optional here: rows without a sale go to the default partition
 CREATE TABLE coupon_sales (
-    id SERIAL PRIMARY KEY,
-    sale_id INTEGER REFERENCES sales(id) ON DELETE CASCADE,
+    id SERIAL,
+    sale_id INTEGER,
+    sale_created_at TIMESTAMP,
     coupon_id INTEGER REFERENCES coupons(id),
     value FLOAT,
     target VARCHAR(100),
-    sponsorship VARCHAR(100)
-);
\ No newline at end of file
+    sponsorship VARCHAR(100),
+    FOREIGN KEY (sale_id, sale_created_at) REFERENCES sales(id, created_at) ON DELETE CASCADE
+) PARTITION BY RANGE (sale_created_at);
+
+-- ============================================================
+-- Monthly partitions
+-- ============================================================
+-- Partitioned tables, parents before children (the order partitions are
+-- created in; they are dropped in the reverse order).
+CREATE FUNCTION sales_partitioned_tables() RETURNS TEXT[] AS $$
+    SELECT ARRAY['sales', 'product_sales', 'item_product_sales', 'item_item_product_sales',
+                 'delivery_sales', 'delivery_addresses', 'payments', 'coupon_sales']
+$$ LANGUAGE sql IMMUTABLE;
+
+-- Create the monthly partitions <table>_pYYYYMM of every partitioned table,
+-- from the month of first_day to the month of last_day (inclusive), plus a
+-- <table>_default partition for rows outside them. Idempotent. Returns the
+-- number of partitions created.
+-- Note: a month can't be added while the default partition holds rows of
+-- that month, so create months ahead of the data (the generator does).
+CREATE FUNCTION create_sales_partitions(first_day DATE, last_day DATE) RETURNS INTEGER AS $$
+DECLARE
+    tbl TEXT;
+    month DATE;
+    created INTEGER := 0;
+BEGIN
+    FOREACH tbl IN ARRAY sales_partitioned_tables() LOOP
+        IF to_regclass(tbl || '_default') IS NULL THEN
+            EXECUTE format('CREATE TABLE %I PARTITION OF %I DEFAULT', tbl || '_default', tbl);
+            created := created + 1;
+        END IF;
+        month := date_trunc('month', first_day);
+        WHILE month <= last_day LOOP
+            IF to_regclass(tbl || to_char(month, '"_p"YYYYMM')) IS NULL THEN
+                EXECUTE format('CREATE TABLE %I PARTITION OF %I FOR VALUES FROM (%L) TO (%L)',
+                               tbl || to_char(month, '"_p"YYYYMM'), tbl,
+                               month, month + INTERVAL '1 month');
+                created := created + 1;
+            END IF;
+            month := month + INTERVAL '1 month';
+        END LOOP;
+    END LOOP;
+    RETURN created;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Retention: drop the monthly partitions of every month before the month of
+-- keep_from, children first. A partition still referenced by a foreign key
+-- must be detached before the drop (Postgres checks that no rows point at
+-- it, which they can't: the children of that month are already gone).
+-- A DROP per partition instead of a DELETE per row: no dead tuples, no vacuum.
+-- Returns the dropped partitions. particoes.py calls it in the same
+-- transaction that deletes those months from the rollup tables.
+CREATE FUNCTION drop_sales_partitions_before(keep_from DATE) RETURNS SETOF TEXT AS $$
+DECLARE
+    tbl TEXT;
+    part TEXT;
+BEGIN
+    FOR tbl IN SELECT t FROM unnest(sales_partitioned_tables()) WITH ORDINALITY AS u(t, n) ORDER BY n DESC LOOP
+        FOR part IN
+            SELECT c.relname
+            FROM pg_inherits i
+            JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = tbl::regclass
+              AND c.relname ~ ('^' || tbl || '_p[0-9]{6}$')
+              AND to_date(right(c.relname, 6), 'YYYYMM') < date_trunc('month', keep_from)
+            ORDER BY c.relname
+        LOOP
+            EXECUTE format('ALTER TABLE %I DETACH PARTITION %I', tbl, part);
+            EXECUTE format('DROP TABLE %I', part);
+            RETURN NEXT part;
+        END LOOP;
+    END LOOP;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Default partitions plus the current and next month; the generator adds
+-- the months it loads
+SELECT create_sales_partitions(CURRENT_DATE, (CURRENT_DATE + INTERVAL '1 month')::date);
\ No newline at end of file
@@ -4,14 +4,23 @@ God Level Coder Challenge - Data Generator
 Generates realistic restaurant data based on Arcca's actual models
 """
 
+import csv
+import io
 import random
 import argparse
+import collections
+import multiprocessing
 from datetime import datetime, timedelta
 from decimal import Decimal
 import psycopg2
-from psycopg2.extras import execute_batch
+from psycopg2.extras import execute_values
 from faker import Faker
 
+try:
+    import numpy as np
+except ImportError:  # without numpy the default engine falls back to python
+    np = None
+
 fake = Faker('pt_BR')
 
 # Configurations
@@ -70,9 +79,33 @@ DISCOUNT_REASONS = [
 DELIVERY_TYPES = ['DELIVERY', 'TAKEOUT', 'INDOOR']
 COURIER_TYPES = ['PLATFORM', 'OWN', 'THIRD_PARTY']
 
+# Per-sale fake data (names, addresses) is drawn from pools of pre-generated
+# Faker values: calling Faker for every sale dominates generation time.
+FAKE_POOL_SIZE = 5000
+FAKE_POOL_PROVIDERS = ['name', 'phone_number', 'street_name', 'bairro',
+                       'city', 'estado_sigla', 'postcode']
+_fake_pools = {}
+
+# Tables filled by the sales loaders (sequences are re-synced after a COPY load)
+SALES_TABLES = ['sales', 'product_sales', 'item_product_sales',
+                'delivery_sales', 'delivery_addresses', 'payments']
+
+# Batch sizes per loader: COPY pays off with bigger batches
+BATCH_SIZES = {'copy': 5000, 'insert': 500}
+
+# Dimension lookups answered from the in-process caches (see build_dimension_cache)
+# instead of a query: one saved round trip each
+_round_trips_saved = collections.Counter()
+
+# Sales are generated in fixed blocks of days, each with its own seed, so the
+# same --seed gives the same rows whatever the number of workers
+SHARD_DAYS = 30
+
 
 def get_db_connection(db_url):
-    return psycopg2.connect(db_url)
+    # The generator commits once per day of sales; waiting for each WAL flush
+    # only slows the load, and a crashed run is re-run from scratch anyway
+    return psycopg2.connect(db_url, options='-c synchronous_commit=off')
 
 
 def get_hour_weight(hour):
@@ -82,8 +115,36 @@ def get_hour_weight(hour):
     return 0.01
 
 
+def fake_value(provider):
+    """Random value from a pool of pre-generated Faker outputs (e.g. 'name', 'bairro')"""
+    pool = _fake_pools.get(provider)
+    if pool is None:
+        method = getattr(fake, provider)
+        pool = _fake_pools[provider] = [method() for _ in range(FAKE_POOL_SIZE)]
+    return random.choice(pool)
+
+
+def warm_fake_pools():
+    """Build every per-sale Faker pool up front (in a fixed order, so a seeded run is reproducible)"""
+    for provider in FAKE_POOL_PROVIDERS:
+        if provider not in _fake_pools:
+            method = getattr(fake, provider)
+            _fake_pools[provider] = [method() for _ in range(FAKE_POOL_SIZE)]
+    return _fake_pools
+
+
+def cumulative_weights(weights):
+    """Running sum of weights, so random.choices doesn't rebuild it on every call"""
+    total = 0
+    cum = []
+    for w in weights:
+        total += w
+        cum.append(total)
+    return cum
+
+
 def setup_base_data(conn):
-    """Create brands, channels, payment types"""
+    """Create brands, channels, payment types (returns their ids for the dimension cache)"""
     print("Setting up base data...")
     cursor = conn.cursor()
     
@@ -114,15 +175,33 @@ def setup_base_data(conn):
         })
     
     # Payment types
+    payment_type_ids = {}
     for pt in PAYMENT_TYPES_LIST:
         cursor.execute(
-            "INSERT INTO payment_types (brand_id, description) VALUES (%s, %s)",
+            "INSERT INTO payment_types (brand_id, description) VALUES (%s, %s) RETURNING id",
             (BRAND_ID, pt)
         )
+        payment_type_ids[pt] = cursor.fetchone()[0]
     
     conn.commit()
     print(f"✓ Base data: {len(sub_brand_ids)} sub-brands, {len(channel_ids)} channels")
-    return sub_brand_ids, channel_ids
+    return sub_brand_ids, channel_ids, payment_type_ids
+
+
+def build_dimension_cache(payment_type_ids, channels, stores, products, items, option_groups):
+    """
+    Dimension tables as created by setup_base_data / generate_stores /
+    generate_products_and_items. They don't change during a run, so the
+    sales loaders read ids from here instead of querying the database.
+    """
+    return {
+        'payment_types': payment_type_ids,
+        'channels': channels,
+        'stores': stores,
+        'products': products,
+        'items': items,
+        'option_groups': option_groups,
+    }
 
 
 def generate_stores(conn, sub_brand_ids, num_stores=50):
@@ -291,12 +370,10 @@ def generate_customers(conn, num_customers=10000):
             datetime.now() - timedelta(days=random.randint(0, 720))
         ))
     
-    execute_batch(cursor, """
-        INSERT INTO customers (
-            customer_name, email, phone_number, cpf, birth_date, gender,
-            agree_terms, receive_promotions_email, registration_origin, created_at
-        ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-    """, batch, page_size=1000)
+    copy_rows(cursor, 'customers', [
+        'customer_name', 'email', 'phone_number', 'cpf', 'birth_date', 'gender',
+        'agree_terms', 'receive_promotions_email', 'registration_origin', 'created_at'
+    ], batch)
     
     cursor.execute("SELECT id FROM customers")
     customer_ids = [row[0] for row in cursor.fetchall()]
@@ -306,42 +383,135 @@ def generate_customers(conn, num_customers=10000):
     return customer_ids
 
 
-def generate_sales(conn, stores, channels, products, items, option_groups, customers, months=6):
-    """Generate sales with realistic patterns"""
-    print(f"Generating sales for {months} months...")
+def generate_sales(conn, dimensions, customers, months=6,
+                   loader='copy', workers=1, seed=None, db_url=None, engine='python'):
+    """
+    Generate sales with realistic patterns.
+    The period is cut into shards of SHARD_DAYS days; with workers > 1 each
+    shard is generated and loaded by a separate process with its own connection.
+    """
+    print(f"Generating sales for {months} months ({engine} engine, {loader} loader, {workers} worker(s))...")
     
-    cursor = conn.cursor()
-    start_date = datetime.now() - timedelta(days=30 * months)
+    start_date = (datetime.now() - timedelta(days=30 * months)).replace(
+        hour=0, minute=0, second=0, microsecond=0
+    )
     end_date = datetime.now()
+    create_partitions(conn, start_date, end_date)
     
     # Anomalies
     anomaly_week = start_date + timedelta(days=random.randint(30, 60))
     promo_day = start_date + timedelta(days=random.randint(90, 120))
     
-    current_date = start_date
+    # Everything a shard needs; plain data, so it can be sent to worker processes
+    context = {
+        **dimensions, 'customers': customers,
+        'anomaly_week': anomaly_week, 'promo_day': promo_day,
+        'loader': loader, 'engine': engine, 'seed': seed, 'fake_pools': warm_fake_pools(),
+    }
+    
+    total_days = (end_date - start_date).days + 1
+    shards = [
+        (index, start_date + timedelta(days=offset), min(SHARD_DAYS, total_days - offset))
+        for index, offset in enumerate(range(0, total_days, SHARD_DAYS))
+    ]
+    
     total_sales = 0
-    batch_size = 500
+    done = 0
+    round_trips_saved = collections.Counter()
+    if workers <= 1:
+        results = (generate_sales_shard(conn, shard, context) for shard in shards)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(workers, initializer=init_sales_worker, initargs=(db_url, context))
+        results = pool.imap_unordered(run_sales_shard, shards)
     
-    while current_date <= end_date:
-        weekday = current_date.weekday()
-        day_mult = WEEKDAY_MULT[weekday]
-        
-        # Anomaly: bad week
-        if anomaly_week <= current_date < anomaly_week + timedelta(days=7):
-            day_mult *= 0.7
-        
-        # Anomaly: promo day
-        if current_date.date() == promo_day.date():
-            day_mult *= 3.0
-        
-        daily_sales = int(random.gauss(2700, 400) * day_mult)
+    try:
+        for first_day, shard_sales, shard_saved in results:
+            total_sales += shard_sales
+            round_trips_saved.update(shard_saved)
+            done += 1
+            print(f"  → shard starting {first_day.strftime('%Y-%m-%d')}: {shard_sales:,} sales "
+                  f"[{done}/{len(shards)} shards, {total_sales:,} total]")
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    
+    print(f"✓ {total_sales:,} total sales generated")
+    if round_trips_saved:
+        detail = ', '.join(f"{table}: {n:,}" for table, n in sorted(round_trips_saved.items()))
+        print(f"✓ Dimension cache saved {sum(round_trips_saved.values()):,} round trips ({detail})")
+    return total_sales
+
+
+# Per-process state of a sales worker (connection + shared context)
+_worker = {}
+
+
+def init_sales_worker(db_url, context):
+    """Pool initializer: one connection per worker process, reused for all its shards"""
+    _fake_pools.update(context['fake_pools'])
+    _worker['conn'] = get_db_connection(db_url)
+    _worker['context'] = context
+
+
+def run_sales_shard(shard):
+    return generate_sales_shard(_worker['conn'], shard, _worker['context'])
+
+
+def generate_sales_shard(conn, shard, context):
+    """
+    Generate and load the sales of one shard: (index, first_day, num_days).
+    The random generator is reseeded from (seed, index), so a shard's rows
+    don't depend on which process runs it or in what order.
+    Returns (first_day, number of sales, round trips saved by the dimension cache).
+    """
+    index, first_day, num_days = shard
+    seed = context['seed']
+    random.seed(f"{seed}:{index}" if seed is not None else None)
+    saved_before = _round_trips_saved.copy()
+    
+    if context['engine'] == 'numpy':
+        first_day, shard_sales = generate_sales_shard_numpy(conn, shard, context)
+    else:
+        first_day, shard_sales = generate_sales_shard_python(conn, shard, context)
+    return first_day, shard_sales, _round_trips_saved - saved_before
+
+
+def generate_sales_shard_python(conn, shard, context):
+    """Python engine: one generate_single_sale call per sale, loaded in batches"""
+    index, first_day, num_days = shard
+    cursor = conn.cursor()
+    channels = context['channels']
+    products = context['products']
+    stores = context['stores']
+    customers = context['customers']
+    anomaly_week = context['anomaly_week']
+    promo_day = context['promo_day']
+    loader = context['loader']
+    batch_size = BATCH_SIZES[loader]
+    shard_sales = 0
+
+    # Weight tables are constant for the whole shard
+    hour_cum_weights = cumulative_weights([get_hour_weight(h) * 100 for h in range(24)])
+    channel_cum_weights = cumulative_weights([c['weight'] for c in channels])
+    product_cum_weights = cumulative_weights([p['popularity'] for p in products])
+
+    payment_type_ids = context['payment_types']
+    if loader == 'copy':
+        insert_batch = lambda batch: copy_sales_batch(cursor, batch, payment_type_ids)
+    else:
+        insert_batch = lambda batch: insert_sales_batch(cursor, batch, payment_type_ids)
+    
+    for day in range(num_days):
+        current_date = first_day + timedelta(days=day)
+        daily_sales = int(random.gauss(2700, 400) * day_multiplier(current_date, anomaly_week, promo_day))
         
         sales_batch = []
         
         for _ in range(daily_sales):
             # Hour distribution
-            hour_weights = [get_hour_weight(h) * 100 for h in range(24)]
-            hour = random.choices(range(24), weights=hour_weights)[0]
+            hour = random.choices(range(24), cum_weights=hour_cum_weights)[0]
             
             sale_time = current_date.replace(
                 hour=hour,
@@ -351,46 +521,58 @@ def generate_sales(conn, stores, channels, products, items, option_groups, custo
             
             # Select entities
             store_id = random.choice(stores)
-            channel = random.choices(channels, weights=[c['weight'] for c in channels])[0]
+            channel = random.choices(channels, cum_weights=channel_cum_weights)[0]
             customer_id = random.choice(customers) if random.random() > 0.3 else None
             
             # Generate sale
             sale_data = generate_single_sale(
                 sale_time, store_id, channel, customer_id, 
-                products, items, option_groups
+                products, context['items'], context['option_groups'], product_cum_weights
             )
             
             sales_batch.append(sale_data)
             
             if len(sales_batch) >= batch_size:
-                insert_sales_batch(cursor, sales_batch, items, option_groups)
-                total_sales += len(sales_batch)
+                insert_batch(sales_batch)
+                shard_sales += len(sales_batch)
                 sales_batch = []
                 conn.commit()
         
         # Insert remaining
         if sales_batch:
-            insert_sales_batch(cursor, sales_batch, items, option_groups)
-            total_sales += len(sales_batch)
+            insert_batch(sales_batch)
+            shard_sales += len(sales_batch)
             conn.commit()
-        
-        current_date += timedelta(days=1)
-        
-        if current_date.day == 1:
-            print(f"  → {current_date.strftime('%B %Y')}: {total_sales:,} sales")
     
-    print(f"✓ {total_sales:,} total sales generated")
-    return total_sales
+    return first_day, shard_sales
+
+
+def day_multiplier(current_date, anomaly_week, promo_day):
+    """Sales volume multiplier of a day: weekday pattern plus the anomalies"""
+    day_mult = WEEKDAY_MULT[current_date.weekday()]
+    
+    # Anomaly: bad week
+    if anomaly_week <= current_date < anomaly_week + timedelta(days=7):
+        day_mult *= 0.7
+    
+    # Anomaly: promo day
+    if current_date.date() == promo_day.date():
+        day_mult *= 3.0
+    
+    return day_mult
 
 
-def generate_single_sale(sale_time, store_id, channel, customer_id, products, items, option_groups):
+def generate_single_sale(sale_time, store_id, channel, customer_id, products, items, option_groups,
+                         product_cum_weights=None):
     """Generate a single sale with all related data"""
     
     # Select 1-5 products
     num_products = min(5, max(1, int(random.expovariate(0.5)) + 1))
+    if product_cum_weights is None:
+        product_cum_weights = cumulative_weights([p['popularity'] for p in products])
     selected_products = random.choices(
         products,
-        weights=[p['popularity'] for p in products],
+        cum_weights=product_cum_weights,
         k=num_products
     )
     
@@ -472,21 +654,21 @@ def generate_single_sale(sale_time, store_id, channel, customer_id, products, it
         long = -46.6 + random.uniform(-10, 10)  # -56.6 to -36.6
         
         delivery_data = {
-            'courier_name': fake.name(),
-            'courier_phone': fake.phone_number(),
+            'courier_name': fake_value('name'),
+            'courier_phone': fake_value('phone_number'),
             'courier_type': random.choice(COURIER_TYPES),
             'delivery_type': random.choice(DELIVERY_TYPES),
             'status': 'DELIVERED',
             'delivery_fee': delivery_fee,
             'courier_fee': round(delivery_fee * 0.6, 2),
             'address': {
-                'street': fake.street_name(),
+                'street': fake_value('street_name'),
                 'number': str(random.randint(10, 9999)),
                 'complement': random.choice(['Apto 101', 'Casa', 'Bloco A', 'Fundos', None, None]) if random.random() > 0.5 else None,
-                'neighborhood': fake.bairro(),
-                'city': fake.city(),
-                'state': fake.estado_sigla(),
-                'postal_code': fake.postcode(),
+                'neighborhood': fake_value('bairro'),
+                'city': fake_value('city'),
+                'state': fake_value('estado_sigla'),
+                'postal_code': fake_value('postcode'),
                 'latitude': lat,
                 'longitude': long
             }
@@ -509,7 +691,7 @@ def generate_single_sale(sale_time, store_id, channel, customer_id, products, it
     return {
         'store_id': store_id,
         'customer_id': customer_id,
-        'customer_name': fake.name() if not customer_id else None,
+        'customer_name': fake_value('name') if not customer_id else None,
         'channel_id': channel['id'],
         'created_at': sale_time,
         'status': status,
@@ -530,7 +712,7 @@ def generate_single_sale(sale_time, store_id, channel, customer_id, products, it
     }
 
 
-def insert_sales_batch(cursor, sales_batch, items, option_groups):
+def insert_sales_batch(cursor, sales_batch, payment_type_ids):
     """Insert batch of sales with all related data"""
     
     # Insert sales
@@ -548,7 +730,9 @@ def insert_sales_batch(cursor, sales_batch, items, option_groups):
         s['discount_reason'], s['people_qty'], 'POS'
     ) for s in sales_batch]
     
-    execute_batch(cursor, """
+    # One multi-row INSERT per batch: the ids come back in the same round trip,
+    # in VALUES order, so this stays correct with several loaders running at once
+    sale_ids = [row[0] for row in execute_values(cursor, """
         INSERT INTO sales (
             store_id, customer_id, channel_id, customer_name,
             created_at, sale_status_desc,
@@ -556,27 +740,21 @@ def insert_sales_batch(cursor, sales_batch, items, option_groups):
             delivery_fee, service_tax_fee, total_amount, value_paid,
             production_seconds, delivery_seconds,
             discount_reason, people_quantity, origin
-        ) VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)
-    """, sales_data, page_size=500)
-    
-    # Get inserted sale IDs
-    cursor.execute("""
-        SELECT id FROM sales 
-        ORDER BY id DESC 
-        LIMIT %s
-    """, (len(sales_batch),))
-    sale_ids = [row[0] for row in cursor.fetchall()]
-    sale_ids.reverse()
+        ) VALUES %s
+        RETURNING id
+    """, sales_data, page_size=len(sales_data), fetch=True)]
+    if len(sale_ids) != len(sales_batch):
+        raise RuntimeError(f"Expected {len(sales_batch)} sale ids, got {len(sale_ids)}")
     
     # Insert product_sales and related data
     for sale_id, sale in zip(sale_ids, sales_batch):
         for prod_data in sale['products']:
             cursor.execute("""
                 INSERT INTO product_sales (
-                    sale_id, product_id, quantity, base_price, total_price
-                ) VALUES (%s,%s,%s,%s,%s) RETURNING id
+                    sale_id, sale_created_at, product_id, quantity, base_price, total_price
+                ) VALUES (%s,%s,%s,%s,%s,%s) RETURNING id
             """, (
-                sale_id, prod_data['product_id'],
+                sale_id, sale['created_at'], prod_data['product_id'],
                 prod_data['quantity'], prod_data['base_price'],
                 prod_data['total_price']
             ))
@@ -586,11 +764,11 @@ def insert_sales_batch(cursor, sales_batch, items, option_groups):
             for item_data in prod_data['items']:
                 cursor.execute("""
                     INSERT INTO item_product_sales (
-                        product_sale_id, item_id, option_group_id,
+                        product_sale_id, sale_created_at, item_id, option_group_id,
                         quantity, additional_price, price, amount
-                    ) VALUES (%s,%s,%s,%s,%s,%s,%s)
+                    ) VALUES (%s,%s,%s,%s,%s,%s,%s,%s)
                 """, (
-                    product_sale_id, item_data['item_id'],
+                    product_sale_id, sale['created_at'], item_data['item_id'],
                     item_data['option_group_id'],
                     item_data['quantity'], item_data['additional_price'],
                     item_data['price'], 1
@@ -601,11 +779,11 @@ def insert_sales_batch(cursor, sales_batch, items, option_groups):
             d = sale['delivery']
             cursor.execute("""
                 INSERT INTO delivery_sales (
-                    sale_id, courier_name, courier_phone, courier_type,
+                    sale_id, sale_created_at, courier_name, courier_phone, courier_type,
                     delivery_type, status, delivery_fee, courier_fee
-                ) VALUES (%s,%s,%s,%s,%s,%s,%s,%s) RETURNING id
+                ) VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s) RETURNING id
             """, (
-                sale_id, d['courier_name'], d['courier_phone'],
+                sale_id, sale['created_at'], d['courier_name'], d['courier_phone'],
                 d['courier_type'], d['delivery_type'], d['status'],
                 d['delivery_fee'], d['courier_fee']
             ))
@@ -618,27 +796,474 @@ def insert_sales_batch(cursor, sales_batch, items, option_groups):
             
             cursor.execute("""
                 INSERT INTO delivery_addresses (
-                    sale_id, delivery_sale_id, street, number, complement,
+                    sale_id, sale_created_at, delivery_sale_id, street, number, complement,
                     neighborhood, city, state, postal_code, latitude, longitude
-                ) VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)
+                ) VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)
             """, (
-                sale_id, delivery_sale_id, addr['street'], addr['number'],
+                sale_id, sale['created_at'], delivery_sale_id, addr['street'], addr['number'],
                 addr['complement'], addr['neighborhood'], addr['city'],
                 addr['state'], addr['postal_code'], lat, long
             ))
         
-        # Insert payments
+        # Insert payments (payment type id from the dimension cache)
         for payment in sale['payments']:
-            cursor.execute(
-                "SELECT id FROM payment_types WHERE description = %s LIMIT 1",
-                (payment['type'],)
-            )
-            result = cursor.fetchone()
-            if result:
+            payment_type_id = payment_type_ids.get(payment['type'])
+            if payment_type_id:
+                _round_trips_saved['payment_types'] += 1
                 cursor.execute("""
-                    INSERT INTO payments (sale_id, payment_type_id, value)
-                    VALUES (%s,%s,%s)
-                """, (sale_id, result[0], Decimal(str(payment['value']))))
+                    INSERT INTO payments (sale_id, sale_created_at, payment_type_id, value)
+                    VALUES (%s,%s,%s,%s)
+                """, (sale_id, sale['created_at'], payment_type_id, Decimal(str(payment['value']))))
+
+
+def reserve_ids(cursor, counts):
+    """
+    Draw ids from several tables' sequences in one round trip.
+    counts: {table: how many ids}. Returns {table: list of ids}.
+    Every id comes from its own nextval, so the batch can't collide with
+    other writers on the same sequences (the insert loader, the API, other
+    workers); when they interleave, the ids are not consecutive.
+    """
+    tables = [t for t, n in counts.items() if n > 0]
+    columns = ", ".join(
+        "(SELECT array_agg(nextval(q.seq)) FROM generate_series(1, %s), "
+        "(SELECT pg_get_serial_sequence(%s, 'id')::regclass AS seq) q)"
+        for _ in tables
+    )
+    drawn = {}
+    if tables:
+        cursor.execute(f"SELECT {columns}", [v for t in tables for v in (counts[t], t)])
+        drawn = dict(zip(tables, cursor.fetchone()))
+    return {t: drawn.get(t, []) for t in counts}
+
+
+def copy_rows(cursor, table, columns, rows):
+    """Stream rows into a table with COPY FROM STDIN (CSV, \\N for NULL)"""
+    if not rows:
+        return
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerows([r'\N' if v is None else v for v in row] for row in rows)
+    buf.seek(0)
+    cursor.copy_expert(
+        f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv, NULL '\\N')",
+        buf
+    )
+
+
+def copy_sales_batch(cursor, sales_batch, payment_type_ids):
+    """
+    Bulk-load a batch of sales with all related data through COPY.
+    Parent ids are reserved up front, so children can reference them
+    without a RETURNING round trip per row.
+    """
+    ids = reserve_ids(cursor, {
+        'sales': len(sales_batch),
+        'product_sales': sum(len(s['products']) for s in sales_batch),
+        'delivery_sales': sum(1 for s in sales_batch if s['delivery']),
+    })
+    product_sale_ids = iter(ids['product_sales'])
+    delivery_sale_ids = iter(ids['delivery_sales'])
+
+    sales_rows, product_rows, item_rows = [], [], []
+    delivery_rows, address_rows, payment_rows = [], [], []
+
+    for sale_id, s in zip(ids['sales'], sales_batch):
+        # Children carry the sale's created_at: it is their partition key
+        sale_key = (sale_id, s['created_at'])
+        sales_rows.append((
+            sale_id, s['store_id'], s['customer_id'], s['channel_id'],
+            s['customer_name'], s['created_at'], s['status'],
+            round(s['total_items_value'], 2), s['discount'], s['increase'],
+            s['delivery_fee'], s['service_tax'], round(s['total_amount'], 2),
+            round(s['value_paid'], 2), s['production_sec'], s['delivery_sec'],
+            s['discount_reason'], s['people_qty'], 'POS'
+        ))
+
+        for prod_data in s['products']:
+            product_sale_id = next(product_sale_ids)
+            product_rows.append((
+                product_sale_id, *sale_key, prod_data['product_id'],
+                prod_data['quantity'], prod_data['base_price'], prod_data['total_price']
+            ))
+            for item_data in prod_data['items']:
+                item_rows.append((
+                    product_sale_id, s['created_at'], item_data['item_id'], item_data['option_group_id'],
+                    item_data['quantity'], item_data['additional_price'], item_data['price'], 1
+                ))
+
+        if s['delivery']:
+            d = s['delivery']
+            delivery_sale_id = next(delivery_sale_ids)
+            delivery_rows.append((
+                delivery_sale_id, *sale_key, d['courier_name'], d['courier_phone'],
+                d['courier_type'], d['delivery_type'], d['status'],
+                d['delivery_fee'], d['courier_fee']
+            ))
+            addr = d['address']
+            # Ensure coordinates are within valid range for Brazil
+            lat = max(-33.0, min(-5.0, addr['latitude']))
+            long = max(-74.0, min(-34.0, addr['longitude']))
+            address_rows.append((
+                *sale_key, delivery_sale_id, addr['street'], addr['number'],
+                addr['complement'], addr['neighborhood'], addr['city'],
+                addr['state'], addr['postal_code'], lat, long
+            ))
+
+        for payment in s['payments']:
+            payment_type_id = payment_type_ids.get(payment['type'])
+            if payment_type_id:
+                _round_trips_saved['payment_types'] += 1
+                payment_rows.append((*sale_key, payment_type_id, round(payment['value'], 2)))
+
+    # Parents before children (foreign keys are checked per row)
+    copy_rows(cursor, 'sales', [
+        'id', 'store_id', 'customer_id', 'channel_id', 'customer_name',
+        'created_at', 'sale_status_desc',
+        'total_amount_items', 'total_discount', 'total_increase',
+        'delivery_fee', 'service_tax_fee', 'total_amount', 'value_paid',
+        'production_seconds', 'delivery_seconds',
+        'discount_reason', 'people_quantity', 'origin'
+    ], sales_rows)
+    copy_rows(cursor, 'product_sales', [
+        'id', 'sale_id', 'sale_created_at', 'product_id', 'quantity', 'base_price', 'total_price'
+    ], product_rows)
+    copy_rows(cursor, 'item_product_sales', [
+        'product_sale_id', 'sale_created_at', 'item_id', 'option_group_id',
+        'quantity', 'additional_price', 'price', 'amount'
+    ], item_rows)
+    copy_rows(cursor, 'delivery_sales', [
+        'id', 'sale_id', 'sale_created_at', 'courier_name', 'courier_phone', 'courier_type',
+        'delivery_type', 'status', 'delivery_fee', 'courier_fee'
+    ], delivery_rows)
+    copy_rows(cursor, 'delivery_addresses', [
+        'sale_id', 'sale_created_at', 'delivery_sale_id', 'street', 'number', 'complement',
+        'neighborhood', 'city', 'state', 'postal_code', 'latitude', 'longitude'
+    ], address_rows)
+    copy_rows(cursor, 'payments', ['sale_id', 'sale_created_at', 'payment_type_id', 'value'], payment_rows)
+
+
+def generate_sales_shard_numpy(conn, shard, context):
+    """
+    NumPy engine: draws each day of the shard as columnar arrays and COPYs
+    them straight in, with no per-sale dicts.
+    Same distributions as generate_single_sale, not the same random stream.
+    """
+    index, first_day, num_days = shard
+    seed = context['seed']
+    rng = np.random.default_rng([seed, index] if seed is not None else None)
+    
+    cursor = conn.cursor()
+    tables = numpy_tables(context)
+    shard_sales = 0
+    
+    for day in range(num_days):
+        current_date = first_day + timedelta(days=day)
+        day_mult = day_multiplier(current_date, context['anomaly_week'], context['promo_day'])
+        daily_sales = max(0, int(rng.normal(2700, 400) * day_mult))
+        
+        copy_numpy_day(cursor, generate_day_arrays(rng, current_date, daily_sales, tables))
+        shard_sales += daily_sales
+        conn.commit()
+    
+    return first_day, shard_sales
+
+
+def numpy_tables(context):
+    """Lookup arrays the NumPy engine samples from (built once per shard)"""
+    products = context['products']
+    items = context['items']
+    channels = context['channels']
+    hour_weights = np.array([get_hour_weight(h) for h in range(24)])
+    popularity = np.array([p['popularity'] for p in products])
+    channel_weights = np.array([c['weight'] for c in channels])
+    return {
+        'hour_p': hour_weights / hour_weights.sum(),
+        'stores': np.array(context['stores']),
+        'customers': np.array(context['customers']),
+        'channel_ids': np.array([c['id'] for c in channels]),
+        'channel_delivery': np.array([c['type'] == 'D' for c in channels]),
+        'channel_presencial': np.array([c['type'] == 'P' for c in channels]),
+        'channel_p': channel_weights / channel_weights.sum(),
+        'product_ids': np.array([p['id'] for p in products]),
+        'product_prices': np.array([p['base_price'] for p in products]),
+        'product_custom': np.array([p['has_customization'] for p in products]),
+        'product_p': popularity / popularity.sum(),
+        'item_ids': np.array([i['id'] for i in items]),
+        'item_prices': np.array([i['price'] for i in items]),
+        'option_groups': np.array(context['option_groups']),
+        'payment_type_ids': np.array([context['payment_types'].get(t, 0) for t in PAYMENT_TYPES_LIST]),
+        'pools': {p: np.array([copy_escape(x) for x in v], dtype=object)
+                  for p, v in context['fake_pools'].items()},
+    }
+
+
+def copy_escape(value):
+    """Escape a string for COPY text format"""
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+def _or_null(values, mask):
+    """Column for COPY: values where mask holds, \\N (NULL) elsewhere"""
+    return np.where(mask, np.asarray(values).astype(object), r'\N')
+
+
+def generate_day_arrays(rng, current_date, n, tables):
+    """
+    Draw the n sales of one day as columns.
+    Returns {table: (columns, [column arrays])}, plus row counts used for id reservation.
+    """
+    pools = tables['pools']
+    day_start = np.datetime64(current_date.replace(hour=0, minute=0, second=0, microsecond=0), 's')
+    
+    # Sale level: time, store, channel, customer
+    hour = rng.choice(24, n, p=tables['hour_p'])
+    created_at = day_start + (hour * 3600 + rng.integers(0, 60, n) * 60 + rng.integers(0, 60, n))
+    store_id = rng.choice(tables['stores'], n)
+    channel = rng.choice(len(tables['channel_ids']), n, p=tables['channel_p'])
+    is_delivery = tables['channel_delivery'][channel]
+    has_customer = rng.random(n) > 0.3
+    customer_id = rng.choice(tables['customers'], n)
+    
+    # Product lines: 1-5 per sale (same truncated exponential as generate_single_sale)
+    num_products = np.clip(rng.exponential(2.0, n).astype(int) + 1, 1, 5)
+    line_sale = np.repeat(np.arange(n), num_products)
+    lines = len(line_sale)
+    product = rng.choice(len(tables['product_ids']), lines, p=tables['product_p'])
+    qty = rng.integers(1, 4, lines)
+    base_price = tables['product_prices'][product]
+    
+    # Items: 60% of customizable products get 1-4
+    customized = tables['product_custom'][product] & (rng.random(lines) > 0.4)
+    num_items = np.where(customized, rng.integers(1, 5, lines), 0)
+    item_line = np.repeat(np.arange(lines), num_items)
+    item = rng.integers(0, len(tables['item_ids']), len(item_line))
+    item_price = tables['item_prices'][item]
+    has_option_group = rng.random(len(item_line)) > 0.5
+    option_group = rng.choice(tables['option_groups'], len(item_line))
+    
+    additions = np.bincount(item_line, weights=item_price, minlength=lines)
+    product_total = (base_price + additions) * qty
+    total_items_value = np.bincount(line_sale, weights=product_total, minlength=n)
+    
+    # Discounts, increases, fees
+    has_discount = rng.random(n) < 0.2
+    discount = np.where(has_discount, np.round(total_items_value * rng.uniform(0.05, 0.30, n), 2), 0)
+    discount_reason = rng.choice(DISCOUNT_REASONS, n)
+    increase = np.where(rng.random(n) < 0.05, np.round(total_items_value * rng.uniform(0.02, 0.10, n), 2), 0)
+    delivery_fee = np.where(is_delivery, rng.choice([5.0, 7.0, 9.0, 12.0, 15.0], n), 0)
+    service_tax = np.where(rng.random(n) < 0.3, np.round(total_items_value * 0.10, 2), 0)
+    
+    # Status and totals
+    completed = rng.random(n) < STATUS_WEIGHTS[0]
+    status = np.where(completed, 'COMPLETED', 'CANCELLED')
+    total_amount = np.round(total_items_value - discount + increase + delivery_fee + service_tax, 2)
+    value_paid = np.where(completed, total_amount, 0)
+    delivered = is_delivery & completed
+    
+    created_at = np.datetime_as_string(created_at)
+    sales = ([
+        'store_id', 'customer_id', 'channel_id', 'customer_name',
+        'created_at', 'sale_status_desc',
+        'total_amount_items', 'total_discount', 'total_increase',
+        'delivery_fee', 'service_tax_fee', 'total_amount', 'value_paid',
+        'production_seconds', 'delivery_seconds',
+        'discount_reason', 'people_quantity', 'origin'
+    ], [
+        store_id, _or_null(customer_id, has_customer), tables['channel_ids'][channel],
+        _or_null(rng.choice(pools['name'], n), ~has_customer),
+        created_at, status,
+        np.round(total_items_value, 2), discount, increase,
+        delivery_fee, service_tax, total_amount, value_paid,
+        _or_null(rng.integers(300, 2401, n), completed),
+        _or_null(rng.integers(600, 3601, n), delivered),
+        _or_null(discount_reason, has_discount),
+        _or_null(rng.integers(1, 9, n), tables['channel_presencial'][channel]),
+        np.full(n, 'POS')
+    ])
+    product_sales = (['product_id', 'quantity', 'base_price', 'total_price'], [
+        tables['product_ids'][product], qty, base_price, np.round(product_total, 2)
+    ])
+    item_product_sales = ([
+        'item_id', 'option_group_id', 'quantity', 'additional_price', 'price', 'amount'
+    ], [
+        tables['item_ids'][item], _or_null(option_group, has_option_group),
+        np.ones(len(item_line), dtype=int), item_price, item_price, np.ones(len(item_line), dtype=int)
+    ])
+    
+    # Deliveries (completed delivery-channel sales)
+    d = int(delivered.sum())
+    fee = delivery_fee[delivered]
+    # Same odds as generate_single_sale: half get a draw among 4 complements and 2 blanks
+    complement = rng.integers(0, 6, d)
+    delivery_sales = ([
+        'courier_name', 'courier_phone', 'courier_type',
+        'delivery_type', 'status', 'delivery_fee', 'courier_fee'
+    ], [
+        rng.choice(pools['name'], d), rng.choice(pools['phone_number'], d),
+        rng.choice(COURIER_TYPES, d), rng.choice(DELIVERY_TYPES, d),
+        np.full(d, 'DELIVERED'), fee, np.round(fee * 0.6, 2)
+    ])
+    delivery_addresses = ([
+        'street', 'number', 'complement', 'neighborhood', 'city',
+        'state', 'postal_code', 'latitude', 'longitude'
+    ], [
+        rng.choice(pools['street_name'], d), rng.integers(10, 10000, d),
+        _or_null(np.array(['Apto 101', 'Casa', 'Bloco A', 'Fundos'])[np.minimum(complement, 3)],
+                 (rng.random(d) > 0.5) & (complement < 4)),
+        rng.choice(pools['bairro'], d), rng.choice(pools['city'], d),
+        rng.choice(pools['estado_sigla'], d), rng.choice(pools['postcode'], d),
+        # Ensure coordinates are within valid range for Brazil
+        np.clip(-23.5 + rng.uniform(-10, 5, d), -33.0, -5.0),
+        np.clip(-46.6 + rng.uniform(-10, 10, d), -74.0, -34.0)
+    ])
+    
+    # Payments (completed sales): 85% single, 15% split in two
+    paid = np.flatnonzero(completed)
+    split = rng.random(len(paid)) < 0.15
+    first_value = np.where(split, np.round(value_paid[paid] * rng.uniform(0.3, 0.7, len(paid)), 2),
+                           value_paid[paid])
+    first_type = np.where(split, rng.integers(0, 3, len(paid)),
+                          rng.integers(0, len(PAYMENT_TYPES_LIST), len(paid)))
+    second = paid[split]
+    payment_sale = np.concatenate([paid, second])
+    payment_type = tables['payment_type_ids'][np.concatenate([
+        first_type, rng.integers(0, len(PAYMENT_TYPES_LIST), len(second))
+    ])]
+    payment_value = np.concatenate([first_value, np.round(value_paid[second] - first_value[split], 2)])
+    known_type = payment_type > 0
+    
+    return {
+        'sales': sales,
+        'product_sales': product_sales,
+        'item_product_sales': item_product_sales,
+        'delivery_sales': delivery_sales,
+        'delivery_addresses': delivery_addresses,
+        'payments': (['payment_type_id', 'value'], [payment_type[known_type], payment_value[known_type]]),
+        # Parent links, resolved to ids (and partition keys) in copy_numpy_day
+        'created_at': created_at,
+        'line_sale': line_sale,
+        'item_line': item_line,
+        'delivered': np.flatnonzero(delivered),
+        'payment_sale': payment_sale[known_type],
+    }
+
+
+def copy_numpy_day(cursor, day):
+    """Reserve ids for a day drawn by generate_day_arrays and COPY every table"""
+    sales_columns, sales_values = day['sales']
+    n = len(sales_values[0])
+    if n == 0:
+        return
+    ids = reserve_ids(cursor, {
+        'sales': n,
+        'product_sales': len(day['line_sale']),
+        'delivery_sales': len(day['delivered']),
+    })
+    sale_ids, product_sale_ids, delivery_sale_ids = (
+        np.array(ids[t], dtype=np.int64) for t in ('sales', 'product_sales', 'delivery_sales')
+    )
+    delivered_sale_ids = sale_ids[day['delivered']]
+    # Partition key of the children: the created_at of their sale
+    created_at = day['created_at']
+    line_created_at = created_at[day['line_sale']]
+    delivered_created_at = created_at[day['delivered']]
+    # Payment type ids came from the dimension cache (unknown types were dropped)
+    _round_trips_saved['payment_types'] += len(day['payments'][1][0])
+    
+    links = {
+        'sales': [('id', sale_ids)],
+        'product_sales': [('id', product_sale_ids), ('sale_id', sale_ids[day['line_sale']]),
+                          ('sale_created_at', line_created_at)],
+        'item_product_sales': [('product_sale_id', product_sale_ids[day['item_line']]),
+                               ('sale_created_at', line_created_at[day['item_line']])],
+        'delivery_sales': [('id', delivery_sale_ids), ('sale_id', delivered_sale_ids),
+                           ('sale_created_at', delivered_created_at)],
+        'delivery_addresses': [('sale_id', delivered_sale_ids), ('sale_created_at', delivered_created_at),
+                               ('delivery_sale_id', delivery_sale_ids)],
+        'payments': [('sale_id', sale_ids[day['payment_sale']]),
+                     ('sale_created_at', created_at[day['payment_sale']])],
+    }
+    # Parents before children, like copy_sales_batch
+    for table in SALES_TABLES:
+        columns, values = day[table]
+        link_columns = [c for c, _ in links[table]]
+        link_values = [v for _, v in links[table]]
+        copy_columns(cursor, table, link_columns + columns, link_values + values)
+
+
+def copy_columns(cursor, table, columns, values):
+    """
+    COPY (text format) from column arrays. Formatting column by column with
+    str() is several times faster than csv.writer on rows of floats; strings
+    must already be COPY-escaped (see numpy_tables).
+    """
+    if len(values[0]) == 0:
+        return
+    text = [list(map(str, np.asarray(v).tolist())) for v in values]
+    buf = io.StringIO('\n'.join(map('\t'.join, zip(*text))) + '\n')
+    cursor.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN", buf)
+
+
+def suspend_foreign_keys(conn):
+    """
+    Drop the foreign keys of the sales tables for a bulk load (--fresh-database).
+    Per-row FK checks cost more than the COPY itself; they are put back
+    (and validated in one pass per constraint) by restore_foreign_keys.
+    Only for a new database nobody else writes to: until then other writers
+    run unchecked, and a killed run leaves the constraints dropped.
+    On partitioned tables only the parent constraints are listed: the ones
+    Postgres clones per partition go away (and come back) with them.
+    """
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT conrelid::regclass::text, conname, pg_get_constraintdef(k.oid), r.relkind = 'p'
+        FROM pg_constraint k
+        JOIN pg_class r ON r.oid = k.conrelid
+        WHERE contype = 'f' AND conrelid = ANY(%s::regclass[]) AND conparentid = 0
+        ORDER BY conrelid::regclass::text, conname
+    """, (SALES_TABLES,))
+    foreign_keys = cursor.fetchall()
+    for table, name, _, _ in foreign_keys:
+        cursor.execute(f'ALTER TABLE {table} DROP CONSTRAINT "{name}"')
+    conn.commit()
+    return foreign_keys
+
+
+def restore_foreign_keys(conn, foreign_keys):
+    """Re-create the foreign keys dropped by suspend_foreign_keys and validate them"""
+    if not foreign_keys:
+        return
+    print("Restoring foreign keys...")
+    cursor = conn.cursor()
+    # Partitioned tables don't take NOT VALID foreign keys: those are validated as they are added
+    for table, name, definition, partitioned in foreign_keys:
+        not_valid = '' if partitioned else ' NOT VALID'
+        cursor.execute(f'ALTER TABLE {table} ADD CONSTRAINT "{name}" {definition}{not_valid}')
+    conn.commit()
+    for table, name, _, partitioned in foreign_keys:
+        if not partitioned:
+            cursor.execute(f'ALTER TABLE {table} VALIDATE CONSTRAINT "{name}"')
+    conn.commit()
+    print(f"✓ {len(foreign_keys)} foreign keys restored")
+
+
+def create_partitions(conn, first_day, last_day):
+    """
+    Create the monthly partitions of the sales tables for the period being
+    loaded, plus next month for the sales that keep coming in
+    (create_sales_partitions in database-schema.sql). No-op on a schema
+    without partitioning.
+    """
+    cursor = conn.cursor()
+    cursor.execute("SELECT to_regproc('create_sales_partitions') IS NOT NULL")
+    if not cursor.fetchone()[0]:
+        return
+    cursor.execute("SELECT create_sales_partitions(%s, %s)",
+                   (first_day.date(), (last_day + timedelta(days=31)).date()))
+    created = cursor.fetchone()[0]
+    conn.commit()
+    print(f"✓ Monthly partitions ready ({created} created)")
 
 
 def create_indexes(conn):
@@ -648,7 +1273,7 @@ def create_indexes(conn):
     
     # Additional indexes
     indexes = [
-        "CREATE INDEX IF NOT EXISTS idx_sales_date_status ON sales(DATE(created_at), sale_status_desc)",
+        "CREATE INDEX IF NOT EXISTS idx_sales_data_loja_canal_status ON sales(sale_date, store_id, channel_id, sale_status_desc) INCLUDE (value_paid, customer_id)",
         "CREATE INDEX IF NOT EXISTS idx_product_sales_product_sale ON product_sales(product_id, sale_id)",
     ]
     
@@ -661,6 +1286,12 @@ def create_indexes(conn):
     
     conn.commit()
     print("✓ Indexes created")
+    
+    # Autovacuum analyzes the partitions but never a partitioned parent, and
+    # join estimates across partitions come from the parent's statistics
+    cursor.execute(f"ANALYZE {', '.join(SALES_TABLES)}")
+    conn.commit()
+    print("✓ Statistics updated")
 
 
 def main():
@@ -672,8 +1303,29 @@ def main():
     parser.add_argument('--items', type=int, default=200, help='Number of items/complements')
     parser.add_argument('--customers', type=int, default=10000, help='Number of customers')
     parser.add_argument('--months', type=int, default=6, help='Months of sales data')
+    parser.add_argument('--loader', choices=['copy', 'insert'], default='copy',
+                       help='How sales are loaded: COPY FROM STDIN (fast) or row-by-row INSERTs')
+    parser.add_argument('--workers', type=int, default=1,
+                       help='Processes generating sales in parallel (one connection and '
+                            f'{SHARD_DAYS}-day shard at a time each)')
+    parser.add_argument('--engine', choices=['python', 'numpy'], default=None,
+                       help='Sales generator: one sale at a time (python) or a whole day '
+                            'as NumPy arrays (numpy, needs --loader copy). Default: numpy when '
+                            'it is installed and the loader is copy, python otherwise')
+    parser.add_argument('--seed', type=int, default=None,
+                       help='Random seed: the same seed gives the same data for any --workers')
+    parser.add_argument('--fresh-database', action='store_true',
+                       help='The database is new and nothing else writes to it: drop the sales '
+                            'foreign keys during the load and validate them at the end (copy loader only)')
     
     args = parser.parse_args()
+    if args.engine is None:
+        args.engine = 'numpy' if np is not None and args.loader == 'copy' else 'python'
+    if args.engine == 'numpy':
+        if np is None:
+            parser.error("--engine numpy requires numpy (pip install numpy)")
+        if args.loader != 'copy':
+            parser.error("--engine numpy only works with --loader copy")
     
     print("=" * 70)
     print("God Level Coder Challenge - Data Generator")
@@ -681,21 +1333,33 @@ def main():
     print(f"Generating {args.months} months of restaurant operational data...")
     print()
     
+    if args.seed is not None:
+        random.seed(args.seed)
+        Faker.seed(args.seed)
+    
     conn = get_db_connection(args.db_url)
     
     try:
-        sub_brand_ids, channels = setup_base_data(conn)
+        sub_brand_ids, channels, payment_type_ids = setup_base_data(conn)
         stores = generate_stores(conn, sub_brand_ids, args.stores)
         products, items, option_groups = generate_products_and_items(
             conn, sub_brand_ids, args.products, args.items
         )
         customers = generate_customers(conn, args.customers)
-        
-        total_sales = generate_sales(
-            conn, stores, channels, products, items, 
-            option_groups, customers, args.months
+        dimensions = build_dimension_cache(
+            payment_type_ids, channels, stores, products, items, option_groups
         )
         
+        foreign_keys = suspend_foreign_keys(conn) if args.fresh_database and args.loader == 'copy' else []
+        try:
+            total_sales = generate_sales(
+                conn, dimensions, customers, args.months, args.loader,
+                workers=args.workers, seed=args.seed, db_url=args.db_url, engine=args.engine
+            )
+        finally:
+            conn.rollback()
+            restore_foreign_keys(conn, foreign_keys)
+        
         create_indexes(conn)
         
         # Final stats
@@ -0,0 +1,367 @@
+# Arquivo: instrumentacao.py
+"""
+Instrumentação das requisições: tempos, linhas, queries lentas e /metrics.
+
+Cada requisição tem uma Medicao que acumula:
+
+* espera do pool (retirada da conexão em conexao_db.get_connection);
+* execução do SQL (cursor.execute) e fetch (fetchone/fetchmany/fetchall);
+* linhas devolvidas pelo banco;
+* pós-processamento em Python: o resto do tempo da requisição.
+
+No main.py (psycopg2) a medição é automática: as conexões do pool usam o
+CursorInstrumentado e a Medicao da requisição fica num ContextVar. No api.py
+(asyncpg) a Medicao é passada explicitamente; ali o execute já traz todas as
+linhas, então não há tempo de fetch separado (exceto no modo streaming).
+
+Ao fim da requisição os tempos viram histogramas por endpoint e, no
+/api/v1/query, por forma da pergunta (query_builder.forma_da_requisicao).
+Query acima de LIMIAR_QUERY_LENTA_MS tem o EXPLAIN (ANALYZE, BUFFERS)
+capturado numa thread à parte e guardado num anel com as últimas
+TAMANHO_ANEL capturas. O texto no formato do Prometheus sai de
+metricas.texto() (endpoint /metrics).
+"""
+import collections
+import contextvars
+import queue
+import sys
+import threading
+import time
+from datetime import datetime
+
+import psycopg2
+import psycopg2.extensions
+
+LIMIAR_QUERY_LENTA_MS = 500           # None desliga a captura de planos
+TAMANHO_ANEL = 50                     # planos capturados guardados (os mais antigos saem)
+FILA_PLANOS_MAX = 10                  # capturas esperando o EXPLAIN; acima disso são descartadas
+INTERVALO_MESMA_QUERY_SEGUNDOS = 300  # a mesma forma/SQL não é capturada de novo antes disso
+MAX_CAPTURAS_LEMBRADAS = 1000         # formas/SQL lembradas dentro do intervalo; acima disso sai a mais antiga
+EXPLAIN_TIMEOUT_MS = 60000
+MAX_FORMAS = 200                      # rótulos de forma distintos; as demais viram 'outras'
+
+TIPO_CONTEUDO_METRICAS = 'text/plain; version=0.0.4; charset=utf-8'
+PREFIXO = 'maria_bi_'
+
+BUCKETS_SEGUNDOS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+BUCKETS_LINHAS = (1, 10, 100, 1000, 10000, 100000, 1000000)
+
+# nome: (tipo, ajuda, buckets)
+DEFINICOES = {
+    'requisicao_segundos': ('histogram', 'Tempo total da requisição', BUCKETS_SEGUNDOS),
+    'sql_execucao_segundos': ('histogram', 'Tempo de execução do SQL (cursor.execute)', BUCKETS_SEGUNDOS),
+    'sql_fetch_segundos': ('histogram', 'Tempo de leitura das linhas (fetch)', BUCKETS_SEGUNDOS),
+    'pos_processamento_segundos': ('histogram', 'Tempo em Python fora do banco e da espera do pool',
+                                   BUCKETS_SEGUNDOS),
+    'pool_espera_segundos': ('histogram', 'Espera por uma conexão livre do pool', BUCKETS_SEGUNDOS),
+    'linhas_retornadas': ('histogram', 'Linhas devolvidas pelo banco por requisição', BUCKETS_LINHAS),
+    'queries_lentas_total': ('counter', 'Queries acima do limiar de query lenta', None),
+    'planos_capturados_total': ('counter', 'EXPLAIN das queries lentas, por resultado', None),
+}
+
+
+# --- 1. Registro de métricas ---
+
+def _escapar(valor):
+    return str(valor).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _rotulos(pares, extra=()):
+    pares = tuple(pares) + tuple(extra)
+    return '{' + ','.join(f'{nome}="{_escapar(valor)}"' for nome, valor in pares) + '}' if pares else ''
+
+
+def _numero(valor):
+    return repr(float(valor)) if not float(valor).is_integer() else str(int(valor))
+
+
+class RegistroMetricas:
+    """Histogramas e contadores por conjunto de rótulos. Thread-safe."""
+
+    def __init__(self, definicoes=None):
+        self.definicoes = DEFINICOES if definicoes is None else definicoes
+        self._lock = threading.Lock()
+        # nome -> {rótulos (tupla ordenada) -> [contagens por bucket..., soma, total] ou valor}
+        self._series = {nome: {} for nome in self.definicoes}
+
+    def observar(self, nome, valor, **rotulos):
+        buckets = self.definicoes[nome][2]
+        chave = tuple(sorted(rotulos.items()))
+        with self._lock:
+            serie = self._series[nome].get(chave)
+            if serie is None:
+                serie = self._series[nome][chave] = [0] * (len(buckets) + 2)
+            for i, limite in enumerate(buckets):
+                if valor <= limite:
+                    serie[i] += 1
+                    break
+            serie[-2] += valor
+            serie[-1] += 1
+
+    def contar(self, nome, quantidade=1, **rotulos):
+        chave = tuple(sorted(rotulos.items()))
+        with self._lock:
+            self._series[nome][chave] = self._series[nome].get(chave, 0) + quantidade
+
+    def texto(self):
+        """Todas as séries no formato de texto do Prometheus."""
+        linhas = []
+        with self._lock:
+            for nome, (tipo, ajuda, buckets) in self.definicoes.items():
+                metrica = PREFIXO + nome
+                linhas.append(f"# HELP {metrica} {ajuda}")
+                linhas.append(f"# TYPE {metrica} {tipo}")
+                for chave, serie in sorted(self._series[nome].items()):
+                    if tipo == 'counter':
+                        linhas.append(f"{metrica}{_rotulos(chave)} {_numero(serie)}")
+                        continue
+                    acumulado = 0
+                    for limite, contagem in zip(buckets, serie):
+                        acumulado += contagem
+                        linhas.append(f"{metrica}_bucket{_rotulos(chave, [('le', _numero(limite))])} {acumulado}")
+                    linhas.append(f"{metrica}_bucket{_rotulos(chave, [('le', '+Inf')])} {serie[-1]}")
+                    linhas.append(f"{metrica}_sum{_rotulos(chave)} {_numero(serie[-2])}")
+                    linhas.append(f"{metrica}_count{_rotulos(chave)} {serie[-1]}")
+        return '\n'.join(linhas) + '\n'
+
+
+metricas = RegistroMetricas()
+_formas_vistas = set()
+_lock_formas = threading.Lock()
+
+
+def rotulo_forma(forma):
+    """Texto curto da forma da pergunta (métrica|dimensões|filtros|fonte), com teto de valores distintos."""
+    if forma is None:
+        return ''
+    metrica, dimensoes, filtros, _ordenar_por, _ordem, periodos_comparados, fonte = forma
+    if periodos_comparados:
+        fonte = f"{fonte}+comparacao:{periodos_comparados}"
+    if not isinstance(metrica, str):  # várias métricas
+        metrica = ','.join(metrica)
+    texto = '|'.join((metrica, ','.join(dimensoes), ','.join(f"{c}:{o}" for c, o in filtros), fonte))
+    with _lock_formas:
+        if texto not in _formas_vistas:
+            if len(_formas_vistas) >= MAX_FORMAS:
+                return 'outras'
+            _formas_vistas.add(texto)
+    return texto
+
+
+# --- 2. Medição de uma requisição ---
+
+class Medicao:
+    """Tempos acumulados de uma requisição (segundos) e linhas devolvidas pelo banco."""
+
+    def __init__(self, endpoint, forma=''):
+        self.endpoint = endpoint
+        self.forma = forma
+        self.inicio = time.perf_counter()
+        self.execucao = 0.0
+        self.fetch = 0.0
+        self.espera_pool = 0.0
+        self.linhas = 0
+        self.queries = 0
+        self._token = None
+
+    def finalizar(self, cache=''):
+        """
+        Registra os histogramas. Resposta do cache (ou de outra requisição
+        igual, COALESCED) conta só no tempo total.
+        """
+        total = time.perf_counter() - self.inicio
+        rotulos = {'endpoint': self.endpoint, 'forma': self.forma}
+        metricas.observar('requisicao_segundos', total, cache=cache, **rotulos)
+        if cache in ('HIT', 'COALESCED'):
+            return
+        metricas.observar('pool_espera_segundos', self.espera_pool, **rotulos)
+        metricas.observar('sql_execucao_segundos', self.execucao, **rotulos)
+        metricas.observar('sql_fetch_segundos', self.fetch, **rotulos)
+        metricas.observar('pos_processamento_segundos',
+                          max(total - self.execucao - self.fetch - self.espera_pool, 0.0), **rotulos)
+        metricas.observar('linhas_retornadas', self.linhas, **rotulos)
+
+
+_medicao_atual = contextvars.ContextVar('medicao_atual', default=None)
+
+
+def iniciar_requisicao(endpoint, forma=''):
+    """Cria a Medicao e a torna a atual (vista pelo cursor e pelo pool) até encerrar_requisicao."""
+    medicao = Medicao(endpoint, forma)
+    medicao._token = _medicao_atual.set(medicao)
+    return medicao
+
+
+def encerrar_requisicao(medicao, cache=''):
+    medicao.finalizar(cache)
+    if medicao._token is not None:
+        _medicao_atual.reset(medicao._token)
+        medicao._token = None
+
+
+def registrar_espera_pool(segundos):
+    medicao = _medicao_atual.get()
+    if medicao is not None:
+        medicao.espera_pool += segundos
+
+
+class CursorInstrumentado(psycopg2.extensions.cursor):
+    """Cursor que soma execução, fetch e linhas na Medicao atual e captura o plano das queries lentas."""
+
+    def execute(self, query, vars=None):
+        inicio = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            duracao = time.perf_counter() - inicio
+            medicao = _medicao_atual.get()
+            if medicao is not None:
+                medicao.execucao += duracao
+                medicao.queries += 1
+            if self.query and lenta(duracao):
+                sql = self.query.decode(psycopg2.extensions.encodings[self.connection.encoding])
+                capturar_plano(sql, None, duracao, medicao)
+
+    def _medir_fetch(self, funcao, *args):
+        inicio = time.perf_counter()
+        resultado = funcao(*args)
+        medicao = _medicao_atual.get()
+        if medicao is not None:
+            medicao.fetch += time.perf_counter() - inicio
+            medicao.linhas += len(resultado) if isinstance(resultado, list) else int(resultado is not None)
+        return resultado
+
+    def fetchone(self):
+        return self._medir_fetch(super().fetchone)
+
+    def fetchmany(self, size=None):
+        return self._medir_fetch(super().fetchmany, self.arraysize if size is None else size)
+
+    def fetchall(self):
+        return self._medir_fetch(super().fetchall)
+
+
+# --- 3. Planos das queries lentas ---
+
+class AnelPlanos:
+    """As últimas `tamanho` capturas de plano (mais recente primeiro na listagem). Thread-safe."""
+
+    def __init__(self, tamanho=TAMANHO_ANEL):
+        self._itens = collections.deque(maxlen=tamanho)
+        self._lock = threading.Lock()
+
+    def guardar(self, captura):
+        with self._lock:
+            self._itens.append(captura)
+
+    def listar(self):
+        with self._lock:
+            return list(reversed(self._itens))
+
+
+planos_lentos = AnelPlanos()
+_fila_planos = None
+# (endpoint, forma ou SQL) -> instante da captura, da mais antiga para a mais nova
+_ultima_captura = collections.OrderedDict()
+_lock_captura = threading.Lock()
+
+
+def lenta(duracao_segundos):
+    return LIMIAR_QUERY_LENTA_MS is not None and duracao_segundos * 1000 >= LIMIAR_QUERY_LENTA_MS
+
+
+def capturar_plano(sql, parametros, duracao_segundos, medicao=None):
+    """
+    Agenda o EXPLAIN (ANALYZE, BUFFERS) de uma query lenta. `sql` é o texto já
+    com os valores (psycopg2) ou uma query do SQLAlchemy com os `parametros`.
+    Não bloqueia: com a fila cheia ou a mesma query capturada há pouco, só conta.
+    """
+    endpoint = medicao.endpoint if medicao is not None else ''
+    forma = medicao.forma if medicao is not None else ''
+    metricas.contar('queries_lentas_total', endpoint=endpoint)
+    if _fila_planos is None:
+        return
+
+    chave = (endpoint, forma or str(sql)[:500])
+    agora = time.monotonic()
+    with _lock_captura:
+        # No Flask a chave é o SQL com os valores: esquece as que saíram do intervalo
+        while _ultima_captura and agora - next(iter(_ultima_captura.values())) >= INTERVALO_MESMA_QUERY_SEGUNDOS:
+            _ultima_captura.popitem(last=False)
+        if chave in _ultima_captura:
+            return
+        _ultima_captura[chave] = agora
+        if len(_ultima_captura) > MAX_CAPTURAS_LEMBRADAS:
+            _ultima_captura.popitem(last=False)
+    try:
+        _fila_planos.put_nowait({
+            'em': datetime.now().isoformat(timespec='seconds'),
+            'endpoint': endpoint,
+            'forma': forma,
+            'duracao_ms': round(1000 * duracao_segundos, 1),
+            'sql': sql,
+            'parametros': parametros,
+        })
+    except queue.Full:
+        metricas.contar('planos_capturados_total', resultado='descartado')
+
+
+def _sql_e_parametros(captura):
+    """Texto e parâmetros (estilo psycopg2) da query capturada."""
+    if isinstance(captura['sql'], str):
+        return captura['sql'], None
+    from sqlalchemy.dialects.postgresql import psycopg2 as dialeto_psycopg2
+    compilada = captura['sql'].compile(dialect=dialeto_psycopg2.dialect())
+    # Expande os parâmetros de lista (IN) com os valores desta execução
+    expandida = compilada.construct_expanded_state(captura['parametros'] or {})
+    return expandida.statement, expandida.parameters
+
+
+def explicar(conn, captura):
+    """Roda o EXPLAIN (ANALYZE, BUFFERS) da captura e devolve o plano em texto."""
+    sql, parametros = _sql_e_parametros(captura)
+    if not sql.lstrip().upper().startswith(('SELECT', 'WITH')):
+        return sql, None  # só leituras: o ANALYZE executa a query de novo
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("EXPLAIN (ANALYZE, BUFFERS) " + sql, parametros)
+            plano = '\n'.join(linha[0] for linha in cursor.fetchall())
+            if parametros is not None:
+                sql = cursor.mogrify(sql, parametros).decode(psycopg2.extensions.encodings[conn.encoding])
+            return sql, plano
+    finally:
+        conn.rollback()
+
+
+def iniciar_captura_planos(db_config):
+    """
+    Sobe a thread daemon que roda os EXPLAIN das queries lentas, numa conexão
+    própria (fora do pool e sem o cursor instrumentado). Idempotente.
+    """
+    global _fila_planos
+    if _fila_planos is not None:
+        return None
+    _fila_planos = queue.Queue(maxsize=FILA_PLANOS_MAX)
+
+    def _loop():
+        conn = None
+        while True:
+            captura = _fila_planos.get()
+            try:
+                if conn is None or conn.closed:
+                    conn = psycopg2.connect(**{**db_config, 'cursor_factory': psycopg2.extensions.cursor},
+                                            options=f"-c statement_timeout={EXPLAIN_TIMEOUT_MS}")
+                sql, plano = explicar(conn, captura)
+                if plano is None:
+                    continue
+                planos_lentos.guardar({**captura, 'sql': sql, 'parametros': None, 'plano': plano})
+                metricas.contar('planos_capturados_total', resultado='ok')
+            except Exception as e:
+                print(f"ERRO [planos lentos]: {e}", file=sys.stderr)
+                planos_lentos.guardar({**captura, 'sql': str(captura['sql']), 'parametros': None,
+                                       'plano': None, 'erro': str(e)})
+                metricas.contar('planos_capturados_total', resultado='erro')
+
+    thread = threading.Thread(target=_loop, name='planos-lentos', daemon=True)
+    thread.start()
+    return thread
@@ -1,8 +1,15 @@
-from flask import Flask, jsonify, request
-from conexao_db import init_pool, get_connection, release_connection
+from flask import Flask, g, jsonify, request
+from conexao_db import init_pool, get_connection, release_connection, db_config, estatisticas_pool, PoolEsgotado
+import rollup
+import cache_respostas
+import coalescencia
+import instrumentacao
+import functools
+import re
 import sys
+from schema import Periodo, Deslocamento
 from flask_cors import CORS
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
 
 # Cria a aplicação Flask
 app = Flask(__name__)
@@ -11,15 +18,130 @@ CORS(app)
 # Inicializa o Pool de Conexões do banco de dados
 init_pool()
 
+# Mantém o rollup dos painéis atualizado em segundo plano (ver rollup.py)
+ROLLUP_INTERVALO_SEGUNDOS = 60
+rollup.iniciar_atualizacao_em_segundo_plano(db_config, ROLLUP_INTERVALO_SEGUNDOS)
+
+# Cache das respostas (ver cache_respostas.py): esvaziado quando chegam vendas
+# novas ou quando o rollup é atualizado
+cache = cache_respostas.CacheRespostas()
+cache_respostas.iniciar_escuta_invalidacao(
+    db_config, cache, canais=(cache_respostas.CANAL_VENDAS, rollup.CANAL_ROLLUP)
+)
+
+# Pedidos iguais e simultâneos rodam o SQL uma vez só (ver coalescencia.py).
+# Com vários processos (ex.: gunicorn --workers N) aponte para uma pasta local
+# para coalescer também entre eles.
+PASTA_TRAVAS_COALESCENCIA = None
+coalescencia_pedidos = coalescencia.Coalescencia(PASTA_TRAVAS_COALESCENCIA)
+
+# Tempos por endpoint (SQL, fetch, pós-processamento, espera do pool) e
+# planos das queries lentas (ver instrumentacao.py)
+instrumentacao.iniciar_captura_planos(db_config)
+
+@app.before_request
+def iniciar_medicao():
+    endpoint = request.url_rule.rule.removeprefix('/api/') if request.url_rule else '(sem rota)'
+    g.medicao = instrumentacao.iniciar_requisicao(endpoint)
+
+@app.after_request
+def registrar_medicao(resposta):
+    medicao = g.pop('medicao', None)
+    if medicao is not None:
+        instrumentacao.encerrar_requisicao(medicao, cache=resposta.headers.get('X-Cache', ''))
+    return resposta
+
+@app.teardown_request
+def encerrar_medicao(erro=None):
+    # Exceção não tratada: o after_request não roda
+    medicao = g.pop('medicao', None)
+    if medicao is not None:
+        instrumentacao.encerrar_requisicao(medicao)
+
+# Parâmetros que cada endpoint lê da query string: {nome: (tipo, padrão)}
+def _ordenacao(valor):
+    return 'ASC' if valor.upper() == 'ASC' else 'DESC'
+
+CAMPOS_FILTROS = {'loja': (list, None), 'canal': (list, None), 'dia_semana': (int, None)}
+CAMPOS_HORA = {'hora_inicio': (int, 0), 'hora_fim': (int, 23)}
+CAMPOS_GRAFICOS = {**CAMPOS_FILTROS, 'dias': (int, 30)}
+
+def com_cache(endpoint, campos):
+    """
+    Responde do cache quando a mesma pergunta (filtros normalizados) já foi
+    respondida. A janela relativa `dias` entra na chave como o dia de início
+    efetivo, o mesmo que get_base_filters usa na query. Sem resposta no cache,
+    pedidos iguais e simultâneos esperam o primeiro (X-Cache: COALESCED).
+    """
+    def decorador(handler):
+        @functools.wraps(handler)
+        def envoltorio(*args, **kwargs):
+            filtros = cache_respostas.normalizar_args(request.args, campos)
+            if 'dias' in filtros:
+                filtros['dias'] = inicio_da_janela(filtros['dias']).date().isoformat()
+            chave = cache_respostas.chave_requisicao(endpoint, filtros)
+
+            achou, corpo = cache.obter(chave)
+            if achou:
+                return app.response_class(corpo, mimetype='application/json', headers={'X-Cache': 'HIT'})
+
+            geracao = cache.geracao
+
+            def calcular():
+                resposta = app.make_response(handler(*args, **kwargs))
+                if resposta.status_code == 200:
+                    cache.guardar(chave, resposta.get_data(), geracao)
+                return {
+                    'corpo': resposta.get_data(as_text=True),
+                    'status': resposta.status_code,
+                    'headers': {k: v for k, v in resposta.headers.items() if k != 'Content-Length'},
+                }
+
+            valor, coalescida = coalescencia_pedidos.executar(chave, calcular)
+            if coalescida and valor['status'] == 200:
+                # Calculada em outro processo: passa a valer também no cache deste
+                cache.guardar(chave, valor['corpo'].encode('utf-8'), geracao)
+            resposta = app.response_class(valor['corpo'], status=valor['status'], headers=valor['headers'])
+            resposta.headers['X-Cache'] = 'COALESCED' if coalescida else 'MISS'
+            return resposta
+        return envoltorio
+    return decorador
+
+def pool_esgotado(e):
+    """Todas as conexões ocupadas além do tempo de espera: 503 para o cliente tentar de novo."""
+    print(f"AVISO [pool]: {e}", file=sys.stderr)
+    return jsonify({"erro": str(e)}), 503, {'Retry-After': '1'}
+
 @app.route('/')
 def home():
     """Página inicial apenas para teste."""
     return "O servidor da API está rodando!"
 
+@app.route('/api/cache/estatisticas')
+def estatisticas_cache():
+    """Contadores do cache de respostas (hits, misses, despejos, invalidações) e da coalescência."""
+    return jsonify({**cache.estatisticas(), 'coalescencia': coalescencia_pedidos.estatisticas()})
+
+@app.route('/api/pool/estatisticas')
+def estatisticas_pool_conexoes():
+    """Uso do pool de conexões: ocupação, fila, tempo de espera e tempo de uso."""
+    return jsonify(estatisticas_pool())
+
+@app.route('/metrics')
+def exportar_metricas():
+    """Histogramas de tempo e linhas por endpoint, no formato de texto do Prometheus."""
+    return app.response_class(instrumentacao.metricas.texto(), content_type=instrumentacao.TIPO_CONTEUDO_METRICAS)
+
+@app.route('/api/queries-lentas')
+def listar_queries_lentas():
+    """EXPLAIN (ANALYZE, BUFFERS) das últimas queries acima de instrumentacao.LIMIAR_QUERY_LENTA_MS."""
+    return jsonify(instrumentacao.planos_lentos.listar())
+
 # --- ENDPOINT DE ANÁLISE TOP PRODUTOS (Painel Resumo) ---
 @app.route('/api/analise/top-produtos')
+@com_cache('analise/top-produtos', {**CAMPOS_FILTROS, **CAMPOS_HORA,
+                                    'ordenacao': (_ordenacao, 'DESC'), 'limite': (int, 10)})
 def analisar_top_produtos_atualizado():
-    print("Recebida requisição em /api/analise/top-produtos")
     conn = None
     try:
         # --- 1. Coletar Filtros ---
@@ -35,41 +157,25 @@ def analisar_top_produtos_atualizado():
             ordenacao = 'DESC'
 
         # --- 2. Montar Query ---
-        params = []
-        where_clauses = []
-
-        where_clauses.append("EXTRACT(HOUR FROM s.created_at) BETWEEN %s AND %s")
-        params.extend([hora_inicio, hora_fim])
-
-        if dia_semana is not None:
-            where_clauses.append("EXTRACT(ISODOW FROM s.created_at) = %s")
-            params.append(dia_semana)
-        if lojas_selecionadas:
-            where_clauses.append("sb.name IN %s") 
-            params.append(tuple(lojas_selecionadas))
-        if canais_selecionados:
-            where_clauses.append("c.name IN %s")
-            params.append(tuple(canais_selecionados))
-
+        conn = get_connection()
+        fonte = escolher_fonte_produtos(conn, precisa_hora=hora_inicio > 0 or hora_fim < 23)
+        params, where_clauses = montar_filtros(
+            fonte, lojas_selecionadas, canais_selecionados, dia_semana, hora_inicio, hora_fim
+        )
         sql_where = "WHERE " + " AND ".join(where_clauses) if where_clauses else ""
-        
+
+        # Desempate pelo nome: o top-N sai igual lendo do rollup ou dos itens
         sql_query = f"""
-            SELECT p.name, sb.name, c.name, SUM(ps.quantity) AS total_vendido
-            FROM product_sales ps
-            JOIN sales s ON ps.sale_id = s.id
-            JOIN products p ON ps.product_id = p.id
-            JOIN channels c ON s.channel_id = c.id
-            JOIN stores l ON s.store_id = l.id 
-            JOIN sub_brands sb ON l.sub_brand_id = sb.id 
+            SELECT p.name, sb.name, c.name, {fonte['quantidade']} AS total_vendido
+            FROM {fonte['from']}
             {sql_where}
-            GROUP BY p.name, sb.name, c.name   
-            ORDER BY total_vendido {ordenacao} 
+            GROUP BY p.name, sb.name, c.name
+            ORDER BY total_vendido {ordenacao}, p.name, sb.name, c.name
             LIMIT %s;
         """
         params.append(limite)
 
         # --- 3. Executar ---
-        conn = get_connection()
         with conn.cursor() as cursor:
             cursor.execute(sql_query, tuple(params))
             produtos = cursor.fetchall()
@@ -79,16 +185,259 @@ def analisar_top_produtos_atualizado():
             ]
             return jsonify(resultado_formatado)
 
+    except PoolEsgotado as e:
+        return pool_esgotado(e)
     except Exception as e:
         print(f"ERRO [top-produtos]: {e}", file=sys.stderr)
         return jsonify({"erro": str(e)}), 500
     finally:
         if conn: release_connection(conn)
 
+# --- FONTES DE DADOS (tabela bruta x rollup) ---
+# Cada fonte diz como ler as mesmas grandezas a partir de uma tabela diferente.
+# Os endpoints montam o SQL só com estas expressões, então a mesma query
+# roda sobre `sales` ou sobre as tabelas pré-agregadas do rollup.
+FONTE_VENDAS = {
+    'from': """sales s
+            JOIN stores l ON s.store_id = l.id
+            JOIN sub_brands sb ON l.sub_brand_id = sb.id
+            JOIN channels c ON s.channel_id = c.id""",
+    'grao': 'venda',
+    # `sales` é particionada por mês de created_at: janelas de tempo também
+    # filtram por ele, para o Postgres só abrir as partições dos meses pedidos.
+    # Com limites de mês: um limite exato repetiria o filtro por dia e o
+    # planner contaria a mesma restrição duas vezes.
+    'particao': "s.created_at",
+    'dia': "s.sale_date",
+    'hora': "s.sale_hour",
+    'dia_semana': "s.sale_isodow",
+    'status': "s.sale_status_desc",
+    'pedidos': "COUNT(s.id)",
+    'faturamento': "SUM(s.value_paid)",
+    'ticket_medio': "AVG(s.value_paid)",
+    'clientes_unicos': "COUNT(DISTINCT s.customer_id)",
+    # Versões com FILTER: várias contas diferentes na mesma passada ({cond} = condição SQL)
+    'pedidos_se': "COUNT(s.id) FILTER (WHERE {cond})",
+    'faturamento_se': "SUM(s.value_paid) FILTER (WHERE {cond})",
+    'clientes_unicos_se': "COUNT(DISTINCT s.customer_id) FILTER (WHERE {cond})",
+}
+
+def _fonte_rollup(tabela, grao):
+    return {
+        'from': f"""{tabela} r
+            JOIN sub_brands sb ON r.sub_brand_id = sb.id
+            JOIN channels c ON r.channel_id = c.id""",
+        'grao': grao,
+        'particao': None,
+        'dia': "r.sale_date",
+        'hora': "r.sale_hour" if grao == 'hora' else None,
+        'dia_semana': "r.sale_isodow",
+        'status': "r.sale_status_desc",
+        'pedidos': "SUM(r.sales_count)",
+        'faturamento': "SUM(r.value_paid_sum)",
+        'ticket_medio': "SUM(r.value_paid_sum) / NULLIF(SUM(r.sales_count), 0)",
+        'clientes_unicos': None,  # COUNT DISTINCT não é somável entre buckets
+        'pedidos_se': "SUM(r.sales_count) FILTER (WHERE {cond})",
+        'faturamento_se': "SUM(r.value_paid_sum) FILTER (WHERE {cond})",
+        'clientes_unicos_se': None,
+    }
+
+FONTE_ROLLUP_HORARIO = _fonte_rollup(rollup.ROLLUP_HORARIO, 'hora')
+FONTE_ROLLUP_DIARIO = _fonte_rollup(rollup.ROLLUP_DIARIO, 'dia')
+
+# Sketches HLL dos clientes (grão diário): cada linha é um registrador de um
+# bucket; juntar buckets = MAX(rho) por registrador (ver rollup.sql_estimativa_hll)
+FONTE_HLL = {
+    'from': f"""{rollup.ROLLUP_HLL} r
+            JOIN sub_brands sb ON r.sub_brand_id = sb.id
+            JOIN channels c ON r.channel_id = c.id""",
+    'grao': 'dia',
+    'particao': None,
+    'dia': "r.sale_date",
+    'hora': None,
+    'dia_semana': "r.sale_isodow",
+    'status': "r.sale_status_desc",
+    'rho_se': "MAX(r.rho) FILTER (WHERE {cond})",
+}
+
+# Itens vendidos por produto: `product_sales` (várias linhas por venda) ou o
+# rollup de produtos, já somado por produto/sub-marca/canal/dia(/hora)
+FONTE_PRODUTOS_VENDAS = {
+    'from': """product_sales ps
+            JOIN sales s ON ps.sale_id = s.id
+            JOIN products p ON ps.product_id = p.id
+            JOIN stores l ON s.store_id = l.id
+            JOIN sub_brands sb ON l.sub_brand_id = sb.id
+            JOIN channels c ON s.channel_id = c.id""",
+    'grao': 'venda',
+    'particao': "s.created_at",
+    'dia': "s.sale_date",
+    'hora': "s.sale_hour",
+    'dia_semana': "s.sale_isodow",
+    'quantidade': "SUM(ps.quantity)",
+}
+
+def _fonte_rollup_produtos(tabela, grao):
+    return {
+        'from': f"""{tabela} r
+            JOIN products p ON r.product_id = p.id
+            JOIN sub_brands sb ON r.sub_brand_id = sb.id
+            JOIN channels c ON r.channel_id = c.id""",
+        'grao': grao,
+        'particao': None,
+        'dia': "r.sale_date",
+        'hora': "r.sale_hour" if grao == 'hora' else None,
+        'dia_semana': "r.sale_isodow",
+        'quantidade': "SUM(r.quantity_sum)",
+    }
+
+FONTE_PRODUTOS_HORARIO = _fonte_rollup_produtos(rollup.ROLLUP_PRODUTOS_HORARIO, 'hora')
+FONTE_PRODUTOS_DIARIO = _fonte_rollup_produtos(rollup.ROLLUP_PRODUTOS_DIARIO, 'dia')
+
+# Modos de contagem de clientes únicos (?clientes=): exato (COUNT DISTINCT em
+# `sales`) ou aproximado (sketches HLL, erro relativo típico rollup.HLL_ERRO_PADRAO)
+MODOS_CLIENTES = ('exato', 'aproximado')
+
+def escolher_fonte(conn, precisa_hora=False):
+    """Escolhe a fonte mais barata capaz de responder (rollup diário > horário > sales)."""
+    if not rollup.rollup_pronto(conn):
+        return FONTE_VENDAS
+    return FONTE_ROLLUP_HORARIO if precisa_hora else FONTE_ROLLUP_DIARIO
+
+def escolher_fonte_produtos(conn, precisa_hora=False):
+    """Como escolher_fonte, para os itens vendidos por produto."""
+    if not rollup.rollup_pronto(conn):
+        return FONTE_PRODUTOS_VENDAS
+    return FONTE_PRODUTOS_HORARIO if precisa_hora else FONTE_PRODUTOS_DIARIO
+
+def montar_filtros(fonte, lojas, canais, dia_semana=None, hora_inicio=0, hora_fim=23, data_inicio=None):
+    """Monta as cláusulas WHERE comuns a todos os painéis sobre a fonte escolhida."""
+    params = []
+    where_clauses = []
+
+    if data_inicio is not None:
+        # data_inicio é sempre meia-noite: as duas fontes filtram pela coluna de dia
+        where_clauses.append(f"{fonte['dia']} >= %s")
+        params.append(data_inicio.date())
+        if fonte['particao'] is not None:
+            where_clauses.append(f"{fonte['particao']} >= %s")
+            params.append(inicio_do_mes(data_inicio))
+
+    if hora_inicio > 0 or hora_fim < 23:
+        where_clauses.append(f"{fonte['hora']} BETWEEN %s AND %s")
+        params.extend([hora_inicio, hora_fim])
+    if dia_semana is not None:
+        where_clauses.append(f"{fonte['dia_semana']} = %s")
+        params.append(dia_semana)
+    if lojas:
+        where_clauses.append("sb.name IN %s")
+        params.append(tuple(lojas))
+    if canais:
+        where_clauses.append("c.name IN %s")
+        params.append(tuple(canais))
+
+    return params, where_clauses
+
 # --- ENDPOINT DE KPIS (Painel Resumo) ---
+def inicio_do_mes(dia):
+    """Início do mês do dia (limite das condições de poda de partições)."""
+    return datetime(dia.year, dia.month, 1)
+
+def mes_seguinte(dia):
+    """Início do mês seguinte ao do dia."""
+    return datetime(dia.year + dia.month // 12, dia.month % 12 + 1, 1)
+
+def filtro_periodos(fonte, periodos):
+    """
+    Condição WHERE: a linha está em algum dos períodos (OR de intervalos, usa
+    o índice por dia). Na fonte particionada cada intervalo também vira uma
+    faixa de meses de created_at, que poda as partições. Retorna (sql, params).
+    """
+    condicoes = []
+    params = []
+    for inicio, fim in periodos:
+        condicao = f"{fonte['dia']} BETWEEN %s AND %s"
+        params.extend([inicio, fim])
+        if fonte['particao'] is not None:
+            condicao += f" AND {fonte['particao']} >= %s AND {fonte['particao']} < %s"
+            params.extend([inicio_do_mes(inicio), mes_seguinte(fim)])
+        condicoes.append(f"({condicao})")
+    return "(" + " OR ".join(condicoes) + ")", params
+
+def ler_periodos():
+    """
+    Lê os parâmetros `periodo=AAAA-MM-DD:AAAA-MM-DD` (datas inclusivas, repetível).
+    Sem nenhum, devolve [None] (um único conjunto de KPIs sobre todo o histórico).
+    """
+    periodos = []
+    for texto in request.args.getlist('periodo'):
+        inicio, _, fim = texto.partition(':')
+        inicio = date.fromisoformat(inicio)
+        fim = date.fromisoformat(fim) if fim else inicio
+        if fim < inicio:
+            raise ValueError(f"período invertido: {texto}")
+        periodos.append((inicio, fim))
+    return periodos or [None]
+
+# `comparar=1s`: período base deslocado N dias (d), semanas (s), meses (m) ou anos (a) para trás
+UNIDADES_COMPARAR = {'d': 'dias', 's': 'semanas', 'm': 'meses', 'a': 'anos'}
+
+def ler_comparacoes():
+    """Lê os parâmetros `comparar` (repetível) como schema.Deslocamento."""
+    deslocamentos = []
+    for texto in request.args.getlist('comparar'):
+        casamento = re.fullmatch(r'(\d+)([dsma])', texto.strip().lower())
+        if casamento is None or int(casamento.group(1)) < 1:
+            raise ValueError(f"comparação inválida: {texto}")
+        deslocamentos.append(Deslocamento(quantidade=int(casamento.group(1)),
+                                          unidade=UNIDADES_COMPARAR[casamento.group(2)]))
+    return deslocamentos
+
+def calcular_variacoes(base, outro):
+    """delta (base - outro) e variação percentual de cada valor; None quando `outro` é zero."""
+    delta = {chave: base[chave] - valor for chave, valor in outro.items()}
+    variacao = {chave: (delta[chave] * 100 / valor) if valor else None for chave, valor in outro.items()}
+    return delta, variacao
+
+def agregados_kpis(fonte, periodos, medidas):
+    """
+    Colunas do SELECT de KPIs: para cada período, cada medida com FILTER.
+    medidas: lista de (nome, chave da fonte, condição extra); a coluna sai
+    como `<nome>_<índice do período>`. Retorna (sql, params).
+    """
+    colunas = []
+    params = []
+    for i, periodo in enumerate(periodos):
+        cond_periodo, params_periodo = "TRUE", []
+        if periodo is not None:
+            cond_periodo, params_periodo = f"{fonte['dia']} BETWEEN %s AND %s", list(periodo)
+        for nome, chave, condicao in medidas:
+            cond = f"{cond_periodo} AND {condicao}"
+            colunas.append(f"{fonte[chave].format(cond=cond)} AS {nome}_{i}")
+            params.extend(params_periodo)
+    return ",\n                ".join(colunas), params
+
+def calcular_kpis(pedidos_concluidos, faturamento_total, pedidos_cancelados, clientes_unicos):
+    pedidos_concluidos = float(pedidos_concluidos or 0)
+    faturamento_total = float(faturamento_total or 0)
+    pedidos_cancelados = float(pedidos_cancelados or 0)
+    clientes_unicos = float(clientes_unicos or 0)
+    total_pedidos = pedidos_concluidos + pedidos_cancelados
+    return {
+        "faturamento_total": faturamento_total,
+        "pedidos_concluidos": pedidos_concluidos,
+        "ticket_medio": (faturamento_total / pedidos_concluidos) if pedidos_concluidos > 0 else 0,
+        "pedidos_cancelados": pedidos_cancelados,
+        "taxa_cancelamento": (pedidos_cancelados / total_pedidos) if total_pedidos > 0 else 0,
+        "clientes_unicos": clientes_unicos,
+        "frequencia_cliente": (pedidos_concluidos / clientes_unicos) if clientes_unicos > 0 else 0,
+        "gasto_medio_cliente": (faturamento_total / clientes_unicos) if clientes_unicos > 0 else 0
+    }
+
 @app.route('/api/analise/resumo-kpis')
+@com_cache('analise/resumo-kpis', {**CAMPOS_FILTROS, **CAMPOS_HORA, 'periodo': (tuple, None),
+                                   'comparar': (tuple, None), 'clientes': (str, 'exato')})
 def analisar_resumo_kpis():
-    print("Recebida requisição em /api/analise/resumo-kpis")
     conn = None
     try:
         # --- 1. Coletar Filtros ---
@@ -97,85 +446,119 @@ def analisar_resumo_kpis():
         dia_semana = request.args.get('dia_semana', default=None, type=int)
         hora_inicio = request.args.get('hora_inicio', default=0, type=int)
         hora_fim = request.args.get('hora_fim', default=23, type=int)
-
-        # --- 2. Montar Filtros Base ---
-        # (Estes filtros serão usados em AMBAS as queries)
-        base_params = []
-        base_where_clauses = []
-
-        base_where_clauses.append("EXTRACT(HOUR FROM s.created_at) BETWEEN %s AND %s")
-        base_params.extend([hora_inicio, hora_fim])
-
-        if dia_semana is not None:
-            base_where_clauses.append("EXTRACT(ISODOW FROM s.created_at) = %s")
-            base_params.append(dia_semana)
-        if lojas_selecionadas:
-            base_where_clauses.append("sb.name IN %s")
-            base_params.append(tuple(lojas_selecionadas))
-        if canais_selecionados:
-            base_where_clauses.append("c.name IN %s")
-            base_params.append(tuple(canais_selecionados))
-
-        # --- 3. Query de KPIs (Concluídos) ---
-        params_kpis = base_params.copy()
-        where_kpis = " AND ".join(base_where_clauses + ["s.sale_status_desc = 'COMPLETED'"])
-        
-        sql_query_kpis = f"""
+        modo_clientes = request.args.get('clientes', default='exato')
+        if modo_clientes not in MODOS_CLIENTES:
+            return jsonify({"erro": f"Parâmetro 'clientes' inválido. Use {' ou '.join(MODOS_CLIENTES)}."}), 400
+        try:
+            periodos = ler_periodos()
+        except ValueError as e:
+            return jsonify({"erro": f"Parâmetro 'periodo' inválido ({e}). Use AAAA-MM-DD:AAAA-MM-DD."}), 400
+        try:
+            comparacoes = ler_comparacoes()
+        except ValueError as e:
+            return jsonify({"erro": f"Parâmetro 'comparar' inválido ({e}). Use N seguido de d, s, m ou a (ex.: 1s)."}), 400
+        rotulos = None
+        if comparacoes:
+            # Base + períodos deslocados: entram na mesma passada como períodos comuns
+            if len(periodos) != 1 or periodos[0] is None:
+                return jsonify({"erro": "Com 'comparar', informe um único 'periodo' (o período base)."}), 400
+            base = Periodo(inicio=periodos[0][0], fim=periodos[0][1])
+            periodos += [(p.inicio, p.fim) for p in (d.aplicar(base) for d in comparacoes)]
+            rotulos = ['base'] + [d.rotulo for d in comparacoes]
+
+        # --- 2. Montar a Query (uma passada só) ---
+        # Concluídos, cancelados e clientes de todos os períodos saem do mesmo
+        # scan, com agregados FILTER (WHERE ...) em vez de uma query por conta.
+        conn = get_connection()
+        precisa_hora = hora_inicio > 0 or hora_fim < 23
+
+        def montar_select(fonte, medidas):
+            params, where_clauses = montar_filtros(
+                fonte, lojas_selecionadas, canais_selecionados,
+                dia_semana=dia_semana, hora_inicio=hora_inicio, hora_fim=hora_fim
+            )
+            if periodos != [None]:
+                # Só as linhas de algum dos períodos
+                sql_periodos, params_periodos = filtro_periodos(fonte, periodos)
+                where_clauses.append(sql_periodos)
+                params.extend(params_periodos)
+            colunas, params_colunas = agregados_kpis(fonte, periodos, medidas)
+            return f"""
             SELECT
-                COUNT(s.id) AS pedidos_concluidos,
-                SUM(s.value_paid) AS faturamento_total,
-                AVG(s.value_paid) AS ticket_medio,
-                COUNT(DISTINCT s.customer_id) AS clientes_unicos
-            FROM sales s
-            JOIN channels c ON s.channel_id = c.id
-            JOIN stores l ON s.store_id = l.id
-            JOIN sub_brands sb ON l.sub_brand_id = sb.id
-            WHERE {where_kpis};
-        """
-        
-        # --- 4. Query de Cancelados ---
-        params_cancelados = base_params.copy()
-        where_cancelados = " AND ".join(base_where_clauses + ["s.sale_status_desc = 'CANCELLED'"])
-
-        sql_query_cancelados = f"""
-            SELECT COUNT(s.id) AS pedidos_cancelados
-            FROM sales s
-            JOIN channels c ON s.channel_id = c.id
-            JOIN stores l ON s.store_id = l.id
-            JOIN sub_brands sb ON l.sub_brand_id = sb.id
-            WHERE {where_cancelados};
-        """
+                {colunas}
+            FROM {fonte['from']}
+            WHERE {" AND ".join(where_clauses) or "TRUE"}
+            """, params_colunas + params
+
+        fonte = escolher_fonte(conn, precisa_hora)
+        medidas = [
+            ('pedidos_concluidos', 'pedidos_se', f"{fonte['status']} = 'COMPLETED'"),
+            ('faturamento_total', 'faturamento_se', f"{fonte['status']} = 'COMPLETED'"),
+            ('pedidos_cancelados', 'pedidos_se', f"{fonte['status']} = 'CANCELLED'"),
+        ]
+        if fonte['clientes_unicos_se'] is not None:
+            modo_clientes = 'exato'
+            medidas.append(('clientes_unicos', 'clientes_unicos_se', f"{fonte['status']} = 'COMPLETED'"))
+            sql_query, params = montar_select(fonte, medidas)
+        elif modo_clientes == 'aproximado' and fonte is FONTE_ROLLUP_DIARIO:
+            # Clientes únicos pelos sketches HLL: junta os registradores dos buckets
+            # de cada período (uma coluna rho_<i> por período) e estima
+            sql_kpis, params_kpis = montar_select(fonte, medidas)
+            sql_rhos, params_clientes = montar_select(
+                FONTE_HLL, [('rho', 'rho_se', "r.sale_status_desc = 'COMPLETED'")]
+            )
+            estimativas = ", ".join(
+                f"{rollup.sql_estimativa_hll(f'h.rho_{i}')} AS clientes_unicos_{i}" for i in range(len(periodos))
+            )
+            sql_query = f"""SELECT * FROM ({sql_kpis}) k
+            CROSS JOIN (SELECT {estimativas} FROM ({sql_rhos} GROUP BY r.registrador) h) c"""
+            params = params_kpis + params_clientes
+        else:
+            # Clientes únicos (COUNT DISTINCT) não dá para somar entre buckets do rollup:
+            # sai de `sales`, mas na mesma ida ao banco. O HLL não tem a hora do dia,
+            # então um filtro de hora também cai aqui (modo exato).
+            modo_clientes = 'exato'
+            sql_kpis, params_kpis = montar_select(fonte, medidas)
+            sql_clientes, params_clientes = montar_select(
+                FONTE_VENDAS, [('clientes_unicos', 'clientes_unicos_se', "s.sale_status_desc = 'COMPLETED'")]
+            )
+            sql_query = f"SELECT * FROM ({sql_kpis}) k CROSS JOIN ({sql_clientes}) c"
+            params = params_kpis + params_clientes
 
-        # --- 5. Executar ---
-        conn = get_connection()
-        kpis = {}
+        # --- 3. Executar ---
         with conn.cursor() as cursor:
-            cursor.execute(sql_query_kpis, tuple(params_kpis))
-            res_kpis = cursor.fetchone()
-            
-            cursor.execute(sql_query_cancelados, tuple(params_cancelados))
-            res_cancelados = cursor.fetchone()
-
-            # --- 6. Formatar Resultado ---
-            pedidos_concluidos = float(res_kpis[0] or 0)
-            faturamento_total = float(res_kpis[1] or 0)
-            ticket_medio = float(res_kpis[2] or 0)
-            clientes_unicos = float(res_kpis[3] or 0)
-            pedidos_cancelados = float(res_cancelados[0] or 0)
-            total_pedidos = pedidos_concluidos + pedidos_cancelados
-
-            kpis = {
-                "faturamento_total": faturamento_total,
-                "pedidos_concluidos": pedidos_concluidos,
-                "ticket_medio": ticket_medio,
-                "pedidos_cancelados": pedidos_cancelados,
-                "taxa_cancelamento": (pedidos_cancelados / total_pedidos) if total_pedidos > 0 else 0,
-                "clientes_unicos": clientes_unicos,
-                "frequencia_cliente": (pedidos_concluidos / clientes_unicos) if clientes_unicos > 0 else 0,
-                "gasto_medio_cliente": (faturamento_total / clientes_unicos) if clientes_unicos > 0 else 0
-            }
-            return jsonify(kpis)
-
+            cursor.execute(sql_query, tuple(params))
+            linha = dict(zip([col[0] for col in cursor.description], cursor.fetchone()))
+
+        # --- 4. Formatar Resultado ---
+        resultados = []
+        kpis_base = None
+        for i, periodo in enumerate(periodos):
+            kpis = calcular_kpis(
+                linha[f'pedidos_concluidos_{i}'], linha[f'faturamento_total_{i}'],
+                linha[f'pedidos_cancelados_{i}'], linha[f'clientes_unicos_{i}']
+            )
+            variacoes = {}
+            if rotulos is not None:
+                if i == 0:
+                    kpis_base = kpis
+                else:
+                    variacoes["delta"], variacoes["variacao_percentual"] = calcular_variacoes(kpis_base, kpis)
+            kpis = {**kpis, **variacoes}
+            kpis["clientes_unicos_modo"] = modo_clientes
+            kpis["clientes_unicos_erro_padrao"] = rollup.HLL_ERRO_PADRAO if modo_clientes == 'aproximado' else 0.0
+            if periodo is not None:
+                kpis = {"inicio": periodo[0].isoformat(), "fim": periodo[1].isoformat(), **kpis}
+            if rotulos is not None:
+                kpis = {"periodo": rotulos[i], **kpis}
+            resultados.append(kpis)
+
+        if periodos == [None]:
+            return jsonify(resultados[0])
+        return jsonify({"periodos": resultados})
+
+    except PoolEsgotado as e:
+        return pool_esgotado(e)
     except Exception as e:
         print(f"ERRO [resumo-kpis]: {e}", file=sys.stderr)
         return jsonify({"erro": str(e)}), 500
@@ -184,83 +567,168 @@ def analisar_resumo_kpis():
 
 
 # --- FUNÇÃO AUXILIAR PARA FILTROS DE GRÁFICOS ---
-def get_base_filters():
-    """Coleta filtros comuns para os endpoints de gráficos."""
+def inicio_da_janela(dias_atras):
+    """Início (meia-noite) da janela relativa de `dias_atras` dias."""
+    return (datetime.now() - timedelta(days=dias_atras)).replace(hour=0, minute=0, second=0, microsecond=0)
+
+def get_base_filters(fonte, periodos=None):
+    """
+    Coleta filtros comuns para os endpoints de gráficos. Com `periodos`
+    [(início, fim)], eles substituem a janela de `dias`.
+    """
     lojas_selecionadas = request.args.getlist('loja')
     canais_selecionados = request.args.getlist('canal')
     dia_semana = request.args.get('dia_semana', default=None, type=int)
     
-    # Período fixo de 30 dias para gráficos de tendência
+    # Período fixo de 30 dias para gráficos de tendência.
+    # Começa à meia-noite para que o primeiro dia do gráfico venha completo
+    # (e para que vendas e rollup devolvam exatamente o mesmo resultado).
     dias_atras = request.args.get('dias', default=30, type=int)
-    data_inicio = datetime.now() - timedelta(days=dias_atras)
-
-    params = [data_inicio]
-    where_clauses = ["s.created_at >= %s"]
-
-    if dia_semana is not None:
-        where_clauses.append("EXTRACT(ISODOW FROM s.created_at) = %s")
-        params.append(dia_semana)
-    if lojas_selecionadas:
-        where_clauses.append("sb.name IN %s")
-        params.append(tuple(lojas_selecionadas))
-    if canais_selecionados:
-        where_clauses.append("c.name IN %s")
-        params.append(tuple(canais_selecionados))
-        
-    # SQL Joins necessários para estes filtros
-    sql_joins = """
-        JOIN stores l ON s.store_id = l.id
-        JOIN sub_brands sb ON l.sub_brand_id = sb.id
-        JOIN channels c ON s.channel_id = c.id
+    data_inicio = inicio_da_janela(dias_atras) if periodos is None else None
+
+    params, where_clauses = montar_filtros(
+        fonte, lojas_selecionadas, canais_selecionados,
+        dia_semana=dia_semana, data_inicio=data_inicio
+    )
+    if periodos is not None:
+        sql_periodos, params_periodos = filtro_periodos(fonte, periodos)
+        where_clauses.append(sql_periodos)
+        params.extend(params_periodos)
+    return params, where_clauses
+
+# --- FORMATAÇÃO DOS GRÁFICOS (Chart.js) ---
+# Usadas pelos endpoints individuais e pelo painel agrupado (/api/graficos/painel)
+def formatar_vendas_por_dia_loja(rows):
+    """rows: (dia, loja, faturamento) -> uma série por loja."""
+    labels = []
+    datasets_data = {} 
+    lojas = set()
+    datas_dias = set()
+
+    for dia, loja, faturamento in rows:
+        dia_str = dia.isoformat()
+        datas_dias.add(dia_str)
+        lojas.add(loja)
+        if loja not in datasets_data: datasets_data[loja] = {}
+        datasets_data[loja][dia_str] = float(faturamento)
+
+    labels = sorted(list(datas_dias))
+    datasets = []
+    for loja in sorted(list(lojas)):
+        data = [datasets_data[loja].get(dia_label, 0) for dia_label in labels]
+        datasets.append({'label': loja, 'data': data})
+
+    return {'labels': labels, 'datasets': datasets}
+
+def formatar_comparacao_vendas_por_dia_loja(rows, periodos):
     """
-    
-    return params, where_clauses, sql_joins
+    rows: (dia, loja, faturamento) da base e dos períodos de comparação, lidos
+    juntos. periodos: [(rótulo, Periodo)], a base primeiro.
+    Cada dia de uma comparação vai para o dia da base na mesma posição do
+    período (-1s: o dia uma semana antes; -1m: o 1º de março com o 1º de
+    abril). Assim cada dia da base tem no máximo um par, mesmo quando a
+    comparação tem outro número de dias (o 31 de março fica sem par).
+    Cada série de comparação traz o delta e a variação percentual da base
+    em relação a ela, ponto a ponto.
+    """
+    inicio_base = periodos[0][1].inicio
+    por_periodo = []
+    for rotulo, periodo in periodos:
+        valores = {}
+        for dia, loja, faturamento in rows:
+            if periodo.inicio <= dia <= periodo.fim:
+                dia = inicio_base + (dia - periodo.inicio)
+                chave = (dia.isoformat(), loja)
+                valores[chave] = valores.get(chave, 0) + float(faturamento)
+        por_periodo.append((rotulo, valores))
+
+    base = formatar_vendas_por_dia_loja(
+        [(date.fromisoformat(dia), loja, valor) for (dia, loja), valor in por_periodo[0][1].items()]
+    )
+    labels = base['labels']
+    datasets = [{**dataset, 'periodo': 'base'} for dataset in base['datasets']]
+    for rotulo, valores in por_periodo[1:]:
+        for dataset_base in base['datasets']:
+            loja = dataset_base['label']
+            data = [valores.get((dia, loja), 0) for dia in labels]
+            delta, variacao = calcular_variacoes(dict(enumerate(dataset_base['data'])), dict(enumerate(data)))
+            datasets.append({
+                'label': f"{loja} ({rotulo})", 'periodo': rotulo, 'data': data,
+                'delta': [delta[i] for i in range(len(data))],
+                'variacao_percentual': [variacao[i] for i in range(len(data))],
+            })
+    return {
+        'labels': labels,
+        'datasets': datasets,
+        'periodos': [
+            {'periodo': rotulo, 'inicio': periodo.inicio.isoformat(), 'fim': periodo.fim.isoformat()}
+            for rotulo, periodo in periodos
+        ],
+    }
+
+def formatar_pedidos_por_status(rows):
+    """rows: (status, pedidos)."""
+    return {'labels': [row[0] for row in rows], 'data': [float(row[1]) for row in rows]}
+
+def formatar_pedidos_por_canal(rows, limite=7):
+    """rows: (canal, pedidos) -> os `limite` maiores, do menor para o maior."""
+    top = sorted(rows, key=lambda row: row[1], reverse=True)[:limite]
+    # Invertemos para Chart.js (horizontal bar)
+    labels = [row[0] for row in reversed(top)]
+    data = [float(row[1]) for row in reversed(top)]
+    return {'labels': labels, 'data': data}
+
+def formatar_pedidos_por_hora(rows):
+    """rows: (hora, pedidos) -> sempre as 24 horas."""
+    # Criar array de 24 horas para garantir que o gráfico mostre todas
+    data_por_hora = {int(row[0]): float(row[1]) for row in rows}
+    labels = [f"{h}h" for h in range(24)]
+    data = [data_por_hora.get(h, 0) for h in range(24)]
+    return {'labels': labels, 'data': data}
 
 # --- ENDPOINT GRÁFICO 1: Vendas por Dia (Linha) ---
 @app.route('/api/graficos/vendas-por-dia-loja')
+@com_cache('graficos/vendas-por-dia-loja', {**CAMPOS_GRAFICOS, 'comparar': (tuple, None)})
 def grafico_vendas_por_dia_loja():
-    print("Recebida requisição em /api/graficos/vendas-por-dia-loja")
     conn = None
     try:
-        params, where_clauses, sql_joins = get_base_filters()
-        where_clauses.append("s.sale_status_desc = 'COMPLETED'") # Apenas vendas concluídas
+        try:
+            comparacoes = ler_comparacoes()
+        except ValueError as e:
+            return jsonify({"erro": f"Parâmetro 'comparar' inválido ({e}). Use N seguido de d, s, m ou a (ex.: 1s)."}), 400
+        periodos = None
+        if comparacoes:
+            # A janela de `dias` é a base; base e comparações saem da mesma leitura
+            dias_atras = request.args.get('dias', default=30, type=int)
+            base = Periodo(inicio=inicio_da_janela(dias_atras).date(), fim=date.today())
+            periodos = [('base', base)] + [(d.rotulo, d.aplicar(base)) for d in comparacoes]
+
+        conn = get_connection()
+        fonte = escolher_fonte(conn)
+        params, where_clauses = get_base_filters(
+            fonte, None if periodos is None else [(p.inicio, p.fim) for _, p in periodos]
+        )
+        where_clauses.append(f"{fonte['status']} = 'COMPLETED'") # Apenas vendas concluídas
         sql_where = "WHERE " + " AND ".join(where_clauses)
 
         sql_query = f"""
-            SELECT DATE(s.created_at) AS dia, sb.name AS loja, SUM(s.value_paid) AS faturamento
-            FROM sales s
-            {sql_joins}
+            SELECT {fonte['dia']} AS dia, sb.name AS loja, {fonte['faturamento']} AS faturamento
+            FROM {fonte['from']}
             {sql_where}
             GROUP BY dia, loja
             ORDER BY dia ASC;
         """
         
-        conn = get_connection()
         with conn.cursor() as cursor:
             cursor.execute(sql_query, tuple(params))
             rows = cursor.fetchall()
 
-        # Processar dados para o formato Chart.js
-        labels = []
-        datasets_data = {} 
-        lojas = set()
-        datas_dias = set()
-
-        for dia, loja, faturamento in rows:
-            dia_str = dia.isoformat()
-            datas_dias.add(dia_str)
-            lojas.add(loja)
-            if loja not in datasets_data: datasets_data[loja] = {}
-            datasets_data[loja][dia_str] = float(faturamento)
-
-        labels = sorted(list(datas_dias))
-        datasets = []
-        for loja in sorted(list(lojas)):
-            data = [datasets_data[loja].get(dia_label, 0) for dia_label in labels]
-            datasets.append({'label': loja, 'data': data})
-
-        return jsonify({'labels': labels, 'datasets': datasets})
+        if periodos is not None:
+            return jsonify(formatar_comparacao_vendas_por_dia_loja(rows, periodos))
+        return jsonify(formatar_vendas_por_dia_loja(rows))
 
+    except PoolEsgotado as e:
+        return pool_esgotado(e)
     except Exception as e:
         print(f"ERRO [grafico-vendas-dia]: {e}", file=sys.stderr)
         return jsonify({"erro": str(e)}), 500
@@ -269,32 +737,31 @@ def grafico_vendas_por_dia_loja():
 
 # --- NOVO - ENDPOINT GRÁFICO 2: Pedidos por Status (Pizza) ---
 @app.route('/api/graficos/pedidos-por-status')
+@com_cache('graficos/pedidos-por-status', CAMPOS_GRAFICOS)
 def grafico_pedidos_por_status():
-    print("Recebida requisição em /api/graficos/pedidos-por-status")
     conn = None
     try:
-        params, where_clauses, sql_joins = get_base_filters()
+        conn = get_connection()
+        fonte = escolher_fonte(conn)
+        params, where_clauses = get_base_filters(fonte)
         # NÃO filtramos por status aqui, queremos ambos
         sql_where = "WHERE " + " AND ".join(where_clauses)
 
         sql_query = f"""
-            SELECT s.sale_status_desc, COUNT(s.id) AS total_pedidos
-            FROM sales s
-            {sql_joins}
+            SELECT {fonte['status']}, {fonte['pedidos']} AS total_pedidos
+            FROM {fonte['from']}
             {sql_where}
-            GROUP BY s.sale_status_desc;
+            GROUP BY {fonte['status']};
         """
         
-        conn = get_connection()
         with conn.cursor() as cursor:
             cursor.execute(sql_query, tuple(params))
             rows = cursor.fetchall()
         
-        labels = [row[0] for row in rows]
-        data = [float(row[1]) for row in rows]
-
-        return jsonify({'labels': labels, 'data': data})
+        return jsonify(formatar_pedidos_por_status(rows))
 
+    except PoolEsgotado as e:
+        return pool_esgotado(e)
     except Exception as e:
         print(f"ERRO [grafico-pedidos-status]: {e}", file=sys.stderr)
         return jsonify({"erro": str(e)}), 500
@@ -303,35 +770,33 @@ def grafico_pedidos_por_status():
 
 # --- ENDPOINT GRÁFICO 3: Pedidos por Canal (Barras Horizontais) ---
 @app.route('/api/graficos/pedidos-por-canal')
+@com_cache('graficos/pedidos-por-canal', CAMPOS_GRAFICOS)
 def grafico_pedidos_por_canal():
-    print("Recebida requisição em /api/graficos/pedidos-por-canal")
     conn = None
     try:
-        params, where_clauses, sql_joins = get_base_filters()
-        where_clauses.append("s.sale_status_desc = 'COMPLETED'") # Apenas concluídos
+        conn = get_connection()
+        fonte = escolher_fonte(conn)
+        params, where_clauses = get_base_filters(fonte)
+        where_clauses.append(f"{fonte['status']} = 'COMPLETED'") # Apenas concluídos
         sql_where = "WHERE " + " AND ".join(where_clauses)
 
         sql_query = f"""
-            SELECT c.name, COUNT(s.id) AS total_pedidos
-            FROM sales s
-            {sql_joins}
+            SELECT c.name, {fonte['pedidos']} AS total_pedidos
+            FROM {fonte['from']}
             {sql_where}
             GROUP BY c.name
             ORDER BY total_pedidos DESC
             LIMIT 7; 
         """
         
-        conn = get_connection()
         with conn.cursor() as cursor:
             cursor.execute(sql_query, tuple(params))
             rows = cursor.fetchall()
         
-        # Invertemos para Chart.js (horizontal bar)
-        labels = [row[0] for row in reversed(rows)]
-        data = [float(row[1]) for row in reversed(rows)]
-
-        return jsonify({'labels': labels, 'data': data})
+        return jsonify(formatar_pedidos_por_canal(rows))
 
+    except PoolEsgotado as e:
+        return pool_esgotado(e)
     except Exception as e:
         print(f"ERRO [grafico-pedidos-canal]: {e}", file=sys.stderr)
         return jsonify({"erro": str(e)}), 500
@@ -340,40 +805,113 @@ def grafico_pedidos_por_canal():
 
 # --- NOVO - ENDPOINT GRÁFICO 4: Pedidos por Hora (Barras Verticais) ---
 @app.route('/api/graficos/pedidos-por-hora')
+@com_cache('graficos/pedidos-por-hora', CAMPOS_GRAFICOS)
 def grafico_pedidos_por_hora():
-    print("Recebida requisição em /api/graficos/pedidos-por-hora")
     conn = None
     try:
-        params, where_clauses, sql_joins = get_base_filters()
-        where_clauses.append("s.sale_status_desc = 'COMPLETED'")
+        conn = get_connection()
+        fonte = escolher_fonte(conn, precisa_hora=True)
+        params, where_clauses = get_base_filters(fonte)
+        where_clauses.append(f"{fonte['status']} = 'COMPLETED'")
         sql_where = "WHERE " + " AND ".join(where_clauses)
 
         sql_query = f"""
-            SELECT EXTRACT(HOUR FROM s.created_at) AS hora, COUNT(s.id) AS total_pedidos
-            FROM sales s
-            {sql_joins}
+            SELECT {fonte['hora']} AS hora, {fonte['pedidos']} AS total_pedidos
+            FROM {fonte['from']}
             {sql_where}
             GROUP BY hora;
         """
         
-        conn = get_connection()
         with conn.cursor() as cursor:
             cursor.execute(sql_query, tuple(params))
             rows = cursor.fetchall()
         
-        # Criar array de 24 horas para garantir que o gráfico mostre todas
-        data_por_hora = {int(row[0]): float(row[1]) for row in rows}
-        labels = [f"{h}h" for h in range(24)]
-        data = [data_por_hora.get(h, 0) for h in range(24)]
-
-        return jsonify({'labels': labels, 'data': data})
+        return jsonify(formatar_pedidos_por_hora(rows))
 
+    except PoolEsgotado as e:
+        return pool_esgotado(e)
     except Exception as e:
         print(f"ERRO [grafico-pedidos-hora]: {e}", file=sys.stderr)
         return jsonify({"erro": str(e)}), 500
     finally:
         if conn: release_connection(conn)
 
+# --- ENDPOINT PAINEL: todos os gráficos numa ida ao banco ---
+# Para cada gráfico: chaves do GROUP BY, medida (coluna do SELECT) e formatação.
+# A medida já traz o filtro de status que o endpoint individual põe no WHERE.
+WIDGETS_GRAFICOS = {
+    'vendas-por-dia-loja': (('dia', 'loja'), 'faturamento_concluido', formatar_vendas_por_dia_loja),
+    'pedidos-por-status': (('status',), 'pedidos', formatar_pedidos_por_status),
+    'pedidos-por-canal': (('canal',), 'pedidos_concluidos', formatar_pedidos_por_canal),
+    'pedidos-por-hora': (('hora',), 'pedidos_concluidos', formatar_pedidos_por_hora),
+}
+
+@app.route('/api/graficos/painel')
+@com_cache('graficos/painel', {**CAMPOS_GRAFICOS, 'widget': (list, None)})
+def grafico_painel():
+    """
+    Todos os gráficos da página com os mesmos filtros, numa só query:
+    um scan do conjunto filtrado com GROUPING SETS (um conjunto por gráfico).
+    Parâmetro opcional `widget` (repetível) escolhe os gráficos; padrão: todos.
+    """
+    conn = None
+    try:
+        widgets = request.args.getlist('widget') or list(WIDGETS_GRAFICOS)
+        desconhecidos = [w for w in widgets if w not in WIDGETS_GRAFICOS]
+        if desconhecidos:
+            return jsonify({"erro": f"Widget(s) desconhecido(s): {', '.join(desconhecidos)}"}), 400
+        widgets = list(dict.fromkeys(widgets))
+
+        conn = get_connection()
+        fonte = escolher_fonte(conn, precisa_hora='pedidos-por-hora' in widgets)
+        params, where_clauses = get_base_filters(fonte)
+        sql_where = "WHERE " + " AND ".join(where_clauses) if where_clauses else ""
+
+        chaves = {'dia': fonte['dia'], 'loja': "sb.name", 'status': fonte['status'],
+                  'canal': "c.name", 'hora': fonte['hora']}
+        concluido = f"{fonte['status']} = 'COMPLETED'"
+        conjuntos = []
+        casos = []
+        for widget in widgets:
+            expressoes = ", ".join(chaves[k] for k in WIDGETS_GRAFICOS[widget][0])
+            conjuntos.append(f"({expressoes})")
+            casos.append(f"WHEN GROUPING({expressoes}) = 0 THEN '{widget}'")
+        colunas_chave = sorted({k for w in widgets for k in WIDGETS_GRAFICOS[w][0]})
+
+        sql_query = f"""
+            SELECT
+                CASE {" ".join(casos)} END AS widget,
+                {", ".join(f"{chaves[k]} AS {k}" for k in colunas_chave)},
+                {fonte['pedidos']} AS pedidos,
+                {fonte['pedidos_se'].format(cond=concluido)} AS pedidos_concluidos,
+                {fonte['faturamento_se'].format(cond=concluido)} AS faturamento_concluido
+            FROM {fonte['from']}
+            {sql_where}
+            GROUP BY GROUPING SETS ({", ".join(conjuntos)});
+        """
+
+        with conn.cursor() as cursor:
+            cursor.execute(sql_query, tuple(params))
+            nomes = [col[0] for col in cursor.description]
+            rows = [dict(zip(nomes, row)) for row in cursor.fetchall()]
+
+        resposta = {}
+        for widget in widgets:
+            campos, medida, formatar = WIDGETS_GRAFICOS[widget]
+            # Grupos sem nenhuma venda concluída não aparecem no endpoint individual (WHERE status)
+            linhas = [tuple(r[c] for c in campos) + (r[medida],)
+                      for r in rows if r['widget'] == widget and r[medida]]
+            resposta[widget] = formatar(linhas)
+        return jsonify(resposta)
+
+    except PoolEsgotado as e:
+        return pool_esgotado(e)
+    except Exception as e:
+        print(f"ERRO [grafico-painel]: {e}", file=sys.stderr)
+        return jsonify({"erro": str(e)}), 500
+    finally:
+        if conn: release_connection(conn)
+
 
 # --- Como rodar o servidor ---
 if __name__ == '__main__':
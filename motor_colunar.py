@@ -0,0 +1,543 @@
+# Arquivo: motor_colunar.py
+"""
+Motor colunar em memória que responde o QueryRequest sem ir ao Postgres (opcional).
+
+Para fatiar os dados de forma interativa, a maior parte do tempo de uma
+pergunta é a ida ao banco e a conversão dos Decimal do resultado. Aqui a
+tabela `sales` fica carregada em colunas NumPy, uma posição por venda:
+
+* chaves das dimensões como inteiros (id da loja, da sub-marca e do canal,
+  dia em dias desde 1970, hora) e os textos (status, origem) codificados
+  num dicionário: cada valor distinto vira um código;
+* medidas em float64 (NULL = NaN).
+
+Um filtro é avaliado uma vez por valor distinto do dicionário da dimensão
+e vira máscara por indexação (`aceitos[codigos]`). O GROUP BY junta os
+códigos das dimensões numa chave inteira e agrega com np.bincount.
+
+Só responde perguntas no grão da venda (métricas e dimensões de venda, loja,
+marca, sub-marca, canal e tempo); as que envolvem produtos, itens, pagamentos
+ou entrega continuam no query_builder. O resultado é o mesmo do query_builder
+lendo de `sales`, com as somas em float em vez de Decimal.
+
+Atualização: a cada `intervalo_segundos` lê só as vendas com id maior que o
+último carregado. Antes confere se o número de vendas com id até o último
+carregado ainda bate com o snapshot. Não bate quando vendas de id menor
+foram comitadas depois (blocos de ids e workers paralelos do
+generate_data.py) ou quando vendas foram apagadas; aí recarrega tudo na
+hora. Vendas alteradas (ex.: um cancelamento) só aparecem na recarga
+completa, a cada `recarga_completa_segundos`.
+"""
+import operator
+import re
+import sys
+import threading
+import time
+
+import numpy as np
+import psycopg2
+
+from . import query_builder
+from .schema import QueryRequest, Metrica, Dimensao, OperadorFiltro, Ordem
+
+# --- CONFIGURAÇÕES ---
+BLOCO_LINHAS = 50000               # linhas lidas do cursor por vez na carga
+ATUALIZACAO_SEGUNDOS = 10          # busca das vendas novas (id > último carregado)
+RECARGA_COMPLETA_SEGUNDOS = 600    # recarga de tudo (pega vendas alteradas/apagadas)
+# ---------------------------
+
+SQL_VENDAS = """
+    SELECT s.id, s.store_id, COALESCE(l.sub_brand_id, -1), s.channel_id, COALESCE(s.customer_id, -1),
+           s.sale_date - DATE '1970-01-01', s.sale_hour,
+           (EXTRACT(EPOCH FROM s.created_at) * 1000000)::bigint,
+           s.sale_status_desc, s.origin,
+           s.total_amount::float8, s.total_discount::float8, s.delivery_fee::float8,
+           s.production_seconds::float8, s.delivery_seconds::float8
+    FROM sales s
+    LEFT JOIN stores l ON l.id = s.store_id  -- sub-marca da loja, como no query_builder e no rollup
+    WHERE s.id > %s
+    ORDER BY s.id
+"""
+# Colunas do SELECT acima, na ordem: chaves inteiras, textos (dicionário) e medidas
+COLUNAS_CHAVE = (
+    ('id', np.int64), ('loja', np.int32), ('sub_marca', np.int32), ('canal', np.int32),
+    ('cliente', np.int64), ('dia', np.int32), ('hora', np.int16), ('data', np.int64),
+)
+COLUNAS_TEXTO = ('status', 'origem')
+COLUNAS_MEDIDA = ('total_amount', 'total_discount', 'delivery_fee', 'production_seconds', 'delivery_seconds')
+TIPOS_COLUNAS = {**dict(COLUNAS_CHAVE), **{t: np.int16 for t in COLUNAS_TEXTO}, **{m: np.float64 for m in COLUNAS_MEDIDA}}
+
+SQL_LOJAS = """
+    SELECT l.id, l.name, l.city, l.district, l.state, b.id, b.name
+    FROM stores l
+    LEFT JOIN brands b ON b.id = l.brand_id
+"""
+SQL_SUB_MARCAS = "SELECT id, name FROM sub_brands"
+SQL_CANAIS = "SELECT id, name, type FROM channels"
+
+# Dimensões que vêm de uma tabela de cadastro: (coluna de vendas com o id, tabela, atributo).
+# Como no query_builder, são INNER JOINs: venda sem linha na tabela fica de fora.
+DIMENSOES_CADASTRO = {
+    Dimensao.loja_nome: ('loja', 'lojas', 'nome'),
+    Dimensao.cidade_loja: ('loja', 'lojas', 'cidade'),
+    Dimensao.bairro_loja: ('loja', 'lojas', 'bairro'),
+    Dimensao.estado_loja: ('loja', 'lojas', 'estado'),
+    Dimensao.marca_nome: ('loja', 'lojas', 'marca'),
+    Dimensao.sub_marca_nome: ('sub_marca', 'sub_marcas', 'nome'),
+    Dimensao.canal_nome: ('canal', 'canais', 'nome'),
+    Dimensao.tipo_canal: ('canal', 'canais', 'tipo'),
+}
+DIMENSOES_SUPORTADAS = set(DIMENSOES_CADASTRO) | {
+    Dimensao.status_venda, Dimensao.origem_venda, Dimensao.dia, Dimensao.dia_semana,
+    Dimensao.mes, Dimensao.hora_dia, Dimensao.data,
+}
+METRICAS_SUPORTADAS = {
+    Metrica.faturamento_total, Metrica.ticket_medio, Metrica.total_pedidos,
+    Metrica.total_pedidos_cancelados, Metrica.taxa_cancelamento, Metrica.total_descontos,
+    Metrica.total_taxa_entrega, Metrica.tempo_preparo_medio_min, Metrica.tempo_entrega_medio_min,
+    Metrica.total_clientes_unicos,
+}
+
+_EPOCA = np.datetime64('1970-01-01', 'D')
+# to_char(data, 'Day'): nome em inglês completado com espaços até 9 letras
+_DIAS_SEMANA = np.array(
+    [d.ljust(9) for d in ('Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday')],
+    dtype=object,
+)
+_COMPARACOES = {
+    OperadorFiltro.eq: operator.eq, OperadorFiltro.neq: operator.ne,
+    OperadorFiltro.gt: operator.gt, OperadorFiltro.gte: operator.ge,
+    OperadorFiltro.lt: operator.lt, OperadorFiltro.lte: operator.le,
+}
+
+
+def _traducao(ids, valores):
+    """
+    Tabela id -> código do valor, e o dicionário de valores (código = posição).
+    O último elemento da tabela fica -1: o id -1 (NULL em vendas) cai nele.
+    """
+    codigos = {}
+    mapa = np.full(max(ids, default=0) + 2, -1, dtype=np.int32)
+    for i, valor in zip(ids, valores):
+        mapa[i] = codigos.setdefault(valor, len(codigos))
+    return mapa, np.array(list(codigos), dtype=object)
+
+
+def _like_regex(padrao):
+    """Padrão do LIKE (% e _, com \\ de escape) como regex."""
+    partes, escapar = [], False
+    for ch in padrao:
+        if escapar:
+            partes.append(re.escape(ch))
+            escapar = False
+        elif ch == '\\':
+            escapar = True
+        elif ch == '%':
+            partes.append('.*')
+        elif ch == '_':
+            partes.append('.')
+        else:
+            partes.append(re.escape(ch))
+    return re.compile(''.join(partes), re.DOTALL)
+
+
+def _valores_aceitos(valores, operador, valor, fim=None):
+    """Máscara sobre o dicionário da dimensão: quais valores passam no filtro (NULL nunca passa)."""
+    operador = OperadorFiltro(operador)
+    try:
+        if valores.dtype != object:
+            # Datas/horas e números: comparação vetorizada
+            escalar = np.datetime64 if valores.dtype.kind == 'M' else (lambda v: v)
+            if operador in _COMPARACOES:
+                return _COMPARACOES[operador](valores, escalar(valor))
+            if operador == OperadorFiltro.between:
+                return (valores >= escalar(valor)) & (valores <= escalar(fim))
+            if operador in (OperadorFiltro.in_, OperadorFiltro.not_in):
+                dentro = np.isin(valores, np.array([escalar(v) for v in valor]))
+                return dentro if operador == OperadorFiltro.in_ else ~dentro
+            raise ValueError(f"Operador '{operador.value}' não se aplica a este campo")
+
+        # Textos: um teste por valor distinto (o dicionário é pequeno)
+        if operador in _COMPARACOES:
+            comparar = _COMPARACOES[operador]
+            teste = lambda v: comparar(v, valor)
+        elif operador == OperadorFiltro.between:
+            teste = lambda v: valor <= v <= fim
+        elif operador == OperadorFiltro.in_:
+            teste = lambda v: v in valor
+        elif operador == OperadorFiltro.not_in:
+            teste = lambda v: v not in valor
+        else:
+            regex = _like_regex(valor)
+            teste = lambda v: regex.fullmatch(v) is not None
+        return np.array([v is not None and bool(teste(v)) for v in valores], dtype=bool)
+    except TypeError:
+        raise ValueError(f"Valor inválido para o filtro: {valor!r}")
+
+
+def _postos(valores):
+    """Posição de cada valor do dicionário na ordenação (NaN = NULL)."""
+    postos = np.full(len(valores), np.nan)
+    if valores.dtype == object:
+        ordem = sorted((i for i, v in enumerate(valores) if v is not None), key=lambda i: valores[i])
+        postos[ordem] = np.arange(len(ordem))
+    else:
+        postos[np.argsort(valores, kind='stable')] = np.arange(len(valores))
+    return postos
+
+
+class Snapshot:
+    """Fotografia imutável das vendas em colunas. Cada atualização gera uma nova."""
+
+    def __init__(self, colunas, textos, tabelas):
+        self.colunas = colunas   # nome -> ndarray (uma posição por venda)
+        self.textos = textos     # 'status'/'origem' -> valores (código = posição)
+        self.tabelas = tabelas   # 'lojas'/'sub_marcas'/'canais' -> {atributo: (mapa id->código, valores)}
+        self.linhas = len(colunas['id'])
+        self.ultimo_id = int(colunas['id'][-1]) if self.linhas else 0
+        self.dia_minimo = int(colunas['dia'].min()) if self.linhas else 0
+        self.dia_maximo = int(colunas['dia'].max()) if self.linhas else -1
+        self.memoria_bytes = sum(coluna.nbytes for coluna in colunas.values())
+        self._data = None  # dicionário de created_at, montado na primeira pergunta que usa `data`
+
+    def dimensao(self, d):
+        """(código de cada venda, valores) da dimensão. Código -1 = a venda fica fora do JOIN."""
+        c = self.colunas
+        if d in DIMENSOES_CADASTRO:
+            coluna, tabela, atributo = DIMENSOES_CADASTRO[d]
+            mapa, valores = self.tabelas[tabela][atributo]
+            ids = c[coluna]
+            return mapa[np.where(ids < len(mapa) - 1, ids, -1)], valores
+        if d == Dimensao.status_venda:
+            return c['status'], np.array(self.textos['status'], dtype=object)
+        if d == Dimensao.origem_venda:
+            return c['origem'], np.array(self.textos['origem'], dtype=object)
+        if d == Dimensao.hora_dia:
+            return c['hora'], np.arange(24)
+        if d == Dimensao.data:
+            if self._data is None:
+                valores, codigos = np.unique(c['data'], return_inverse=True)
+                self._data = (codigos.reshape(-1), valores.astype('datetime64[us]'))
+            return self._data
+
+        dias = np.arange(self.dia_minimo, self.dia_maximo + 1)
+        codigos = c['dia'] - self.dia_minimo
+        if d == Dimensao.dia:
+            return codigos, _EPOCA + dias
+        if d == Dimensao.dia_semana:
+            # 1970-01-01 foi uma quinta-feira (posição 3 a partir de segunda)
+            return ((dias + 3) % 7)[codigos], _DIAS_SEMANA
+        if d == Dimensao.mes:
+            meses, codigo_mes = np.unique((_EPOCA + dias).astype('datetime64[M]'), return_inverse=True)
+            return codigo_mes.reshape(-1)[codigos], np.array([str(m) for m in meses], dtype=object)
+        raise ValueError(f"Dimensão não suportada pelo motor colunar: {d.value}")
+
+
+class MotorColunar:
+    """Guarda o Snapshot atual e responde QueryRequest a partir dele. Thread-safe."""
+
+    def __init__(self):
+        self._snapshot = None
+        self._lock_atualizacao = threading.Lock()
+        self._codigos_texto = {nome: {} for nome in COLUNAS_TEXTO}
+        self._lock = threading.Lock()
+        self._contadores = {'perguntas': 0, 'atualizacoes': 0, 'recargas_completas': 0}
+        self._tempo = {'perguntas': 0.0, 'ultima_carga': 0.0}
+        self._atualizado_em = None
+        self._recarregado_em = None
+
+    @property
+    def pronto(self):
+        return self._snapshot is not None
+
+    # --- carga ---
+
+    def _ler_vendas(self, conn, desde_id):
+        """Colunas das vendas com id > desde_id, lidas de um cursor no servidor em blocos."""
+        blocos = {nome: [] for nome in TIPOS_COLUNAS}
+        with conn.cursor(name='motor_colunar_vendas') as cursor:
+            cursor.itersize = BLOCO_LINHAS
+            cursor.execute(SQL_VENDAS, (desde_id,))
+            while True:
+                linhas = cursor.fetchmany(BLOCO_LINHAS)
+                if not linhas:
+                    break
+                valores = list(zip(*linhas))
+                posicao = 0
+                for nome, tipo in COLUNAS_CHAVE:
+                    blocos[nome].append(np.array(valores[posicao], dtype=tipo))
+                    posicao += 1
+                for nome in COLUNAS_TEXTO:
+                    codigos = self._codigos_texto[nome]
+                    blocos[nome].append(np.fromiter(
+                        (codigos.setdefault(v, len(codigos)) for v in valores[posicao]),
+                        dtype=np.int16, count=len(linhas)
+                    ))
+                    posicao += 1
+                for nome in COLUNAS_MEDIDA:
+                    blocos[nome].append(np.array(valores[posicao], dtype=np.float64))  # None -> NaN
+                    posicao += 1
+
+        return {nome: np.concatenate(partes) if partes else np.empty(0, dtype=TIPOS_COLUNAS[nome])
+                for nome, partes in blocos.items()}
+
+    @staticmethod
+    def _ler_tabelas(conn):
+        """Lojas (com a marca), sub-marcas e canais como tabelas de tradução id -> código."""
+        with conn.cursor() as cursor:
+            cursor.execute(SQL_LOJAS)
+            lojas = cursor.fetchall()
+            cursor.execute(SQL_SUB_MARCAS)
+            sub_marcas = cursor.fetchall()
+            cursor.execute(SQL_CANAIS)
+            canais = cursor.fetchall()
+
+        ids_lojas = [l[0] for l in lojas]
+        com_marca = [l for l in lojas if l[5] is not None]
+        return {
+            'lojas': {
+                'nome': _traducao(ids_lojas, [l[1] for l in lojas]),
+                'cidade': _traducao(ids_lojas, [l[2] for l in lojas]),
+                'bairro': _traducao(ids_lojas, [l[3] for l in lojas]),
+                'estado': _traducao(ids_lojas, [l[4] for l in lojas]),
+                'marca': _traducao([l[0] for l in com_marca], [l[6] for l in com_marca]),
+            },
+            'sub_marcas': {'nome': _traducao([s[0] for s in sub_marcas], [s[1] for s in sub_marcas])},
+            'canais': {
+                'nome': _traducao([c[0] for c in canais], [c[1] for c in canais]),
+                'tipo': _traducao([c[0] for c in canais], [c[2] for c in canais]),
+            },
+        }
+
+    def atualizar(self, conn, completa=False):
+        """
+        Lê as vendas novas (id > último carregado) e os cadastros, e troca o
+        snapshot. Com `completa` (ou na primeira vez) lê tudo de novo; também
+        quando as vendas com id até o último carregado não batem mais com o
+        snapshot (comitadas fora da ordem de id, ou apagadas).
+        Retorna quantas vendas entraram.
+        """
+        with self._lock_atualizacao:
+            inicio = time.perf_counter()
+            atual = None if completa else self._snapshot
+            try:
+                with conn.cursor() as cursor:
+                    # Vendas e cadastros do mesmo instante
+                    cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY")
+                    if atual is not None:
+                        cursor.execute("SELECT COUNT(*) FROM sales WHERE id <= %s", (atual.ultimo_id,))
+                        if cursor.fetchone()[0] != atual.linhas:
+                            atual = None
+                if atual is None:
+                    self._codigos_texto = {nome: {} for nome in COLUNAS_TEXTO}
+                novas = self._ler_vendas(conn, atual.ultimo_id if atual else 0)
+                tabelas = self._ler_tabelas(conn)
+            finally:
+                conn.rollback()
+
+            novas_linhas = len(novas['id'])
+            colunas = novas if atual is None else {
+                nome: np.concatenate((atual.colunas[nome], coluna)) for nome, coluna in novas.items()
+            }
+            textos = {nome: list(codigos) for nome, codigos in self._codigos_texto.items()}
+            self._snapshot = Snapshot(colunas, textos, tabelas)
+
+            with self._lock:
+                self._contadores['atualizacoes'] += 1
+                self._tempo['ultima_carga'] = time.perf_counter() - inicio
+                self._atualizado_em = time.time()
+                if atual is None:
+                    self._contadores['recargas_completas'] += 1
+                    self._recarregado_em = self._atualizado_em
+            return novas_linhas
+
+    # --- perguntas ---
+
+    def pode_responder(self, request: QueryRequest):
+        """O snapshot está carregado e a pergunta é toda no grão da venda?"""
+        campos = {Dimensao(d) for d in request.dimensoes} | {Dimensao(f.campo) for f in request.filtros}
+        return (
+            self._snapshot is not None
+            and request.comparacao is None
+            and request.metricas is None
+            and Metrica(request.metrica) in METRICAS_SUPORTADAS
+            and campos <= DIMENSOES_SUPORTADAS
+        )
+
+    def responder(self, request: QueryRequest):
+        """Linhas da resposta como dicts (mesmas colunas do query_builder: metrica + dimensões)."""
+        snap = self._snapshot
+        if snap is None:
+            raise RuntimeError("Motor colunar ainda não carregou as vendas.")
+        inicio = time.perf_counter()
+        # Mesma validação e conversão de valores da query SQL
+        parametros = query_builder.parametros_da_requisicao(request)
+        dims = [Dimensao(d) for d in request.dimensoes]
+        if request.ordenar_por != 'metrica' and request.ordenar_por not in {d.value for d in dims}:
+            raise ValueError(f"Campo de ordenação inválido: {request.ordenar_por}")
+
+        cache_dims = {}
+        def dimensao(d):
+            if d not in cache_dims:
+                cache_dims[d] = snap.dimensao(d)
+            return cache_dims[d]
+
+        # --- WHERE: JOINs que excluem a venda (código -1) e filtros ---
+        mascara = np.ones(snap.linhas, dtype=bool)
+        for d in set(dims) | {Dimensao(f.campo) for f in request.filtros}:
+            mascara &= dimensao(d)[0] >= 0
+        for i, f in enumerate(request.filtros):
+            codigos, valores = dimensao(Dimensao(f.campo))
+            aceitos = _valores_aceitos(valores, f.operador, parametros[f"filtro_{i}"], parametros.get(f"filtro_{i}_fim"))
+            mascara &= np.append(aceitos, False)[codigos]  # código -1 cai no False do fim
+        linhas = np.flatnonzero(mascara)
+
+        resultado = []
+        if len(linhas):
+            resultado = self._agrupar(snap, request, dims, dimensao, linhas)
+
+        with self._lock:
+            self._contadores['perguntas'] += 1
+            self._tempo['perguntas'] += time.perf_counter() - inicio
+        return resultado
+
+    def _agrupar(self, snap, request, dims, dimensao, linhas):
+        """GROUP BY, métrica, ORDER BY e LIMIT sobre as vendas selecionadas."""
+        # --- GROUP BY: códigos das dimensões numa chave inteira ---
+        codigos = [dimensao(d)[0][linhas].astype(np.int64) for d in dims]
+        tamanhos = [len(dimensao(d)[1]) for d in dims]
+        if np.prod([float(t) for t in tamanhos]) < 2 ** 62:
+            chave = np.zeros(len(linhas), dtype=np.int64)
+            for codigo, tamanho in zip(codigos, tamanhos):
+                chave = chave * tamanho + codigo
+            _, primeira, grupo = np.unique(chave, return_index=True, return_inverse=True)
+        else:
+            _, primeira, grupo = np.unique(np.stack(codigos, axis=1), axis=0, return_index=True, return_inverse=True)
+        grupo = grupo.reshape(-1)
+        n_grupos = len(primeira)
+
+        valores, inteiro = self._metrica(snap, Metrica(request.metrica), linhas, grupo, n_grupos)
+
+        # --- ORDER BY (NULL por último no ASC e primeiro no DESC, como no Postgres) e LIMIT ---
+        if request.ordenar_por == 'metrica':
+            chave_ordem = valores
+        else:
+            posicao = [d.value for d in dims].index(request.ordenar_por)
+            chave_ordem = _postos(dimensao(dims[posicao])[1])[codigos[posicao][primeira]]
+        nulos = np.isnan(chave_ordem)
+        if Ordem(request.ordem) == Ordem.desc:
+            ordem = np.lexsort((-chave_ordem, ~nulos))
+        else:
+            ordem = np.lexsort((chave_ordem, nulos))
+        ordem = ordem[:max(request.limite, 0)]
+
+        colunas = {'metrica': [
+            None if np.isnan(v) else (int(v) if inteiro else v) for v in valores[ordem].tolist()
+        ]}
+        for d, codigo in zip(dims, codigos):
+            colunas[d.value] = dimensao(d)[1][codigo[primeira][ordem]].tolist()
+        return [dict(zip(colunas, linha)) for linha in zip(*colunas.values())]
+
+    @staticmethod
+    def _metrica(snap, metrica, linhas, grupo, n_grupos):
+        """(valor por grupo em float, NaN = NULL; se é contagem inteira)."""
+        c = snap.colunas
+
+        def contar(pesos=None):
+            return np.bincount(grupo, weights=pesos, minlength=n_grupos)
+
+        def soma_e_contagem(nome):
+            x = c[nome][linhas]
+            presentes = ~np.isnan(x)
+            return contar(np.where(presentes, x, 0.0)), contar(presentes)
+
+        def soma(nome):
+            total, n = soma_e_contagem(nome)
+            return np.where(n > 0, total, np.nan)
+
+        def media(nome):
+            total, n = soma_e_contagem(nome)
+            return np.divide(total, n, out=np.full(n_grupos, np.nan), where=n > 0)
+
+        def cancelados():
+            codigo = {v: i for i, v in enumerate(snap.textos['status'])}.get('CANCELLED')
+            if codigo is None:
+                return np.zeros(n_grupos)
+            return contar(c['status'][linhas] == codigo)
+
+        if metrica == Metrica.faturamento_total:
+            return soma('total_amount'), False
+        if metrica == Metrica.ticket_medio:
+            return media('total_amount'), False
+        if metrica == Metrica.total_pedidos:
+            return contar().astype(np.float64), True
+        if metrica == Metrica.total_pedidos_cancelados:
+            return cancelados(), True
+        if metrica == Metrica.taxa_cancelamento:
+            return cancelados() * 100.0 / contar(), False
+        if metrica == Metrica.total_descontos:
+            return soma('total_discount'), False
+        if metrica == Metrica.total_taxa_entrega:
+            return soma('delivery_fee'), False
+        if metrica == Metrica.tempo_preparo_medio_min:
+            return media('production_seconds') / 60.0, False
+        if metrica == Metrica.tempo_entrega_medio_min:
+            return media('delivery_seconds') / 60.0, False
+        if metrica == Metrica.total_clientes_unicos:
+            clientes = c['cliente'][linhas]
+            com_cliente = clientes >= 0
+            if not com_cliente.any():
+                return np.zeros(n_grupos), True
+            base = int(clientes.max()) + 1
+            pares = np.unique(grupo[com_cliente].astype(np.int64) * base + clientes[com_cliente])
+            return np.bincount(pares // base, minlength=n_grupos).astype(np.float64), True
+        raise ValueError(f"Métrica não suportada pelo motor colunar: {metrica.value}")
+
+    def estatisticas(self):
+        snap = self._snapshot
+        with self._lock:
+            perguntas = self._contadores['perguntas']
+            return {
+                **self._contadores,
+                'pronto': snap is not None,
+                'vendas': snap.linhas if snap else 0,
+                'ultimo_id': snap.ultimo_id if snap else None,
+                'memoria_mb': snap.memoria_bytes / 2 ** 20 if snap else 0,
+                'tempo_medio_ms': 1000 * self._tempo['perguntas'] / perguntas if perguntas else 0,
+                'ultima_carga_ms': 1000 * self._tempo['ultima_carga'],
+                'atualizado_em': self._atualizado_em,
+                'recarregado_em': self._recarregado_em,
+            }
+
+
+def iniciar_atualizacao_em_segundo_plano(motor, db_config, intervalo_segundos=ATUALIZACAO_SEGUNDOS,
+                                         recarga_completa_segundos=RECARGA_COMPLETA_SEGUNDOS):
+    """
+    Sobe uma thread daemon que carrega o snapshot e depois busca as vendas
+    novas a cada `intervalo_segundos` (recarga completa a cada
+    `recarga_completa_segundos`). Usa uma conexão própria, fora do pool.
+    """
+    def _loop():
+        conn = None
+        ultima_completa = -float('inf')
+        while True:
+            try:
+                if conn is None or conn.closed:
+                    conn = psycopg2.connect(**db_config)
+                completa = not motor.pronto or time.monotonic() - ultima_completa > recarga_completa_segundos
+                novas = motor.atualizar(conn, completa=completa)
+                if completa:
+                    ultima_completa = time.monotonic()
+                    print(f"Motor colunar carregado: {motor.estatisticas()['vendas']:,} vendas")
+                elif novas:
+                    print(f"Motor colunar: {novas:,} vendas novas")
+            except Exception as e:
+                print(f"ERRO [motor-colunar]: {e}", file=sys.stderr)
+                if conn is not None and not conn.closed:
+                    conn.close()
+                conn = None
+            time.sleep(intervalo_segundos)
+
+    thread = threading.Thread(target=_loop, name='motor-colunar', daemon=True)
+    thread.start()
+    return thread
@@ -1,5 +1,17 @@
--- 1. Índice para o filtro de DATA e HORA (o mais importante!)
-CREATE INDEX IF NOT EXISTS idx_sales_created_at_hora_dia ON sales (EXTRACT(HOUR FROM created_at), EXTRACT(ISODOW FROM created_at));
+-- 1. Índices para os filtros de DATA, HORA e DIA DA SEMANA (o mais importante!)
+-- Colunas geradas a partir de created_at (já existem em bancos criados com o
+-- database-schema.sql atual). Com elas os filtros viram range scans em índices
+-- compostos junto com loja/canal/status, em vez de um EXTRACT por linha.
+ALTER TABLE sales
+    ADD COLUMN IF NOT EXISTS sale_date DATE GENERATED ALWAYS AS (created_at::date) STORED,
+    ADD COLUMN IF NOT EXISTS sale_hour SMALLINT GENERATED ALWAYS AS (EXTRACT(HOUR FROM created_at)::smallint) STORED,
+    ADD COLUMN IF NOT EXISTS sale_isodow SMALLINT GENERATED ALWAYS AS (EXTRACT(ISODOW FROM created_at)::smallint) STORED;
+
+DROP INDEX IF EXISTS idx_sales_created_at_hora_dia;
+CREATE INDEX IF NOT EXISTS idx_sales_data_loja_canal_status
+    ON sales (sale_date, store_id, channel_id, sale_status_desc) INCLUDE (value_paid, customer_id);
+CREATE INDEX IF NOT EXISTS idx_sales_hora_dia_semana_loja_canal
+    ON sales (sale_hour, sale_isodow, store_id, channel_id, sale_status_desc) INCLUDE (value_paid, customer_id);
 
 -- 2. Índice para o filtro de NOME DO CANAL
 CREATE INDEX IF NOT EXISTS idx_channels_name ON channels (name);
@@ -13,3 +25,26 @@ CREATE INDEX IF NOT EXISTS idx_sales_channel_id ON sales (channel_id);
 CREATE INDEX IF NOT EXISTS idx_product_sales_sale_id ON product_sales (sale_id);
 CREATE INDEX IF NOT EXISTS idx_product_sales_product_id ON product_sales (product_id);
 CREATE INDEX IF NOT EXISTS idx_stores_sub_brand_id ON stores (sub_brand_id);
+
+-- 5. Created_at da venda nas tabelas filhas (sale_created_at)
+-- No database-schema.sql atual é a chave de partição (mensal) das filhas, e o
+-- query_builder a usa nos JOINs e na poda de partições. Bancos criados antes
+-- não são particionados; aqui as filhas só ganham a coluna preenchida, para
+-- que as mesmas queries rodem neles. Particionar um banco existente exige
+-- recriar as tabelas (database-schema.sql) e recarregar os dados.
+ALTER TABLE product_sales ADD COLUMN IF NOT EXISTS sale_created_at TIMESTAMP;
+ALTER TABLE item_product_sales ADD COLUMN IF NOT EXISTS sale_created_at TIMESTAMP;
+ALTER TABLE delivery_sales ADD COLUMN IF NOT EXISTS sale_created_at TIMESTAMP;
+ALTER TABLE delivery_addresses ADD COLUMN IF NOT EXISTS sale_created_at TIMESTAMP;
+ALTER TABLE payments ADD COLUMN IF NOT EXISTS sale_created_at TIMESTAMP;
+
+UPDATE product_sales ps SET sale_created_at = s.created_at
+FROM sales s WHERE s.id = ps.sale_id AND ps.sale_created_at IS NULL;
+UPDATE item_product_sales ips SET sale_created_at = ps.sale_created_at
+FROM product_sales ps WHERE ps.id = ips.product_sale_id AND ips.sale_created_at IS NULL;
+UPDATE delivery_sales ds SET sale_created_at = s.created_at
+FROM sales s WHERE s.id = ds.sale_id AND ds.sale_created_at IS NULL;
+UPDATE delivery_addresses da SET sale_created_at = s.created_at
+FROM sales s WHERE s.id = da.sale_id AND da.sale_created_at IS NULL;
+UPDATE payments p SET sale_created_at = s.created_at
+FROM sales s WHERE s.id = p.sale_id AND p.sale_created_at IS NULL;
@@ -1,10 +1,23 @@
 
 
+import threading
+import time
+from collections import OrderedDict
+from datetime import date, datetime
+
 from sqlalchemy import (
     Table, Column, Integer, String, Float, DateTime, Boolean, MetaData,
-    func, case, select, and_, Numeric, Date, CHAR
+    func, case, select, and_, or_, true, null, union_all, Numeric, Date, CHAR, SmallInteger, BigInteger,
+    asc, desc, literal_column, bindparam, cast, Interval
+)
+from sqlalchemy.types import NullType
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.sql.expression import Join
+from sqlalchemy.sql.util import find_tables
+from . import rollup
+from .schema import (
+    QueryRequest, Metrica, Dimensao, Filtro, OperadorFiltro, Ordem, ModoContagem, UnidadeDeslocamento
 )
-from .schema import QueryRequest, Metrica, Dimensao, Filtro, OperadorFiltro
 
 # --- 1. Definição do Schema do Banco (Espelho do database-schema.sql) ---
 metadata = MetaData()
@@ -61,6 +74,10 @@ t_sales = Table('sales', metadata,
     Column('customer_id', Integer),
     Column('channel_id', Integer),
     Column('created_at', DateTime),
+    # Colunas geradas (STORED) a partir de created_at, indexadas com loja/canal/status
+    Column('sale_date', Date),
+    Column('sale_hour', SmallInteger),
+    Column('sale_isodow', SmallInteger),
     Column('sale_status_desc', String),
     Column('total_amount_items', Numeric),
     Column('total_discount', Numeric),
@@ -73,15 +90,18 @@ t_sales = Table('sales', metadata,
     Column('delivery_seconds', Integer),
     Column('origin', String),
 )
+# As tabelas filhas guardam o created_at da venda (chave de partição, ver seção 3.1)
 t_product_sales = Table('product_sales', metadata,
     Column('id', Integer, primary_key=True),
     Column('sale_id', Integer),
+    Column('sale_created_at', DateTime),
     Column('product_id', Integer),
     Column('quantity', Float),
 )
 t_item_product_sales = Table('item_product_sales', metadata,
     Column('id', Integer, primary_key=True),
     Column('product_sale_id', Integer),
+    Column('sale_created_at', DateTime),
     Column('item_id', Integer),
     Column('option_group_id', Integer),
     Column('additional_price', Float),
@@ -89,12 +109,14 @@ t_item_product_sales = Table('item_product_sales', metadata,
 t_delivery_sales = Table('delivery_sales', metadata,
     Column('id', Integer, primary_key=True),
     Column('sale_id', Integer),
+    Column('sale_created_at', DateTime),
     Column('courier_type', String),
     Column('delivery_type', String),
 )
 t_delivery_addresses = Table('delivery_addresses', metadata,
     Column('id', Integer, primary_key=True),
     Column('sale_id', Integer),
+    Column('sale_created_at', DateTime),
     Column('neighborhood', String),
     Column('city', String),
 )
@@ -105,9 +127,47 @@ t_payment_types = Table('payment_types', metadata,
 t_payments = Table('payments', metadata,
     Column('id', Integer, primary_key=True),
     Column('sale_id', Integer),
+    Column('sale_created_at', DateTime),
     Column('payment_type_id', Integer),
 )
 
+# Tabelas de rollup (ver rollup.py): mesmas medidas, com e sem a hora na chave
+def _rollup_table(name, com_hora):
+    colunas_hora = [Column('sale_hour', SmallInteger)] if com_hora else []
+    return Table(name, metadata,
+        Column('sale_date', Date),
+        *colunas_hora,
+        Column('sale_isodow', SmallInteger),
+        Column('store_id', Integer),
+        Column('sub_brand_id', Integer),
+        Column('channel_id', Integer),
+        Column('sale_status_desc', String),
+        Column('sales_count', Integer),
+        Column('value_paid_sum', Numeric),
+        Column('total_amount_sum', Numeric),
+        Column('discount_sum', Numeric),
+        Column('delivery_fee_sum', Numeric),
+        Column('production_seconds_sum', BigInteger),
+        Column('production_count', Integer),
+        Column('delivery_seconds_sum', BigInteger),
+        Column('delivery_count', Integer),
+    )
+
+t_sales_rollup_hourly = _rollup_table('sales_rollup_hourly', com_hora=True)
+t_sales_rollup_daily = _rollup_table('sales_rollup_daily', com_hora=False)
+
+# Sketches HyperLogLog dos clientes por bucket diário (uma linha por registrador)
+t_sales_rollup_hll = Table('sales_rollup_hll', metadata,
+    Column('sale_date', Date),
+    Column('sale_isodow', SmallInteger),
+    Column('store_id', Integer),
+    Column('sub_brand_id', Integer),
+    Column('channel_id', Integer),
+    Column('sale_status_desc', String),
+    Column('registrador', SmallInteger),
+    Column('rho', SmallInteger),
+)
+
 # --- 2. Mapas de Tradução (O "Cérebro") ---
 
 # Mapeia a 'Metrica' (amigável) para a coluna/função SQL (SQLAlchemy)
@@ -152,152 +212,904 @@ DIMENSION_MAP = {
     Dimensao.cidade_entrega: t_delivery_addresses.c.city,
     Dimensao.tipo_entregador: t_delivery_sales.c.courier_type,
     Dimensao.tipo_entrega: t_delivery_sales.c.delivery_type,
-    Dimensao.dia: func.date(t_sales.c.created_at),
-    Dimensao.dia_semana: func.to_char(t_sales.c.created_at, 'Day'),
-    Dimensao.mes: func.to_char(t_sales.c.created_at, 'YYYY-MM'),
-    Dimensao.hora_dia: func.extract('hour', t_sales.c.created_at),
+    Dimensao.dia: t_sales.c.sale_date,
+    Dimensao.dia_semana: func.to_char(t_sales.c.sale_date, 'Day'),
+    Dimensao.mes: func.to_char(t_sales.c.sale_date, 'YYYY-MM'),
+    Dimensao.hora_dia: t_sales.c.sale_hour,
     Dimensao.data: t_sales.c.created_at 
 }
 
+# Mesmas traduções, mas lendo das tabelas de rollup.
+# Só entram as métricas que são somas/contagens (ou razões entre elas).
+def _rollup_metric_map(t):
+    cancelados = func.sum(case((t.c.sale_status_desc == 'CANCELLED', t.c.sales_count), else_=0))
+    pedidos = func.nullif(func.sum(t.c.sales_count), 0)
+    return {
+        Metrica.faturamento_total: func.sum(t.c.total_amount_sum),
+        Metrica.ticket_medio: func.sum(t.c.total_amount_sum) / pedidos,
+        Metrica.total_pedidos: func.sum(t.c.sales_count),
+        Metrica.total_pedidos_cancelados: cancelados,
+        Metrica.taxa_cancelamento: cancelados * 100.0 / pedidos,
+        Metrica.total_descontos: func.sum(t.c.discount_sum),
+        Metrica.total_taxa_entrega: func.sum(t.c.delivery_fee_sum),
+        Metrica.tempo_preparo_medio_min: (
+            func.sum(t.c.production_seconds_sum) / func.nullif(func.sum(t.c.production_count), 0) / 60.0
+        ),
+        Metrica.tempo_entrega_medio_min: (
+            func.sum(t.c.delivery_seconds_sum) / func.nullif(func.sum(t.c.delivery_count), 0) / 60.0
+        ),
+    }
+
+def _rollup_dimension_map(t):
+    dim_map = {
+        Dimensao.loja_nome: t_stores.c.name,
+        Dimensao.cidade_loja: t_stores.c.city,
+        Dimensao.bairro_loja: t_stores.c.district,
+        Dimensao.estado_loja: t_stores.c.state,
+        Dimensao.marca_nome: t_brands.c.name,
+        Dimensao.sub_marca_nome: t_sub_brands.c.name,
+        Dimensao.canal_nome: t_channels.c.name,
+        Dimensao.tipo_canal: t_channels.c.type,
+        Dimensao.status_venda: t.c.sale_status_desc,
+        Dimensao.dia: t.c.sale_date,
+        Dimensao.dia_semana: func.to_char(t.c.sale_date, 'Day'),
+        Dimensao.mes: func.to_char(t.c.sale_date, 'YYYY-MM'),
+    }
+    if 'sale_hour' in t.c:
+        dim_map[Dimensao.hora_dia] = t.c.sale_hour
+    return dim_map
+
+ROLLUP_METRIC_MAPS = {t: _rollup_metric_map(t) for t in (t_sales_rollup_hourly, t_sales_rollup_daily)}
+ROLLUP_DIMENSION_MAPS = {
+    t: _rollup_dimension_map(t) for t in (t_sales_rollup_hourly, t_sales_rollup_daily, t_sales_rollup_hll)
+}
+
+STORE_FIELDS = {'loja_nome', 'cidade_loja', 'bairro_loja', 'estado_loja', 'marca_nome'}
+
+
+# --- 3. Grafo das Tabelas (planejamento dos JOINs) ---
+# Cada tabela aponta para a tabela "mãe" pela qual é alcançada a partir de `sales`:
+#   tabela: (mãe, coluna na mãe, coluna na tabela, cardinalidade, opcional)
+# cardinalidade = linhas desta tabela por linha da mãe:
+#   'um'     -> no máximo uma (lookup N:1): o JOIN não multiplica as linhas da mãe
+#   'muitos' -> várias (tabela filha 1:N): o JOIN multiplica as linhas da mãe
+# opcional = a mãe pode não ter linha nesta tabela (LEFT JOIN).
+# delivery_* não têm UNIQUE(sale_id) no schema, então contam como 'muitos'.
+# A sub-marca é a da loja (stores.sub_brand_id), como nos painéis e no rollup:
+# o gerador de dados não preenche sales.sub_brand_id.
+GRAFO_TABELAS = {
+    t_stores: (t_sales, t_sales.c.store_id, t_stores.c.id, 'um', False),
+    t_brands: (t_stores, t_stores.c.brand_id, t_brands.c.id, 'um', False),
+    t_sub_brands: (t_stores, t_stores.c.sub_brand_id, t_sub_brands.c.id, 'um', False),
+    t_channels: (t_sales, t_sales.c.channel_id, t_channels.c.id, 'um', False),
+    t_product_sales: (t_sales, t_sales.c.id, t_product_sales.c.sale_id, 'muitos', False),
+    t_products: (t_product_sales, t_product_sales.c.product_id, t_products.c.id, 'um', False),
+    t_categories: (t_products, t_products.c.category_id, t_categories.c.id, 'um', False),
+    t_item_product_sales: (t_product_sales, t_product_sales.c.id, t_item_product_sales.c.product_sale_id, 'muitos', True),
+    t_items: (t_item_product_sales, t_item_product_sales.c.item_id, t_items.c.id, 'um', True),
+    t_option_groups: (t_item_product_sales, t_item_product_sales.c.option_group_id, t_option_groups.c.id, 'um', True),
+    t_payments: (t_sales, t_sales.c.id, t_payments.c.sale_id, 'muitos', False),
+    t_payment_types: (t_payments, t_payments.c.payment_type_id, t_payment_types.c.id, 'um', False),
+    t_delivery_sales: (t_sales, t_sales.c.id, t_delivery_sales.c.sale_id, 'muitos', True),
+    t_delivery_addresses: (t_sales, t_sales.c.id, t_delivery_addresses.c.sale_id, 'muitos', True),
+}
+
+
+# --- 3.1 Poda de Partições ---
+# `sales` e as tabelas filhas são particionadas por mês do created_at da venda
+# (database-schema.sql). O Postgres só descarta partições por condições sobre
+# a chave de partição, e `sale_date` é uma coluna gerada: um filtro de `dia`
+# sozinho abriria todos os meses. Por isso cada filtro de tempo ganha uma
+# condição sobre a chave de cada tabela particionada da query.
+CHAVE_PARTICAO = {
+    t_sales: t_sales.c.created_at,
+    t_product_sales: t_product_sales.c.sale_created_at,
+    t_item_product_sales: t_item_product_sales.c.sale_created_at,
+    t_delivery_sales: t_delivery_sales.c.sale_created_at,
+    t_delivery_addresses: t_delivery_addresses.c.sale_created_at,
+    t_payments: t_payments.c.sale_created_at,
+}
+
+
+def _tabelas_com_join_interno(from_):
+    """
+    Tabelas do FROM alcançadas só por JOIN interno. Uma condição no WHERE
+    sobre o lado opcional de um LEFT JOIN descartaria as linhas sem par,
+    então essas ficam de fora (subqueries também: são podadas por dentro).
+    """
+    if isinstance(from_, Join):
+        tabelas = _tabelas_com_join_interno(from_.left)
+        return tabelas if from_.isouter else tabelas + _tabelas_com_join_interno(from_.right)
+    return [from_] if from_ in CHAVE_PARTICAO else []
+
+
+def _mes(expressao):
+    """Início do mês (timestamp) de uma data/timestamp."""
+    return func.date_trunc(literal_column("'month'"), cast(expressao, DateTime))
+
+
+def _mes_seguinte(expressao):
+    return _mes(expressao) + literal_column("INTERVAL '1 month'")
+
+
+def _faixa_de_meses(chave, f: Filtro, nome: str):
+    """
+    Condições sobre a chave de partição que deixam só os meses que o filtro
+    de tempo pode tocar. Os limites caem no início de um mês, como os das
+    partições: nas que sobram a condição é sempre verdadeira. Um limite exato
+    repetiria a restrição do filtro, e o planner, achando as duas
+    independentes, subestimaria as linhas (e escolheria loops aninhados).
+    """
+    tipo = Date if Dimensao(f.campo) == Dimensao.dia else DateTime
+    valor = cast(bindparam(nome, type_=tipo), tipo)
+    um_dia = literal_column('1', Integer)
+    if f.operador == OperadorFiltro.eq: return [chave >= _mes(valor), chave < _mes_seguinte(valor)]
+    elif f.operador in (OperadorFiltro.gt, OperadorFiltro.gte): return [chave >= _mes(valor)]
+    elif f.operador == OperadorFiltro.lte: return [chave < _mes_seguinte(valor)]
+    elif f.operador == OperadorFiltro.lt:
+        # Para `dia`, o último dia incluído é o anterior (ex.: lt 2026-10-01 não abre outubro)
+        return [chave < _mes_seguinte(valor - um_dia if tipo is Date else valor)]
+    elif f.operador == OperadorFiltro.between:
+        fim = cast(bindparam(f"{nome}_fim", type_=tipo), tipo)
+        return [chave >= _mes(valor), chave < _mes_seguinte(fim)]
+    return []  # in/not_in/neq/like: não viram uma faixa de meses
+
+
+def _podas_particao(request: QueryRequest, tabelas):
+    """
+    Condições de poda para as `tabelas` particionadas, a partir dos filtros de
+    `dia` e `data` da pergunta (com os mesmos parâmetros dos filtros). As
+    filhas têm o created_at da própria venda, então a faixa vale para elas.
+    Um filtro de `data` já é sobre a chave de `sales`.
+    """
+    condicoes = []
+    for i, f in enumerate(request.filtros):
+        campo = Dimensao(f.campo)
+        if campo not in (Dimensao.dia, Dimensao.data):
+            continue
+        for t in tabelas:
+            if not (campo == Dimensao.data and t is t_sales):
+                condicoes += _faixa_de_meses(CHAVE_PARTICAO[t], f, f"filtro_{i}")
+    if request.comparacao is not None:
+        # Os meses de algum dos períodos comparados
+        for t in tabelas:
+            chave = CHAVE_PARTICAO[t]
+            condicoes.append(or_(*(
+                and_(chave >= _mes(inicio), chave < _mes_seguinte(fim)) for inicio, fim in _limites_periodos(request)
+            )))
+    return condicoes
+
+
+# --- 3.2 Comparação entre Períodos ---
+# Com `comparacao`, o período base e os deslocados saem de uma única leitura:
+# cada venda é ligada (JOIN por igualdade, que vira um hash join) aos dias
+# dos períodos que a contêm, e o GROUP BY ganha o período. Uma venda que cai em dois períodos que se sobrepõem conta
+# nos dois. As dimensões de data dos períodos deslocados são alinhadas às da
+# base pela posição no período (o 1º dia com o 1º dia, e assim por diante),
+# para que "1º de outubro" e "1º de setembro" caiam na mesma linha de um
+# gráfico por dia. Somar o deslocamento não serviria: com meses, 30 e 31 de
+# março cairiam os dois em 30 de abril. Os dias de uma comparação mais longa
+# que a base ficam sem par e saem da grade. O `mes` é alinhado somando o
+# deslocamento, que leva o mês inteiro para o mês da base.
+COLUNAS_PERIODO = ('periodo_indice', 'periodo', 'periodo_inicio', 'periodo_fim')
+CAMPOS_DE_DATA = {Dimensao.dia, Dimensao.data, Dimensao.mes}
+
+
+def _limites_periodos(request: QueryRequest):
+    """(início, fim) como parâmetros, um par por período (a base é o 0)."""
+    return [
+        (cast(bindparam(f"periodo_{k}_inicio", type_=Date), Date), cast(bindparam(f"periodo_{k}_fim", type_=Date), Date))
+        for k in range(len(request.comparacao.deslocamentos) + 1)
+    ]
+
+
+def _juntar_periodos(request: QueryRequest, join_chain, dim_map, t):
+    """
+    Liga as linhas de `t` (sales ou rollup) aos períodos da comparação.
+    Retorna (join_chain, dim_map com as datas alinhadas à base, subquery dos
+    períodos (uma linha cada), subquery dos dias dos períodos (a que entra no
+    JOIN), condição do WHERE que restringe a leitura aos períodos).
+    """
+    limites = _limites_periodos(request)
+    inicio_base = limites[0][0]
+    periodos = union_all(*(
+        select(
+            literal_column(str(k), Integer).label('periodo_indice'),
+            cast(bindparam(f"periodo_{k}_rotulo", type_=String), String).label('periodo'),
+            inicio.label('periodo_inicio'),
+            fim.label('periodo_fim'),
+            cast(bindparam(f"periodo_{k}_deslocamento", type_=String), Interval).label('deslocamento'),
+            cast(inicio_base - inicio, Integer).label('deslocamento_dias'),
+        )
+        for k, (inicio, fim) in enumerate(limites)
+    )).subquery('periodos')
+    um_dia = literal_column("INTERVAL '1 day'")
+    dias = select(
+        *periodos.c,
+        cast(func.generate_series(periodos.c.periodo_inicio, periodos.c.periodo_fim, um_dia), Date).label('dia'),
+    ).subquery('dias_periodos')
+
+    dia = t.c.sale_date
+    join_chain = join_chain.join(dias, dia == dias.c.dia)
+    mes_alinhado = func.to_char(cast(dia + dias.c.deslocamento, Date), 'YYYY-MM')
+    dim_map = {**dim_map, Dimensao.dia: cast(dia + dias.c.deslocamento_dias, Date), Dimensao.mes: mes_alinhado}
+    if 'created_at' in t.c:
+        dim_map[Dimensao.data] = t.c.created_at + dias.c.deslocamento_dias * um_dia
+    # Mesmo com o JOIN, o WHERE deixa o planner usar o índice por dia
+    condicao = or_(*(dia.between(inicio, fim) for inicio, fim in limites))
+    return join_chain, dim_map, periodos, dias, condicao
+
+
+def _comparar_periodos(agregado, request: QueryRequest, periodos):
+    """
+    Recebe a query agrupada por (período, dimensões) e devolve, para as
+    `limite` primeiras combinações de dimensões do período base (na ordem
+    pedida), uma linha por período, com `delta` (base - período) e
+    `variacao_percentual` (delta sobre o período) já calculados.
+    """
+    a = agregado.cte('agregado')
+    base = a.alias('agregado_base')
+    dims = [Dimensao(d).value for d in request.dimensoes]
+    ordem = a.c.metrica if request.ordenar_por == "metrica" else a.c[request.ordenar_por]
+    order_func = desc if request.ordem == Ordem.desc else asc
+
+    topo = select(*(a.c[d] for d in dims), func.row_number().over(order_by=order_func(ordem)).label('posicao')) \
+        .where(a.c.periodo_indice == 0) \
+        .order_by(order_func(ordem)) \
+        .limit(bindparam('limite', type_=Integer)) \
+        .subquery('topo')
+
+    def mesmas_dimensoes(x, y):
+        return and_(*(x.c[d].is_not_distinct_from(y.c[d]) for d in dims))
+
+    delta = base.c.metrica - a.c.metrica
+    e_base = periodos.c.periodo_indice == 0
+    # Toda combinação do topo aparece em todos os períodos (métrica nula se não houve venda)
+    grade = topo.join(periodos, true()) \
+        .outerjoin(a, and_(a.c.periodo_indice == periodos.c.periodo_indice, mesmas_dimensoes(a, topo))) \
+        .outerjoin(base, and_(base.c.periodo_indice == 0, mesmas_dimensoes(base, topo)))
+    return select(
+        a.c.metrica, *(topo.c[d] for d in dims),
+        periodos.c.periodo, periodos.c.periodo_inicio, periodos.c.periodo_fim,
+        case((e_base, None), else_=delta).label('delta'),
+        case((e_base, None), else_=delta * 100.0 / func.nullif(a.c.metrica, 0)).label('variacao_percentual'),
+    ).select_from(grade).order_by(topo.c.posicao, periodos.c.periodo_indice)
+
+
+# Métricas que não mudam com linhas repetidas (COUNT DISTINCT): dispensam a subquery dos ramos
+METRICAS_SEM_DUPLICACAO = {Metrica.total_clientes_unicos}
+
+
+def _tabela_da_expressao(expressao):
+    """Tabela (do grafo) de onde vem a coluna/métrica."""
+    tabelas = list({t for t in find_tables(expressao, check_columns=True) if t is t_sales or t in GRAFO_TABELAS})
+    if len(tabelas) != 1:
+        raise ValueError(f"Expressão deve vir de uma única tabela: {expressao}")
+    return tabelas[0]
+
+
+def _caminho_ate_raiz(tabela):
+    """[tabela, mãe, avó, ..., sales]"""
+    caminho = [tabela]
+    while caminho[-1] in GRAFO_TABELAS:
+        caminho.append(GRAFO_TABELAS[caminho[-1]][0])
+    return caminho
+
+
+def _condicao(tabela):
+    mae, coluna_mae, coluna_tabela, _, _ = GRAFO_TABELAS[tabela]
+    return coluna_mae == coluna_tabela
+
+
+def planejar_joins(request: QueryRequest, base, reduzir_ramos=True):
+    """
+    Monta o FROM da pergunta a partir da tabela `base` (o grão da métrica:
+    sales, product_sales ou item_product_sales) sem multiplicar as linhas dela.
+
+    * tabelas acima da base (mães) e lookups 'um' entram com JOIN direto;
+    * um ramo que desce por uma aresta 'muitos' (ex.: produtos de uma venda)
+      vira uma subquery reduzida ao grão de onde ele se pendura: uma linha
+      por (chave, valores das dimensões do ramo), já com os filtros do ramo.
+      Assim SUM(total_amount) conta cada venda uma vez por grupo.
+
+    Com `reduzir_ramos=False` (métricas imunes a duplicação) tudo entra
+    com JOIN direto.
+
+    Retorna (join_chain, dim_map com as colunas a usar, índices dos filtros
+    já aplicados nas subqueries).
+    """
+    caminho_base = _caminho_ate_raiz(base)
+    campos = [(Dimensao(d), None) for d in request.dimensoes]
+    campos += [(Dimensao(f.campo), i) for i, f in enumerate(request.filtros)]
+    if request.comparacao is not None:
+        campos.append((Dimensao.dia, None))  # os períodos são recortados pelo dia da venda
+
+    # Agrupa os campos pelo ramo onde estão: (ponto de apoio no caminho da base, primeira tabela do ramo)
+    subir_ate = 0           # até qual mãe da base é preciso subir
+    ramos = {}              # primeira tabela do ramo -> {'apoio', 'tabelas', 'campos'}
+    for campo, indice_filtro in campos:
+        tabela = _tabela_da_expressao(DIMENSION_MAP[campo])
+        caminho = _caminho_ate_raiz(tabela)
+        apoio = next(t for t in caminho if t in caminho_base)
+        subir_ate = max(subir_ate, caminho_base.index(apoio))
+        if tabela is apoio:
+            continue  # a coluna está no próprio caminho da base
+        descida = caminho[:caminho.index(apoio)]  # da tabela do campo até logo abaixo do apoio
+        ramo = ramos.setdefault(descida[-1], {'apoio': apoio, 'tabelas': set(), 'campos': []})
+        ramo['tabelas'].update(descida)
+        ramo['campos'].append((campo, indice_filtro))
+
+    # FROM: a base e as mães necessárias (cada linha tem uma só mãe: não multiplica)
+    join_chain = base
+    for filha, mae in zip(caminho_base, caminho_base[1:subir_ate + 1]):
+        join_chain = join_chain.join(mae, _condicao(filha))
+
+    dim_map = dict(DIMENSION_MAP)
+    filtros_aplicados = set()
+    for inicio, ramo in ramos.items():
+        # Ordem de JOIN: mães antes das filhas dentro do ramo
+        tabelas = sorted(ramo['tabelas'], key=lambda t: len(_caminho_ate_raiz(t)))
+        reduzir = reduzir_ramos and any(GRAFO_TABELAS[t][3] == 'muitos' for t in tabelas)
+        if not reduzir:
+            for t in tabelas:
+                join_chain = join_chain.join(t, _condicao(t), isouter=GRAFO_TABELAS[t][4])
+            continue
+
+        # Subquery do ramo: uma linha por (chave do apoio, dimensões do ramo)
+        _, coluna_apoio, coluna_chave, _, opcional = GRAFO_TABELAS[inicio]
+        ramo_from = inicio
+        for t in tabelas[1:]:
+            ramo_from = ramo_from.join(t, _condicao(t), isouter=GRAFO_TABELAS[t][4])
+        dims_ramo = list(dict.fromkeys(c for c, i in ramo['campos'] if i is None))
+        filtros_ramo = [i for _, i in ramo['campos'] if i is not None]
+        sub = select(coluna_chave.label('chave'), *(DIMENSION_MAP[d].label(d.value) for d in dims_ramo))
+        sub = sub.select_from(ramo_from).distinct()
+        for i in filtros_ramo:
+            f = request.filtros[i]
+            sub = sub.where(_aplicar_filtro(DIMENSION_MAP[Dimensao(f.campo)], f, f"filtro_{i}"))
+            filtros_aplicados.add(i)
+        # Os filtros de tempo (em `sales`, fora do ramo) também podam as partições do ramo
+        podas = _podas_particao(request, _tabelas_com_join_interno(ramo_from))
+        if podas:
+            sub = sub.where(and_(*podas))
+        sub = sub.subquery(f"ramo_{inicio.name}")
+
+        # Com filtro no ramo, só ficam as linhas que têm correspondência (como no WHERE)
+        join_chain = join_chain.join(sub, coluna_apoio == sub.c.chave, isouter=opcional and not filtros_ramo)
+        for d in dims_ramo:
+            dim_map[d] = sub.c[d.value]
+
+    return join_chain, dim_map, filtros_aplicados
+
+
+# --- 4. O Construtor da Query (A Lógica Principal) ---
+
+def _campos_da_requisicao(request: QueryRequest):
+    """Conjunto com os nomes de todas as dimensões usadas (GROUP BY + filtros)."""
+    dim_fields = set(Dimensao(d).value for d in request.dimensoes)
+    filter_fields = set(Dimensao(f.campo).value for f in request.filtros)
+    return dim_fields, dim_fields.union(filter_fields)
+
+
+def pode_usar_rollup(request: QueryRequest, metrica=None):
+    """A pergunta (ou só a `metrica` dela) pode ser respondida pelas tabelas de rollup?"""
+    _, all_fields = _campos_da_requisicao(request)
+    rollup_fields = set(d.value for d in ROLLUP_DIMENSION_MAPS[t_sales_rollup_hourly])
+    return (
+        Metrica(metrica or request.metrica) in ROLLUP_METRIC_MAPS[t_sales_rollup_hourly]
+        and all_fields <= rollup_fields
+    )
+
+
+def pode_usar_hll(request: QueryRequest, metrica=None):
+    """Clientes únicos aproximados: a pergunta cabe nos sketches HLL (grão diário)?"""
+    _, all_fields = _campos_da_requisicao(request)
+    hll_fields = set(d.value for d in ROLLUP_DIMENSION_MAPS[t_sales_rollup_hll])
+    return (
+        Metrica(metrica or request.metrica) == Metrica.total_clientes_unicos
+        and ModoContagem(request.modo_clientes_unicos) == ModoContagem.aproximado
+        and all_fields <= hll_fields
+    )
+
+
+def metricas_da_requisicao(request: QueryRequest):
+    """As métricas pedidas, na ordem: as de `metricas` ou só a `metrica`."""
+    if request.metricas is None:
+        return [Metrica(request.metrica)]
+    return [Metrica(m) for m in request.metricas]
+
+
+def partes_da_requisicao(request: QueryRequest, usar_rollup: bool = True):
+    """
+    Divide as métricas da pergunta no menor número de SELECTs: [(fonte, grão,
+    métricas)]. Métricas do mesmo grão (a tabela base: sales, product_sales ou
+    item_product_sales) e da mesma fonte dividem o FROM e o GROUP BY. Grãos
+    diferentes não: juntar os itens às vendas repetiria cada venda nas somas.
+    As métricas do rollup vão para a leitura de `sales` quando ela já é
+    necessária (ex.: clientes únicos exatos), em vez de virar outra parte.
+    """
+    partes = {}
+    for metrica in metricas_da_requisicao(request):
+        if usar_rollup and pode_usar_hll(request, metrica):
+            chave = ('hll', t_sales)
+        elif usar_rollup and pode_usar_rollup(request, metrica):
+            chave = ('rollup', t_sales)
+        else:
+            chave = ('vendas', _tabela_da_expressao(METRIC_MAP[metrica]))
+        partes.setdefault(chave, []).append(metrica)
+    if ('rollup', t_sales) in partes and ('vendas', t_sales) in partes:
+        ordem = metricas_da_requisicao(request)
+        juntas = partes.pop(('rollup', t_sales)) + partes[('vendas', t_sales)]
+        partes[('vendas', t_sales)] = sorted(juntas, key=ordem.index)
+    return [(fonte, grao, metricas) for (fonte, grao), metricas in partes.items()]
+
+
+def fonte_da_requisicao(request: QueryRequest, usar_rollup: bool = True):
+    """
+    De onde a pergunta é respondida: 'hll', 'rollup' ou 'vendas'. Com várias
+    métricas em partes de fontes diferentes, as fontes unidas por '+'.
+    """
+    partes = partes_da_requisicao(request, usar_rollup)
+    return '+'.join(dict.fromkeys(fonte for fonte, _, _ in partes))
+
 
-# --- 3. O Construtor da Query (A Lógica Principal) ---
+def erro_padrao_relativo(request: QueryRequest, usar_rollup: bool = True):
+    """Erro relativo típico da resposta (da coluna de clientes únicos): None quando ela é exata."""
+    return rollup.HLL_ERRO_PADRAO if 'hll' in fonte_da_requisicao(request, usar_rollup).split('+') else None
 
-def build_analytics_query(request: QueryRequest):
+
+def build_analytics_query(request: QueryRequest, usar_rollup: bool = True):
     """
     Recebe o 'contrato' (QueryRequest) e constrói dinamicamente
     uma query SQLAlchemy segura e otimizada.
+
+    Quando `usar_rollup` é True e a métrica/dimensões cabem no rollup,
+    a query é montada sobre as tabelas pré-agregadas em vez de `sales`.
+    O chamador decide se o rollup está pronto (ver rollup.rollup_pronto).
+
+    Com `metricas`, cada métrica vira uma coluna. As que cabem num mesmo
+    SELECT saem juntas; grãos diferentes viram partes unidas pelas
+    dimensões (ver partes_da_requisicao).
+
+    A query vem com os valores da pergunta já ligados. Para executar
+    muitas vezes, prefira plano_da_requisicao (query em cache + parâmetros).
     """
-    
-    # --- Passo 1: Selecionar a Métrica ---
-    metric_sql = METRIC_MAP.get(request.metrica)
-    if metric_sql is None:
-        raise ValueError(f"Métrica inválida: {request.metrica}")
-    
-    query = select(metric_sql.label("metrica"))
-    
-    # --- Passo 2 & 3: Dimensões e JOINs necessários ---
-    dimensions_sql = []
-    required_joins = {t_sales} 
-    dim_fields = set(d.value for d in request.dimensoes)
-    filter_fields = set(f.campo.value for f in request.filtros)
-    all_fields = dim_fields.union(filter_fields)
-
-    # Função auxiliar para adicionar joins
-    def add_join(table, condition):
-        if table not in required_joins:
-            required_joins.add(table)
-            return (table, condition)
-        return None
-
-    join_conditions = []
-
-    # Mapeia campos (dimensões/filtros) para as tabelas e joins que eles precisam
-    # Esta é a lógica central para otimizar os joins
-    if any(f in all_fields for f in ['loja_nome', 'cidade_loja', 'bairro_loja', 'estado_loja', 'marca_nome', 'sub_marca_nome']):
-        join_conditions.append(add_join(t_stores, t_sales.c.store_id == t_stores.c.id))
-    
-    if 'sub_marca_nome' in all_fields:
-        join_conditions.append(add_join(t_sub_brands, t_sales.c.sub_brand_id == t_sub_brands.c.id))
-        
+    query, parametros = plano_da_requisicao(request, usar_rollup)
+    return query.params(**parametros)
+
+
+def _montar_query(request: QueryRequest, usar_rollup: bool):
+    """Monta a query da pergunta com parâmetros nomeados no lugar dos valores."""
+    partes = partes_da_requisicao(request, usar_rollup)
+    if len(partes) == 1:
+        fonte, _, metricas = partes[0]
+        return _montar_parte(request, fonte, None if request.metricas is None else metricas)
+    return _unir_partes(request, [
+        _montar_parte(request, fonte, metricas, parcial=True) for fonte, _, metricas in partes
+    ])
+
+
+def _montar_parte(request: QueryRequest, fonte, metricas, parcial=False):
+    if fonte == 'hll':
+        return build_hll_query(request, metricas, parcial)
+    if fonte == 'rollup':
+        return build_rollup_query(request, metricas, parcial)
+    return build_sales_query(request, metricas, parcial)
+
+
+def _colunas_metricas(request: QueryRequest, metric_map, metricas):
+    """
+    As métricas do SELECT: a coluna `metrica` (pergunta de uma métrica só)
+    ou, com `metricas`, uma coluna por métrica, com o nome dela.
+    """
+    if metricas is None:
+        return [metric_map[Metrica(request.metrica)].label("metrica")]
+    return [metric_map[m].label(m.value) for m in metricas]
+
+
+def build_sales_query(request: QueryRequest, metricas=None, parcial=False):
+    """
+    Versão de build_analytics_query que lê direto de `sales` (e das tabelas
+    ligadas a ela). `metricas`: todas do mesmo grão (ver partes_da_requisicao).
+    Com `parcial`, a query sai só agrupada, sem ORDER BY/LIMIT.
+    """
+    # --- Passo 1: Selecionar as Métricas ---
+    metricas_sql = []
+    for metrica in metricas or [Metrica(request.metrica)]:
+        metric_sql = METRIC_MAP.get(metrica)
+        if metric_sql is None:
+            raise ValueError(f"Métrica inválida: {metrica}")
+        metricas_sql.append(metric_sql)
+
+    # --- Passo 2: Tabelas de cada dimensão/filtro ---
+    dim_fields, _ = _campos_da_requisicao(request)
+    campos = [Dimensao(d) for d in request.dimensoes] + [Dimensao(f.campo) for f in request.filtros]
+    for campo in campos:
+        if DIMENSION_MAP.get(campo) is None:
+            raise ValueError(f"Dimensão inválida: {campo}")
+
+    # --- Passo 3 & 4: JOINs planejados pelo grafo (sem multiplicar linhas) ---
+    join_chain, dim_map, filtros_aplicados = planejar_joins(
+        request, _tabela_da_expressao(metricas_sql[0]),
+        reduzir_ramos=not set(metricas or [Metrica(request.metrica)]) <= METRICAS_SEM_DUPLICACAO
+    )
+
+    # A poda usa as tabelas antes do JOIN com os períodos (que não é particionado)
+    tabelas_particionadas = _tabelas_com_join_interno(join_chain)
+    periodos = dias_periodos = None
+    if request.comparacao is not None:
+        join_chain, dim_map, periodos, dias_periodos, condicao_periodos = \
+            _juntar_periodos(request, join_chain, dim_map, t_sales)
+
+    dimensions_sql = [dim_map[Dimensao(d)].label(Dimensao(d).value) for d in request.dimensoes]
+    query = select(*_colunas_metricas(request, METRIC_MAP, metricas), *dimensions_sql).select_from(join_chain)
+    if periodos is not None:
+        query = query.where(condicao_periodos)
+
+    # --- Passo 4.1: Poda das partições pelos filtros de tempo ---
+    podas = _podas_particao(request, tabelas_particionadas)
+    if podas:
+        query = query.where(and_(*podas))
+
+    # --- Passos 5 a 7: WHERE, GROUP BY, ORDER BY, LIMIT ---
+    return _finalizar_query(query, request, dim_map, dimensions_sql, dim_fields, filtros_aplicados,
+                            periodos, dias_periodos, parcial=parcial)
+
+
+def build_rollup_query(request: QueryRequest, metricas=None, parcial=False):
+    """
+    Versão de build_analytics_query que lê das tabelas de rollup.
+    Usa o rollup diário, a não ser que a hora do dia seja pedida.
+    """
+    dim_fields, all_fields = _campos_da_requisicao(request)
+    t = t_sales_rollup_hourly if 'hora_dia' in all_fields else t_sales_rollup_daily
+    metricas_sql = _colunas_metricas(request, ROLLUP_METRIC_MAPS[t], metricas)
+    dim_map = ROLLUP_DIMENSION_MAPS[t]
+    join_chain = _joins_rollup(t, all_fields)
+    periodos = dias_periodos = None
+    if request.comparacao is not None:
+        join_chain, dim_map, periodos, dias_periodos, condicao_periodos = \
+            _juntar_periodos(request, join_chain, dim_map, t)
+
+    dimensions_sql = [dim_map[Dimensao(d)].label(Dimensao(d).value) for d in request.dimensoes]
+    query = select(*metricas_sql, *dimensions_sql).select_from(join_chain)
+    if periodos is not None:
+        query = query.where(condicao_periodos)
+
+    return _finalizar_query(query, request, dim_map, dimensions_sql, dim_fields,
+                            periodos=periodos, origem_periodo=dias_periodos, parcial=parcial)
+
+
+def build_hll_query(request: QueryRequest, metricas=None, parcial=False):
+    """
+    total_clientes_unicos aproximado, a partir dos sketches HLL do rollup.
+    A subquery junta os sketches dos buckets filtrados (MAX(rho) por
+    registrador em cada grupo) e a query de fora estima cada grupo.
+    """
+    dim_fields, all_fields = _campos_da_requisicao(request)
+    t = t_sales_rollup_hll
+    dim_map = ROLLUP_DIMENSION_MAPS[t]
+    join_chain = _joins_rollup(t, all_fields)
+    periodos, colunas_periodo = None, []
+    if request.comparacao is not None:
+        join_chain, dim_map, periodos, dias_periodos, condicao_periodos = \
+            _juntar_periodos(request, join_chain, dim_map, t)
+        colunas_periodo = [dias_periodos.c[nome] for nome in COLUNAS_PERIODO]
+
+    dimensions_sql = [dim_map[Dimensao(d)].label(Dimensao(d).value) for d in request.dimensoes]
+    sketch = select(*dimensions_sql, *colunas_periodo, t.c.registrador, func.max(t.c.rho).label('rho')) \
+        .select_from(join_chain)
+    filters_sql = _filtros_sql(request, dim_map)
+    if colunas_periodo:
+        filters_sql.append(condicao_periodos)
+    if filters_sql:
+        sketch = sketch.where(and_(*filters_sql))
+    sketch = sketch.group_by(*dimensions_sql, *colunas_periodo, t.c.registrador).subquery('hll')
+
+    # Fora da subquery os filtros já foram aplicados; só agrupa, ordena e limita
+    dim_map_sketch = {Dimensao(d): sketch.c[Dimensao(d).value] for d in request.dimensoes}
+    dimensions_sketch = [dim_map_sketch[Dimensao(d)] for d in request.dimensoes]
+    estimativa = literal_column(rollup.sql_estimativa_hll('hll.rho'), BigInteger)
+    rotulo = "metrica" if metricas is None else Metrica.total_clientes_unicos.value
+    query = select(estimativa.label(rotulo), *dimensions_sketch).select_from(sketch)
+
+    return _finalizar_query(query, request, dim_map_sketch, dimensions_sketch, dim_fields,
+                            filtros_aplicados=range(len(request.filtros)),
+                            periodos=periodos if colunas_periodo else None, origem_periodo=sketch,
+                            parcial=parcial)
+
+
+def _unir_partes(request: QueryRequest, partes):
+    """
+    Junta as partes de uma pergunta com várias métricas (cada uma já agrupada
+    pelas dimensões) pelas chaves das dimensões: UNION ALL, com NULL nas
+    métricas das outras partes, e um GROUP BY por fora. O GROUP BY trata
+    dimensões NULL como iguais (como IS NOT DISTINCT FROM) e, ao contrário de
+    um FULL JOIN por essa condição, o Postgres o executa com hash. Uma
+    combinação que só aparece numa parte fica com as métricas das outras nulas.
+    """
+    metricas = metricas_da_requisicao(request)
+    dims = [Dimensao(d).value for d in request.dimensoes]
+
+    def coluna(parte, metrica):
+        if metrica.value in parte.selected_columns:
+            return parte.selected_columns[metrica.value]
+        # NULL com o tipo da métrica: com 3+ partes, NULLs sem tipo virariam text no UNION
+        tipo = next(p.selected_columns[metrica.value].type for p in partes if metrica.value in p.selected_columns)
+        return cast(null(), Numeric if isinstance(tipo, NullType) else tipo).label(metrica.value)
+
+    uniao = union_all(*(
+        parte.with_only_columns(*(parte.selected_columns[d] for d in dims), *(coluna(parte, m) for m in metricas))
+        for parte in partes
+    )).subquery('partes')
+
+    dim_fields, _ = _campos_da_requisicao(request)
+    dim_map = {Dimensao(d): uniao.c[d] for d in dims}
+    dimensions_sql = [uniao.c[d] for d in dims]
+    query = select(*(func.max(uniao.c[m.value]).label(m.value) for m in metricas), *dimensions_sql) \
+        .select_from(uniao).group_by(*dimensions_sql)
+    return _ordenar_e_limitar(query, request, dim_map, dim_fields)
+
+
+def _joins_rollup(t, all_fields):
+    """
+    JOINs a partir de uma tabela de rollup: ela já tem loja, sub-marca e canal
+    como chaves. O sub_brand_id do rollup é o da loja (ver GRAFO_TABELAS).
+    """
+    join_chain = t
+    if all_fields & STORE_FIELDS:
+        join_chain = join_chain.join(t_stores, t.c.store_id == t_stores.c.id)
     if 'marca_nome' in all_fields:
-        # Precisa de join em stores E sub_brands para chegar em brands
-        join_conditions.append(add_join(t_stores, t_sales.c.store_id == t_stores.c.id))
-        join_conditions.append(add_join(t_brands, t_stores.c.brand_id == t_brands.c.id))
+        join_chain = join_chain.join(t_brands, t_stores.c.brand_id == t_brands.c.id)
+    if 'sub_marca_nome' in all_fields:
+        join_chain = join_chain.join(t_sub_brands, t.c.sub_brand_id == t_sub_brands.c.id)
+    if all_fields & {'canal_nome', 'tipo_canal'}:
+        join_chain = join_chain.join(t_channels, t.c.channel_id == t_channels.c.id)
+    return join_chain
 
-    if any(f in all_fields for f in ['canal_nome', 'tipo_canal']):
-        join_conditions.append(add_join(t_channels, t_sales.c.channel_id == t_channels.c.id))
 
-    if any(f in all_fields for f in ['bairro_entrega', 'cidade_entrega']):
-        join_conditions.append(add_join(t_delivery_addresses, t_sales.c.id == t_delivery_addresses.c.sale_id, True)) # LEFT JOIN
+def _aplicar_filtro(col_sql, f: Filtro, nome: str):
+    """
+    Traduz um Filtro em uma expressão SQLAlchemy sobre a coluna.
+    O valor entra como parâmetro `nome` (ver parametros_da_requisicao).
+    """
+    valor = bindparam(nome)
+    if f.operador == OperadorFiltro.eq: return col_sql == valor
+    elif f.operador == OperadorFiltro.neq: return col_sql != valor
+    elif f.operador == OperadorFiltro.gt: return col_sql > valor
+    elif f.operador == OperadorFiltro.gte: return col_sql >= valor
+    elif f.operador == OperadorFiltro.lt: return col_sql < valor
+    elif f.operador == OperadorFiltro.lte: return col_sql <= valor
+    elif f.operador == OperadorFiltro.in_: return col_sql.in_(bindparam(nome, expanding=True))
+    elif f.operador == OperadorFiltro.not_in: return col_sql.notin_(bindparam(nome, expanding=True))
+    elif f.operador == OperadorFiltro.like: return col_sql.like(valor)
+    elif f.operador == OperadorFiltro.between: return col_sql.between(valor, bindparam(f"{nome}_fim"))
+    raise ValueError(f"Operador de filtro inválido: {f.operador}")
 
-    if any(f in all_fields for f in ['tipo_entregador', 'tipo_entrega']):
-        join_conditions.append(add_join(t_delivery_sales, t_sales.c.id == t_delivery_sales.c.sale_id, True)) # LEFT JOIN
 
-    if 'tipo_pagamento' in all_fields:
-        join_conditions.append(add_join(t_payments, t_sales.c.id == t_payments.c.sale_id))
-        join_conditions.append(add_join(t_payment_types, t_payments.c.payment_type_id == t_payment_types.c.id))
+# O JSON traz datas e horas como texto/número; o driver assíncrono exige o tipo da coluna
+CONVERSAO_FILTRO = {
+    Dimensao.dia: date.fromisoformat,
+    Dimensao.data: datetime.fromisoformat,
+    Dimensao.hora_dia: int,
+}
 
-    # Joins para Produtos/Itens (mais complexos)
-    product_fields = ['produto_nome', 'produto_categoria', 'item_adicional_nome', 'grupo_opcao_nome']
-    if any(f in all_fields for f in product_fields) or request.metrica in [Metrica.total_itens_vendidos, Metrica.faturamento_adicionais]:
-        join_conditions.append(add_join(t_product_sales, t_sales.c.id == t_product_sales.c.sale_id))
+def _converter_valor(campo, valor):
+    converter = CONVERSAO_FILTRO.get(Dimensao(campo))
+    if converter is None or not isinstance(valor, (str, int, float)):
+        return valor
+    try:
+        return converter(valor)
+    except (TypeError, ValueError):
+        raise ValueError(f"Valor inválido para o filtro '{Dimensao(campo).value}': {valor!r}")
 
-    if any(f in all_fields for f in ['produto_nome', 'produto_categoria']):
-        join_conditions.append(add_join(t_products, t_product_sales.c.product_id == t_products.c.id))
 
-    if 'produto_categoria' in all_fields:
-        join_conditions.append(add_join(t_categories, t_products.c.category_id == t_categories.c.id))
+# Unidade do deslocamento -> unidade do INTERVAL do Postgres
+UNIDADE_INTERVALO = {
+    UnidadeDeslocamento.dias: 'days',
+    UnidadeDeslocamento.semanas: 'weeks',
+    UnidadeDeslocamento.meses: 'months',
+    UnidadeDeslocamento.anos: 'years',
+}
 
-    if any(f in all_fields for f in ['item_adicional_nome', 'grupo_opcao_nome']) or request.metrica == Metrica.faturamento_adicionais:
-        join_conditions.append(add_join(t_item_product_sales, t_product_sales.c.id == t_item_product_sales.c.product_sale_id, True)) # LEFT JOIN
+def _parametros_comparacao(request: QueryRequest):
+    """Rótulo, limites e deslocamento (que alinha as datas à base) de cada período."""
+    campos_de_data = {Dimensao(f.campo) for f in request.filtros} & CAMPOS_DE_DATA
+    if campos_de_data:
+        nomes = ', '.join(sorted(c.value for c in campos_de_data))
+        raise ValueError(f"Com 'comparacao', o período vem de 'comparacao.base'; remova os filtros de {nomes}")
+    deslocamentos = [None] + list(request.comparacao.deslocamentos)
+    parametros = {}
+    for k, ((rotulo, periodo), d) in enumerate(zip(request.comparacao.periodos(), deslocamentos)):
+        parametros[f"periodo_{k}_rotulo"] = rotulo
+        parametros[f"periodo_{k}_inicio"] = periodo.inicio
+        parametros[f"periodo_{k}_fim"] = periodo.fim
+        parametros[f"periodo_{k}_deslocamento"] = (
+            '0 days' if d is None else f"{d.quantidade} {UNIDADE_INTERVALO[UnidadeDeslocamento(d.unidade)]}"
+        )
+    return parametros
 
-    if 'item_adicional_nome' in all_fields:
-        join_conditions.append(add_join(t_items, t_item_product_sales.c.item_id == t_items.c.id, True)) # LEFT JOIN
-    
-    if 'grupo_opcao_nome' in all_fields:
-         join_conditions.append(add_join(t_option_groups, t_item_product_sales.c.option_group_id == t_option_groups.c.id, True)) # LEFT JOIN
-
-    # Adiciona as dimensões ao SELECT
-    for dim in request.dimensoes:
-        dim_sql = DIMENSION_MAP.get(dim)
-        if dim_sql is None:
-            raise ValueError(f"Dimensão inválida: {dim}")
-        dimensions_sql.append(dim_sql.label(dim.value))
-    
-    query = query.add_columns(*dimensions_sql)
 
-    # --- Passo 4: Construir a cláusula FROM (com JOINs) ---
-    join_chain = t_sales
-    for j in join_conditions:
-        if j: # Ignora Nones (joins já adicionados)
-            table, condition, *isouter = j
-            join_chain = join_chain.join(table, condition, isouter=isouter)
+def parametros_da_requisicao(request: QueryRequest):
+    """Valores da pergunta para os parâmetros nomeados da query (filtros e limite)."""
+    parametros = {'limite': request.limite}
+    if request.comparacao is not None:
+        parametros.update(_parametros_comparacao(request))
+    for i, f in enumerate(request.filtros):
+        nome = f"filtro_{i}"
+        if f.operador == OperadorFiltro.like:
+            parametros[nome] = f"%{f.valor}%"
+        elif f.operador == OperadorFiltro.between:
+            if not (isinstance(f.valor, (list, tuple)) and len(f.valor) == 2):
+                raise ValueError("Operador 'between' exige uma lista com 2 valores")
+            parametros[nome], parametros[f"{nome}_fim"] = (_converter_valor(f.campo, v) for v in f.valor)
+        elif f.operador in (OperadorFiltro.in_, OperadorFiltro.not_in):
+            if not isinstance(f.valor, (list, tuple)):
+                raise ValueError(f"Operador '{OperadorFiltro(f.operador).value}' exige uma lista de valores")
+            parametros[nome] = [_converter_valor(f.campo, v) for v in f.valor]
+        else:
+            parametros[nome] = _converter_valor(f.campo, f.valor)
+    return parametros
 
-    query = query.select_from(join_chain)
 
-    # --- Passo 5: Construir a cláusula WHERE (Filtros) ---
+def _filtros_sql(request: QueryRequest, dim_map, filtros_aplicados=()):
+    """Expressões do WHERE, uma por filtro (menos os de `filtros_aplicados`)."""
     filters_sql = []
-    for f in request.filtros:
-        col_sql = DIMENSION_MAP.get(f.campo)
+    for i, f in enumerate(request.filtros):
+        if i in filtros_aplicados:
+            continue
+        col_sql = dim_map.get(Dimensao(f.campo))
         if col_sql is None:
             raise ValueError(f"Campo de filtro inválido: {f.campo}")
+        filters_sql.append(_aplicar_filtro(col_sql, f, f"filtro_{i}"))
+    return filters_sql
 
-        if f.operador == OperadorFiltro.eq: filters_sql.append(col_sql == f.valor)
-        elif f.operador == OperadorFiltro.neq: filters_sql.append(col_sql != f.valor)
-        elif f.operador == OperadorFiltro.gt: filters_sql.append(col_sql > f.valor)
-        elif f.operador == OperadorFiltro.gte: filters_sql.append(col_sql >= f.valor)
-        elif f.operador == OperadorFiltro.lt: filters_sql.append(col_sql < f.valor)
-        elif f.operador == OperadorFiltro.lte: filters_sql.append(col_sql <= f.valor)
-        elif f.operador == OperadorFiltro.in_: filters_sql.append(col_sql.in_(f.valor))
-        elif f.operador == OperadorFiltro.not_in: filters_sql.append(col_sql.notin_(f.valor))
-        elif f.operador == OperadorFiltro.like: filters_sql.append(col_sql.like(f"%{f.valor}%"))
-        elif f.operador == OperadorFiltro.between:
-            if isinstance(f.valor, (list, tuple)) and len(f.valor) == 2:
-                filters_sql.append(col_sql.between(f.valor[0], f.valor[1]))
-            else:
-                raise ValueError("Operador 'between' exige uma lista com 2 valores")
+
+def _finalizar_query(query, request: QueryRequest, dim_map, dimensions_sql, dim_fields, filtros_aplicados=(),
+                     periodos=None, origem_periodo=None, parcial=False):
+    """
+    WHERE (filtros), GROUP BY, ORDER BY e LIMIT, comuns a todas as fontes.
+    `filtros_aplicados`: índices de filtros que já estão numa subquery.
+    `periodos`: com comparação, a subquery dos períodos (ver _juntar_periodos);
+    as colunas do período da query vêm de `origem_periodo`.
+    `parcial`: para aí no GROUP BY (a parte será unida às outras, ver _unir_partes).
+    """
+
+    # --- Passo 5: Construir a cláusula WHERE (Filtros) ---
+    filters_sql = _filtros_sql(request, dim_map, filtros_aplicados)
     
     if filters_sql:
         query = query.where(and_(*filters_sql))
 
     # --- Passo 6: Construir GROUP BY, ORDER BY, LIMIT ---
+    if periodos is not None:
+        colunas_periodo = [origem_periodo.c[nome] for nome in COLUNAS_PERIODO]
+        query = query.add_columns(*colunas_periodo).group_by(*dimensions_sql, *colunas_periodo)
+        if request.ordenar_por != "metrica" and request.ordenar_por not in dim_fields:
+            raise ValueError(f"Campo de ordenação inválido: {request.ordenar_por}")
+        return _comparar_periodos(query, request, periodos)
+
     if dimensions_sql:
         query = query.group_by(*dimensions_sql)
+    if parcial:
+        return query
+
+    # --- Passo 7: Retornar a query pronta ---
+    return _ordenar_e_limitar(query, request, dim_map, dim_fields)
 
-    # Ordenação
+
+def _ordenar_e_limitar(query, request: QueryRequest, dim_map, dim_fields):
+    """ORDER BY (métrica ou dimensão pedida) e LIMIT."""
+    nomes_metricas = {m.value for m in metricas_da_requisicao(request)} if request.metricas is not None else set()
     order_col_sql = None
     if request.ordenar_por == "metrica":
-        order_col_sql = "metrica"
+        order_col_sql = literal_column("metrica" if request.metricas is None else Metrica(request.metrica).value)
+    elif request.ordenar_por in nomes_metricas:
+        order_col_sql = literal_column(request.ordenar_por)
     elif request.ordenar_por in dim_fields:
-        order_col_sql = DIMENSION_MAP.get(Dimensao(request.ordenar_por))
+        order_col_sql = dim_map.get(Dimensao(request.ordenar_por))
     
     if order_col_sql is None:
         raise ValueError(f"Campo de ordenação inválido: {request.ordenar_por}")
 
-    order_func = func.desc if request.ordem == Ordem.desc else func.asc
-    query = query.order_by(order_func(order_col_sql))
+    order_func = desc if request.ordem == Ordem.desc else asc
+    ordem = order_func(order_col_sql)
+    if request.metricas is not None:
+        ordem = ordem.nulls_last()  # combinações sem a métrica (só em outra parte) vão para o fim
+    query = query.order_by(ordem)
     
-    query = query.limit(request.limite)
+    return query.limit(bindparam('limite', type_=Integer))
 
-    # --- Passo 7: Retornar a query pronta ---
-    return query
\ No newline at end of file
+
+# --- 5. Cache de Planos (query montada uma vez por "forma" de pergunta) ---
+# Os painéis mandam poucas formas (métrica + dimensões + campos/operadores
+# dos filtros + ordenação) com valores diferentes. A query de cada forma é
+# montada uma vez, com parâmetros nomeados, e só os valores mudam por chamada.
+# Como o SQL da forma é sempre o mesmo, o SQLAlchemy reaproveita a compilação
+# e o driver assíncrono reaproveita o prepared statement de cada conexão.
+PLANOS_MAX_ITENS = 256
+
+
+class CachePlanos:
+    """LRU de queries montadas, por forma da pergunta. Thread-safe."""
+
+    def __init__(self, max_itens=PLANOS_MAX_ITENS):
+        self.max_itens = max_itens
+        self._itens = OrderedDict()  # forma -> (query, custo_montagem_segundos)
+        self._lock = threading.Lock()
+        self._contadores = {'hits': 0, 'misses': 0, 'despejados': 0}
+        self._tempo = {'montagem': 0.0, 'economizado': 0.0}
+
+    def obter_ou_montar(self, forma, montar):
+        with self._lock:
+            item = self._itens.get(forma)
+            if item is not None:
+                self._itens.move_to_end(forma)
+                self._contadores['hits'] += 1
+                self._tempo['economizado'] += item[1]
+                return item[0]
+
+        inicio = time.perf_counter()
+        query = montar()
+        # Compila uma vez aqui: o SQLAlchemy guarda o SQL no cache de compilação
+        query.compile(dialect=_DIALETO_POSTGRES)
+        custo = time.perf_counter() - inicio
+
+        with self._lock:
+            self._contadores['misses'] += 1
+            self._tempo['montagem'] += custo
+            self._itens[forma] = (query, custo)
+            self._itens.move_to_end(forma)
+            while len(self._itens) > self.max_itens:
+                self._itens.popitem(last=False)
+                self._contadores['despejados'] += 1
+        return query
+
+    def limpar(self):
+        with self._lock:
+            self._itens.clear()
+
+    def estatisticas(self):
+        with self._lock:
+            consultas = self._contadores['hits'] + self._contadores['misses']
+            return {
+                **self._contadores,
+                'taxa_acerto': (self._contadores['hits'] / consultas) if consultas else 0,
+                'itens': len(self._itens),
+                'max_itens': self.max_itens,
+                'tempo_montagem_ms': 1000 * self._tempo['montagem'],
+                'tempo_economizado_ms': 1000 * self._tempo['economizado'],
+            }
+
+
+_DIALETO_POSTGRES = postgresql.dialect()
+planos = CachePlanos()
+
+
+def forma_da_requisicao(request: QueryRequest, usar_rollup: bool = True):
+    """Chave do cache de planos: tudo o que muda o SQL, sem os valores."""
+    filtros = tuple((Dimensao(f.campo).value, OperadorFiltro(f.operador).value) for f in request.filtros)
+    metricas = Metrica(request.metrica).value if request.metricas is None else \
+        tuple(m.value for m in metricas_da_requisicao(request))
+    return (
+        metricas,
+        tuple(Dimensao(d).value for d in request.dimensoes),
+        filtros,
+        request.ordenar_por,
+        Ordem(request.ordem).value,
+        len(request.comparacao.deslocamentos) if request.comparacao is not None else 0,
+        fonte_da_requisicao(request, usar_rollup),
+    )
+
+
+def plano_da_requisicao(request: QueryRequest, usar_rollup: bool = True):
+    """
+    (query, parâmetros) da pergunta: a query vem do cache de planos (montada
+    uma vez por forma) e os parâmetros trazem os valores desta chamada.
+    Execute com conn.execute(query, parametros).
+    """
+    parametros = parametros_da_requisicao(request)
+    query = planos.obter_ou_montar(
+        forma_da_requisicao(request, usar_rollup), lambda: _montar_query(request, usar_rollup)
+    )
+    return query, parametros
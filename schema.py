@@ -1,6 +1,7 @@
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, model_validator
 from typing import List, Optional, Any
-from datetime import date
+from datetime import date, timedelta
+from calendar import monthrange
 from enum import Enum
 
 # --- Definição das Métricas (O que medir) ---
@@ -74,6 +75,70 @@ class Ordem(str, Enum):
     asc = "ASC"  # Ascendente
     desc = "DESC" # Descendente
 
+class ModoContagem(str, Enum):
+    exato = "exato"  # COUNT(DISTINCT) sobre as vendas
+    aproximado = "aproximado"  # Sketches HyperLogLog do rollup (erro relativo ~1,6%)
+
+class UnidadeDeslocamento(str, Enum):
+    dias = "dias"
+    semanas = "semanas"
+    meses = "meses"
+    anos = "anos"
+
+# --- Comparação entre períodos ("esta semana x semana passada") ---
+def deslocar_dia(dia: date, quantidade: int, unidade: UnidadeDeslocamento) -> date:
+    """Move o dia `quantidade` unidades (negativo = para trás). Meses/anos param no último dia do mês."""
+    unidade = UnidadeDeslocamento(unidade)
+    if unidade == UnidadeDeslocamento.dias:
+        return dia + timedelta(days=quantidade)
+    if unidade == UnidadeDeslocamento.semanas:
+        return dia + timedelta(weeks=quantidade)
+    meses = quantidade * (12 if unidade == UnidadeDeslocamento.anos else 1)
+    indice = dia.year * 12 + dia.month - 1 + meses
+    ano, mes = indice // 12, indice % 12 + 1
+    return date(ano, mes, min(dia.day, monthrange(ano, mes)[1]))
+
+class Periodo(BaseModel):
+    inicio: date = Field(..., description="Primeiro dia (inclusivo).")
+    fim: date = Field(..., description="Último dia (inclusivo).")
+
+    @model_validator(mode='after')
+    def _ordem_das_datas(self):
+        if self.fim < self.inicio:
+            raise ValueError("período invertido: 'fim' antes de 'inicio'")
+        return self
+
+class Deslocamento(BaseModel):
+    quantidade: int = Field(default=1, ge=1, description="Quantas unidades antes do período base.")
+    unidade: UnidadeDeslocamento = Field(..., description="dias, semanas, meses ou anos.")
+
+    @property
+    def rotulo(self):
+        """Ex.: '-1s' (semana anterior), '-1a' (mesmo período do ano anterior)."""
+        return f"-{self.quantidade}{UnidadeDeslocamento(self.unidade).value[0]}"
+
+    def aplicar(self, periodo: Periodo) -> Periodo:
+        """
+        O período base deslocado para trás. Em meses/anos, um período que
+        termina no último dia do mês continua terminando no último dia
+        (outubro -> setembro inteiro).
+        """
+        fim = deslocar_dia(periodo.fim, -self.quantidade, self.unidade)
+        em_meses = UnidadeDeslocamento(self.unidade) in (UnidadeDeslocamento.meses, UnidadeDeslocamento.anos)
+        if em_meses and periodo.fim.day == monthrange(periodo.fim.year, periodo.fim.month)[1]:
+            fim = fim.replace(day=monthrange(fim.year, fim.month)[1])
+        return Periodo(inicio=deslocar_dia(periodo.inicio, -self.quantidade, self.unidade), fim=fim)
+
+class Comparacao(BaseModel):
+    base: Periodo = Field(..., description="Período principal.")
+    deslocamentos: List[Deslocamento] = Field(
+        ..., min_length=1, description="Períodos de comparação, cada um deslocado para trás a partir da base."
+    )
+
+    def periodos(self):
+        """[(rótulo, Periodo)]: a base primeiro, depois um por deslocamento."""
+        return [('base', self.base)] + [(d.rotulo, d.aplicar(self.base)) for d in self.deslocamentos]
+
 # --- Estrutura dos Filtros ---
 class Filtro(BaseModel):
     campo: Dimensao = Field(..., description="O campo/dimensão para filtrar")
@@ -87,7 +152,19 @@ class QueryRequest(BaseModel):
     para o nosso endpoint POST /api/v1/query
     """
     
-    metrica: Metrica = Field(..., description="A métrica principal a ser calculada.")
+    metrica: Optional[Metrica] = Field(
+        default=None,
+        description="A métrica principal a ser calculada. Com 'metricas', é a usada por ordenar_por='metrica' (padrão: a primeira)."
+    )
+
+    metricas: Optional[List[Metrica]] = Field(
+        default=None,
+        min_length=1,
+        description=(
+            "Várias métricas na mesma pergunta, cada uma numa coluna com o nome da métrica. "
+            "As de mesmo grão (venda, item, adicional) saem do mesmo SELECT."
+        )
+    )
     
     dimensoes: List[Dimensao] = Field(
         ..., 
@@ -115,6 +192,36 @@ class QueryRequest(BaseModel):
         description="Número máximo de resultados a retornar."
     )
 
+    modo_clientes_unicos: ModoContagem = Field(
+        default=ModoContagem.exato,
+        description="Como contar 'total_clientes_unicos': exato ou aproximado (HyperLogLog, bem mais rápido)."
+    )
+
+    comparacao: Optional[Comparacao] = Field(
+        default=None,
+        description=(
+            "Compara o período base com períodos deslocados (ex.: semana anterior), numa query só. "
+            "Cada linha ganha o rótulo do período e, nos de comparação, 'delta' e 'variacao_percentual' "
+            "da base em relação a eles. Substitui os filtros de data."
+        )
+    )
+
+    @model_validator(mode='after')
+    def _metrica_principal(self):
+        if self.metricas is None:
+            if self.metrica is None:
+                raise ValueError("informe 'metrica' ou 'metricas'")
+            return self
+        if len(set(self.metricas)) != len(self.metricas):
+            raise ValueError("'metricas' tem métricas repetidas")
+        if self.metrica is None:
+            self.metrica = self.metricas[0]
+        elif self.metrica not in self.metricas:
+            raise ValueError("'metrica' precisa estar em 'metricas'")
+        if self.comparacao is not None:
+            raise ValueError("'comparacao' aceita uma métrica só: use 'metrica'")
+        return self
+
     class Config:
         use_enum_values = True
 
@@ -125,4 +232,8 @@ class QueryResponse(BaseModel):
     O que a nossa API irá retornar em formato JSON.
     """
     dados: List[dict] = Field(..., description="Os dados resultantes da consulta.")
+    erro_padrao_relativo: Optional[float] = Field(
+        default=None,
+        description="Erro relativo típico da métrica quando ela é aproximada (None = valor exato)."
+    )
     query_request: QueryRequest = Field(..., description="O 'pedido' original para referência.")
\ No newline at end of file